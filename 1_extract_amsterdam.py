@@ -4,16 +4,17 @@ This code extracts the data from the Amsterdam dataset
 
 It creates a set of .parquet files at the specified path 
 ('amsterdam' in paths.json). 
+The extraction steps are run by N_WORKERS processes (config.json).
 """
 from amsterdam_preprocessing.AmsterdamPreparator import AmsterdamPreparator
+from database_processing.extractionrunner import ExtractionRunner
 
-ams_prep = AmsterdamPreparator(
+preparator_kwargs = dict(
     admission_pth='admissions.csv.gz',
     drugitems_pth='drugitems.csv.gz',
     numericitems_pth='numericitems.csv.gz',
     listitems_pth='listitems.csv.gz')
 
-ams_prep.gen_labels()
-ams_prep.gen_medication()
-ams_prep.gen_listitems_timeseries()
-ams_prep.gen_num_timeseries()
+if __name__ == '__main__':
+    runner = ExtractionRunner(AmsterdamPreparator, **preparator_kwargs)
+    runner.run()
@@ -4,10 +4,12 @@ This code extracts the data from the Amsterdam dataset
 
 It creates a set of .parquet files at the specified path 
 ('eicu' in paths.json). 
+The extraction steps are run by N_WORKERS processes (config.json).
 """
 from eicu_preprocessing.eicupreparator import eicuPreparator
+from database_processing.extractionrunner import ExtractionRunner
 
-eicu_prep = eicuPreparator(
+preparator_kwargs = dict(
     physicalexam_pth='physicalExam.csv.gz',
     diag_pth='diagnosis.csv.gz',
     pasthistory_pth='pastHistory.csv.gz',
@@ -23,12 +25,6 @@ eicu_prep = eicuPreparator(
     aperiodic_pth='vitalAperiodic.csv.gz',
     intakeoutput_pth='intakeOutput.csv.gz')
 
-eicu_prep.gen_labels()
-eicu_prep.gen_flat()
-eicu_prep.gen_medication()
-eicu_prep.gen_timeseriesintakeoutput()
-eicu_prep.gen_timeseriesresp()
-eicu_prep.gen_timeserieslab()
-eicu_prep.gen_timeseriesnurse()
-eicu_prep.gen_timeseriesaperiodic()
-eicu_prep.gen_timeseriesperiodic()
+if __name__ == '__main__':
+    runner = ExtractionRunner(eicuPreparator, **preparator_kwargs)
+    runner.run()
@@ -4,17 +4,23 @@ This code extracts the data from the Amsterdam dataset
 
 It creates a set of .parquet files at the specified path 
 ('hirid' in paths.json). 
+The extraction steps are run by N_WORKERS processes (config.json).
 """
 from hirid_preprocessing.HiridPreparator import hiridPreparator
+from database_processing.extractionrunner import ExtractionRunner
 
-hirid_prep = hiridPreparator(
+preparator_kwargs = dict(
     variable_ref_path='hirid_variable_reference_v1.csv',
     raw_ts_path='raw_stage/observation_tables_parquet.tar.gz',
     raw_pharma_path='raw_stage/pharma_records_parquet.tar.gz',
     admissions_path='reference_data.tar.gz',
-    imputedstage_path='imputed_stage/imputed_stage_parquet.tar.gz',
-    untar=True)
+    imputedstage_path='imputed_stage/imputed_stage_parquet.tar.gz')
 
-hirid_prep.gen_labels()
-hirid_prep.gen_medication()
-hirid_prep.gen_timeseries()
+if __name__ == '__main__':
+    # untarring is done once, before the extraction steps are dispatched.
+    hiridPreparator(**preparator_kwargs, untar=True)
+
+    runner = ExtractionRunner(hiridPreparator,
+                              untar=False,
+                              **preparator_kwargs)
+    runner.run()
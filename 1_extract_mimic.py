@@ -4,18 +4,15 @@ This code extracts the data from the MIMIC-IV dataset
 
 It creates a set of .parquet files at the specified path 
 ('mimic' in paths.json). 
+The extraction steps are run by N_WORKERS processes (config.json).
 """
 from mimic_preprocessing.mimicpreparator import mimicPreparator
+from database_processing.extractionrunner import ExtractionRunner
 
-mimic_prep = mimicPreparator(
-    chartevents_pth='/icu/chartevents.csv.gz',                         
+preparator_kwargs = dict(
+    chartevents_pth='/icu/chartevents.csv.gz',
     labevents_pth='/hosp/labevents.csv.gz')
 
-mimic_prep.load_raw_tables()
-
-mimic_prep.gen_labels()
-mimic_prep.gen_flat()
-mimic_prep.gen_medication()
-mimic_prep.gen_timeseriesoutputs()
-mimic_prep.gen_timeserieslab()
-mimic_prep.gen_timeseries()
+if __name__ == '__main__':
+    runner = ExtractionRunner(mimicPreparator, **preparator_kwargs)
+    runner.run()
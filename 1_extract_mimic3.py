@@ -4,17 +4,14 @@ This code extracts the data from the MIMIC-IV dataset
 
 It creates a set of .parquet files at the specified path 
 ('mimic' in paths.json). 
+The extraction steps are run by N_WORKERS processes (config.json).
 """
 from mimic3_preprocessing.mimic3preparator import mimic3Preparator
+from database_processing.extractionrunner import ExtractionRunner
 
+preparator_kwargs = dict(
+    chartevents_pth='CHARTEVENTS.csv.gz')
 
-mimic3_prep = mimic3Preparator(chartevents_pth='CHARTEVENTS.csv.gz')
-
-mimic3_prep.load_raw_tables()
-
-mimic3_prep.gen_labels()
-mimic3_prep.gen_flat()
-mimic3_prep.gen_medication()
-mimic3_prep.gen_timeseriesoutputs()
-mimic3_prep.gen_timeserieslab()
-mimic3_prep.gen_timeseries()
+if __name__ == '__main__':
+    runner = ExtractionRunner(mimic3Preparator, **preparator_kwargs)
+    runner.run()
@@ -3,17 +3,19 @@ This script lauches the timeseriesprocessing (tsp) and the flat and labels
 processing (flp) for the amsterdam database. 
 Note that this produces the 'raw' data of the BlendedICU dataset.
 The preprocessed BlendedICU dataset will then be obtained with 3_blendedICU.py
+The patient chunks are processed by N_WORKERS processes (config.json).
 """
 from amsterdam_preprocessing.timeseries import amsterdamTSP
 from amsterdam_preprocessing.flat_and_labels import Ams_FLProcessor
 
-tsp = amsterdamTSP(
-    ts_chunks='numericitems_1000_patient_chunks/',
-    listitems_pth='listitems.parquet',
-    gcs_scores_pth='glasgow_coma_scores.parquet')
+if __name__ == '__main__':
+    tsp = amsterdamTSP(
+        ts_chunks='numericitems_1000_patient_chunks/',
+        listitems_pth='listitems.parquet',
+        gcs_scores_pth='glasgow_coma_scores.parquet')
 
-tsp.run()
+    tsp.run()
 
-flp = Ams_FLProcessor()
+    flp = Ams_FLProcessor()
 
-flp.run_labels()
+    flp.run_labels()
@@ -3,20 +3,22 @@ This script lauches the timeseriesprocessing (tsp) and the flat and labels
 processing (flp) for the eicu database. 
 Note that this produces the 'raw' data of the BlendedICU dataset.
 The preprocessed BlendedICU dataset will then be obtained with 3_blendedICU.py
+The patient chunks are processed by N_WORKERS processes (config.json).
 """
 from eicu_preprocessing.flat_and_labels import eicu_FLProcessor
 from eicu_preprocessing.timeseries import eicuTSP
 
-tsp = eicuTSP(
-    lab_pth='tslab_1000_patient_chunks/',
-    resp_pth='tsresp_1000_patient_chunks/',
-    nurse_pth='tsnurse_1000_patient_chunks/',
-    aperiodic_pth='tsperiodic_1000_patient_chunks/',
-    periodic_pth='tsaperiodic_1000_patient_chunks/',
-    inout_pth='tsintakeoutput_1000_patient_chunks/')
+if __name__ == '__main__':
+    tsp = eicuTSP(
+        lab_pth='tslab_1000_patient_chunks/',
+        resp_pth='tsresp_1000_patient_chunks/',
+        nurse_pth='tsnurse_1000_patient_chunks/',
+        aperiodic_pth='tsperiodic_1000_patient_chunks/',
+        periodic_pth='tsaperiodic_1000_patient_chunks/',
+        inout_pth='tsintakeoutput_1000_patient_chunks/')
 
-tsp.run()
+    tsp.run()
 
-flp = eicu_FLProcessor()
+    flp = eicu_FLProcessor()
 
-flp.run_labels()
+    flp.run_labels()
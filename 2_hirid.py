@@ -3,16 +3,18 @@ This script lauches the timeseriesprocessing (tsp) and the flat and labels
 processing (flp) for the hirid database. 
 Note that this produces the 'raw' data of the BlendedICU dataset.
 The preprocessed BlendedICU dataset will then be obtained with 3_blendedICU.py
+The patient chunks are processed by N_WORKERS processes (config.json).
 """
 from hirid_preprocessing.flat_and_labels import Hir_FLProcessing
 from hirid_preprocessing.timeseries import hiridTSP
 
-tsp = hiridTSP(
-    ts_chunks='timeseries_1000_patient_chunks/',
-    pharma_chunks='pharma_1000_patient_chunks/')
+if __name__ == '__main__':
+    tsp = hiridTSP(
+        ts_chunks='timeseries_1000_patient_chunks/',
+        pharma_chunks='pharma_1000_patient_chunks/')
 
-tsp.run()
+    tsp.run()
 
-flp = Hir_FLProcessing()
+    flp = Hir_FLProcessing()
 
-flp.run_labels()
+    flp.run_labels()
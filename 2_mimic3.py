@@ -3,18 +3,20 @@ This script lauches the timeseriesprocessing (tsp) and the flat and labels
 processing (flp) for the mimic database. 
 Note that this produces the 'raw' data of the BlendedICU dataset.
 The preprocessed BlendedICU dataset will then be obtained with 3_blendedICU.py
+The patient chunks are processed by N_WORKERS processes (config.json).
 """
 from mimic3_preprocessing.flat_and_labels import mimic3_FLProcessor
 from mimic3_preprocessing.timeseries import mimic3TSP
 
-tsp = mimic3TSP(
-    med_pth='medication.parquet',
-    ts_pth='timeseries.parquet',
-    tslab_pth='timeserieslab.parquet',
-    outputevents_pth='timeseriesoutputs.parquet')
+if __name__ == '__main__':
+    tsp = mimic3TSP(
+        med_pth='medication.parquet',
+        ts_pth='timeseries.parquet',
+        tslab_pth='timeserieslab.parquet',
+        outputevents_pth='timeseriesoutputs.parquet')
 
-tsp.run()
+    tsp.run()
 
-flp = mimic3_FLProcessor()
+    flp = mimic3_FLProcessor()
 
-flp.run_labels()
+    flp.run_labels()
@@ -5,16 +5,21 @@ variables require a lot of time.
 
 To reduce the memory overhead, the timeseries data is once again processed by 
 chunks. We provide the option to generate a csv dataset, however this is 
-inconvenient due to the size of the data. 
+inconvenient due to the size of the data. With OMOP_CSV in config.json, the
+parquet chunks of the measurement and drug_exposure tables are streamed to
+csv files, optionally compressed, without loading the tables in memory.
 The preffered way is to output .parquet dataset, written using the OMOP 
 specifications.
 """
 from blended_preprocessing.omop_conversion import OMOP_converter
 
-self = OMOP_converter(initialize_tables=True)
+if __name__ == '__main__':
+    # the chunks are written by a process pool, which re-imports this script
+    # when the processes are spawned.
+    self = OMOP_converter(initialize_tables=True)
 
-self.measurement_table(start_chunk=0)
+    self.measurement_table(start_chunk=0)
 
-self.drug_exposure_table(start_chunk=0)
+    self.drug_exposure_table(start_chunk=0)
 
-self.export_tables()
+    self.export_tables(chunked_csv=self.OMOP_CSV)
@@ -2,9 +2,19 @@ import pandas as pd
 
 from database_processing.medicationprocessor import MedicationProcessor
 from database_processing.datapreparator import DataPreparator
+from utils.memory_utils import format_peak_rss
 
 
 class AmsterdamPreparator(DataPreparator):
+    extraction_steps = {'build_source_cache': [],
+                        'gen_labels': [],
+                        'gen_medication': ['gen_labels'],
+                        'gen_listitems_timeseries': ['gen_labels'],
+                        'gen_num_timeseries': ['gen_labels',
+                                               'build_source_cache']}
+    source_tables = {'numericitems_pth': 'admissionid'}
+    source_encoding = 'ISO-8859-1'
+
     def __init__(self,
                  admission_pth,
                  drugitems_pth,
@@ -19,6 +29,13 @@ class AmsterdamPreparator(DataPreparator):
         self.ts_savepath = f'{self.parquet_pth}/numericitems_{self.n_patient_chunk}_patient_chunks/'
         self.listitems_savepath = f'{self.parquet_pth}/listitems.parquet'
         self.gcs_savepath = f'{self.parquet_pth}/glasgow_coma_scores.parquet'
+        self.step_outputs = {
+            'gen_labels': [self.labels_savepath],
+            'gen_medication': [self.med_savepath],
+            'gen_listitems_timeseries': [self.gcs_savepath,
+                                         self.listitems_savepath],
+            'gen_num_timeseries': [self.ts_savepath],
+            }
         self.col_los = 'lengthofstay'
         self.unit_los = 'hour'
 
@@ -49,7 +66,7 @@ class AmsterdamPreparator(DataPreparator):
                                       unit_los='hour')
 
         self.med = self.mp.run(drugitems)
-        return self.save(self.med, self.med_savepath)
+        return self.save(self.med, self.med_savepath, sort_by='admissionid')
 
     def gen_listitems_timeseries(self):
         """
@@ -77,7 +94,7 @@ class AmsterdamPreparator(DataPreparator):
         df_gcs = self._compute_gcs(listitems)
         listitems = listitems.drop(columns=['valueid', 'itemid'])
         self.save(df_gcs, self.gcs_savepath)
-        self.save(listitems, self.listitems_savepath)
+        self.save(listitems, self.listitems_savepath, sort_by='admissionid')
 
     def _compute_gcs(self, df):
         """
@@ -116,6 +133,26 @@ class AmsterdamPreparator(DataPreparator):
         return df_gcs.reset_index()
 
 
+    def _flush_patient_chunks(self, pending, final=False):
+        """
+        pending is a list of prepared numericitems pieces, sorted by
+        admissionid and containing complete patients only. Groups of
+        n_patient_chunk patients are saved with save_chunk. The rows of the
+        patients that do not fill a whole chunk are returned, unless final is
+        True, in which case they are saved as the last chunk.
+        """
+        df = pd.concat(pending)
+        ids = df.admissionid.values
+        first_patients = pd.unique(ids)[::self.n_patient_chunk]
+        stops = [*ids.searchsorted(first_patients[1:])]
+        if final:
+            stops.append(len(df))
+        start = 0
+        for stop in stops:
+            self.save_chunk(df.iloc[start:stop], self.ts_savepath)
+            start = stop
+        return df.iloc[start:]
+
     def gen_num_timeseries(self):
         """
         The numericitems table does not fit in memory on most machines. 
@@ -126,33 +163,49 @@ class AmsterdamPreparator(DataPreparator):
                                                     is 1000)
              a chunk of patient is saved to a parquet file.
         It is possible to process in this way because the patients in the 
-        numericitems table are ordered.
+        numericitems table are ordered: only the last patient of a csv chunk
+        may continue in the next one, so it is the only one carried over.
+        Memory usage is therefore bounded by the csv chunksize and
+        n_patient_chunk, and does not grow with the size of the table.
         """
         print('numericitems ts...')
+        self.reset_chunk_idx()
         self.get_labels()
 
-        df_chunks = pd.read_csv(self.numericitems_pth,
-                                compression='gzip',
-                                encoding='ISO-8859-1',
-                                chunksize=self.chunksize,
-                                usecols=['admissionid',
-                                         'item',
-                                         'value',
-                                         'measuredat'])
+        df_chunks = self.read_table(self.numericitems_pth,
+                                    chunk_rows=self.chunksize,
+                                    columns=['admissionid',
+                                             'item',
+                                             'value',
+                                             'measuredat'])
 
-        df = pd.DataFrame()
+        trailing = pd.DataFrame()
+        pending = []
+        n_pending = 0
         for chunk in df_chunks:
+            last_patient = chunk.admissionid.iloc[-1]
             chunk = self.prepare_tstable(chunk,
                                          col_offset='measuredat',
                                          col_variable='item',
                                          unit_offset='milisecond')
-
-            df = pd.concat([df, chunk])
-            patients = df.admissionid.unique()
-            while len(patients) > self.n_patient_chunk:
-                patient_chunk = patients[:self.n_patient_chunk]
-                save_idx = df.admissionid.isin(patient_chunk)
-
-                self.save_chunk(df.loc[save_idx], self.ts_savepath)
-                df = df.loc[~save_idx]
-                patients = df.admissionid.unique()
+            if not trailing.empty:
+                chunk = pd.concat([trailing, chunk])
+
+            is_trailing = (chunk.admissionid == last_patient).values
+            trailing = chunk.loc[is_trailing]
+            finished = chunk.loc[~is_trailing]
+            if finished.empty:
+                continue
+
+            pending.append(finished)
+            n_pending += finished.admissionid.nunique()
+            if n_pending >= self.n_patient_chunk:
+                remainder = self._flush_patient_chunks(pending)
+                pending = [remainder]
+                n_pending = remainder.admissionid.nunique()
+            print(f'   {format_peak_rss()}')
+
+        pending.append(trailing)
+        if any(len(df) for df in pending):
+            self._flush_patient_chunks(pending, final=True)
+        print(f'   {format_peak_rss()}')
@@ -1,5 +1,6 @@
 import pandas as pd
 
+from database_processing.stagecache import cached_stage
 from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
 
 
@@ -10,17 +11,20 @@ class amsterdamTSP(TimeseriesPreprocessing):
     * 1 wide table: the gcs_score tables that was computed in 1_amsterdam.py
     * 1 medication table that was computed in 1_amsterdam.py
     """
-    def __init__(self, ts_chunks, listitems_pth, gcs_scores_pth):
-        super().__init__(dataset='amsterdam')
+    def __init__(self,
+                 ts_chunks,
+                 listitems_pth,
+                 gcs_scores_pth,
+                 n_workers=None):
+        super().__init__(dataset='amsterdam', n_workers=n_workers)
         self.ts_chunks = self.ls(self.parquet_pth+ts_chunks)
-        self.listitems = self.load(self.parquet_pth+listitems_pth)
-        self.medication = self.load(self.med_savepath,
-                                    columns=['admissionid',
-                                             'label',
-                                             'original_drugname',
-                                             'start',
-                                             'end',
-                                             'value'])
+        self.listitems_pth = self.parquet_pth+listitems_pth
+        self.med_cols = ['admissionid',
+                         'label',
+                         'original_drugname',
+                         'start',
+                         'end',
+                         'value']
         self.gcs_scores = self.load(self.parquet_pth+gcs_scores_pth)
         
         self.colnames_med = {
@@ -43,34 +47,46 @@ class amsterdamTSP(TimeseriesPreprocessing):
 
         self.gcs_scores = self.filter_tables(self.gcs_scores,
                                              **self.colnames_gcs)
+        self.gcs_scores = self.index_patients(self.gcs_scores)
 
-    def _get_chunk(self, table, chunk_idx):
-        return table.loc[table.admissionid.isin(chunk_idx)]
+    def _get_chunk(self, pth, chunk_idx, columns=None):
+        """
+        The listitems and medication tables are sorted by admissionid, only
+        the row groups of the patients of the chunk are read.
+        """
+        return self.load(pth,
+                         verbose=False,
+                         columns=columns,
+                         filters=[('admissionid', 'in', chunk_idx)])
     
-    def run(self):
-        self.reset_dir()
-        for i, data_pth in enumerate(self.ts_chunks):
+    def _chunk_inputs(self):
+        for data_pth in self.ts_chunks:
             numericitems_chunk = self.load(data_pth, columns=self.tscols)
 
             chunk_ids = numericitems_chunk.admissionid.unique()
 
-            listitems_chunk = self._get_chunk(self.listitems, chunk_ids)
-            medication_chunk = self._get_chunk(self.medication, chunk_ids)
+            listitems_chunk = self._get_chunk(self.listitems_pth, chunk_ids)
+            medication_chunk = self._get_chunk(self.med_savepath,
+                                               chunk_ids,
+                                               columns=self.med_cols)
             
             timeseries_chunk = pd.concat([numericitems_chunk, listitems_chunk])
 
-            self.ts_table = self.filter_tables(timeseries_chunk,
-                                               self.kept_ts,
-                                               **self.colnames_ts)
+            ts_table = self.filter_tables(timeseries_chunk,
+                                          self.kept_ts,
+                                          **self.colnames_ts)
+
+            med_table = self.filter_tables(medication_chunk,
+                                           self.kept_med,
+                                           **self.colnames_med)
 
-            self.med_table = self.filter_tables(medication_chunk,
-                                                self.kept_med,
-                                                **self.colnames_med)
+            gcs_scores_chunk = self.gcs_scores.get(ts_table.patient.unique())
 
-            gcs_scores_chunk_idx = self.gcs_scores.patient.isin(self.ts_table.patient)
-            self.gcs_scores_chunk = self.gcs_scores.loc[gcs_scores_chunk_idx]
+            yield {'ts_ver': ts_table,
+                   'ts_hor': gcs_scores_chunk,
+                   'med': med_table}
 
-            self.process_tables(ts_ver=self.ts_table,
-                                ts_hor=self.gcs_scores_chunk,
-                                med=self.med_table,
-                                stop_at_first_chunk=False)
+    @cached_stage
+    def run(self):
+        self.reset_dir()
+        self.process_chunks(self._chunk_inputs())
@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of the long to wide conversion of TimeseriesPreprocessing.
+
+The current _extract_variables is compared to the previous implementation,
+which filtered and aggregated the long-format table once per variable, on
+a synthetic chunk of 1000 patients and 45 variables.
+The outputs are checked to be identical.
+
+Run from the root of the repository:
+    python benchmarks/extract_variables_benchmark.py
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from resampling_benchmark import make_processor
+
+
+def legacy_extract_variables(self, ts_ver, kept_variables):
+    series = []
+    for var in kept_variables:
+        df = (ts_ver.loc[ts_ver['variable'] == var, 'value']
+              .groupby(level=[0, 1])
+              .agg(self.aggregates.loc[var])
+              .rename(var))
+        series.append(df)
+    return pd.concat(series, axis=1)
+
+
+def synthetic_ts_ver(n_patients=1000, n_variables=45, n_rows=2_000_000,
+                     seed=0):
+    """
+    Long-format chunk with integer times in seconds, some variables are
+    measured several times at the same time.
+    """
+    rng = np.random.default_rng(seed)
+    patients = np.array([f'synthetic-{i}' for i in range(n_patients)])
+    variables = np.array([f'variable_{i}' for i in range(n_variables)])
+    ts_ver = pd.DataFrame({
+        'patient': patients[rng.integers(0, n_patients, n_rows)],
+        'time': rng.integers(0, 14*24*60, n_rows)*60,
+        'variable': variables[rng.integers(0, n_variables, n_rows)],
+        'value': rng.normal(0, 1, n_rows),
+        })
+    aggregates = pd.Series(rng.choice(['mean', 'last', 'max'], n_variables),
+                           index=variables)
+    return ts_ver.set_index(['patient', 'time']), aggregates
+
+
+if __name__ == '__main__':
+    ts_ver, aggregates = synthetic_ts_ver()
+    tsp = make_processor(aggregates)
+    tsp.aggregates = aggregates
+    kept_variables = aggregates.index
+
+    legacy = legacy_extract_variables(tsp, ts_ver, kept_variables)
+    current = tsp._extract_variables(ts_ver, kept_variables)
+    pd.testing.assert_frame_equal(legacy.sort_index(), current.sort_index())
+    print(f'{len(ts_ver)} rows, outputs are identical.')
+
+    for name, func in [('legacy', legacy_extract_variables),
+                       ('current', type(tsp)._extract_variables)]:
+        durations = timeit.repeat(lambda: func(tsp, ts_ver, kept_variables),
+                                  number=1,
+                                  repeat=3)
+        print(f'{name:>8}: {min(durations):.3f} s')
@@ -0,0 +1,59 @@
+"""
+Micro-benchmark of the decaying measurement mask of TimeseriesPreprocessing.
+
+The current _mask is compared to the previous implementation, which 
+applied the decay function to each patient with groupby().apply, on the 
+resampled synthetic chunk of resampling_benchmark.py.
+The outputs are checked to be identical.
+
+Run from the root of the repository:
+    python benchmarks/mask_benchmark.py
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from resampling_benchmark import make_processor, run_current, synthetic_chunk
+
+
+def legacy_apply_mask_decay(mask_bool, decay_rate=4/3):
+    mask = mask_bool.astype(int).replace({0: np.nan})
+    inv_mask_bool = ~mask_bool
+    count_non_measurements = inv_mask_bool.cumsum() \
+        - inv_mask_bool.cumsum().where(mask_bool).ffill().fillna(0)
+    decay_mask = (mask.ffill().fillna(0)
+                  / (count_non_measurements * decay_rate).replace(0, 1))
+    return decay_mask
+
+
+def legacy_mask(data):
+    mask = (data.notna()
+                .groupby('patient')
+                .apply(legacy_apply_mask_decay)
+                .add_suffix('_mask')
+                .droplevel(0))
+    return pd.concat([data, mask], axis=1)
+
+
+if __name__ == '__main__':
+    timeseries, aggregates = synthetic_chunk()
+    tsp = make_processor(aggregates)
+    tsp.TS_MASK_FORMAT = 'decay'
+    resampled = run_current(tsp, timeseries)
+
+    pd.testing.assert_frame_equal(legacy_mask(resampled),
+                                  tsp._mask(resampled))
+    print(f'{len(resampled)} hourly bins, outputs are identical.')
+
+    for name, func in [('legacy', legacy_mask), ('current', tsp._mask)]:
+        durations = timeit.repeat(lambda: func(resampled),
+                                  number=1,
+                                  repeat=3)
+        print(f'{name:>8}: {min(durations):.3f} s')
+
+    mask_cols = resampled.columns + '_mask'
+    for mask_format in ['decay', 'hours']:
+        tsp.TS_MASK_FORMAT = mask_format
+        nbytes = tsp._mask(resampled)[mask_cols].memory_usage(index=False).sum()
+        print(f'{mask_format:>8} mask: {nbytes/1e6:.1f} MB')
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the drug exposure mask of TimeseriesPreprocessing.
+
+The current _make_med_mask is compared to the previous implementation,
+which resampled the starts and the ends of the administrations separately
+and forward filled the exposures of each patient, on the hourly grid of the
+synthetic chunk of resampling_benchmark.py.
+The outputs are checked to be identical on administrations that do not
+overlap, the previous implementation stopped the exposure at the first end
+of overlapping administrations of a drug.
+
+Run from the root of the repository:
+    python benchmarks/med_mask_benchmark.py
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from resampling_benchmark import make_processor, synthetic_chunk
+
+
+def legacy_make_med_mask(self, med):
+    med_starts = med.set_index(['patient', 'start'])
+    med_ends = med.set_index(['patient', 'end'])
+    med_ends_resampled = (med_ends.pipe(self._extract_variables,
+                                        kept_variables=self.kept_med)
+                          .rename_axis([self.idx_col, self.time_col])
+                          .pipe(self._resampling)
+                          .multiply(0))
+
+    med_starts_resampled = (med_starts.pipe(self._extract_variables,
+                                            kept_variables=self.kept_med)
+                            .rename_axis([self.idx_col, self.time_col])
+                            .pipe(self._resampling))
+
+    return (pd.concat([med_starts_resampled, med_ends_resampled])
+            .groupby(level=[0, 1]).max()
+            .groupby(level=0).ffill().fillna(0))
+
+
+def synthetic_med(patients, kept_med, n_administrations=5, seed=0):
+    """
+    Administrations of each drug to each patient, in seconds. They last at
+    least an hour and do not start before the hourly bin in which the
+    previous administration of the same drug ended.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(patients)*len(kept_med)*n_administrations
+    shape = (len(patients)*len(kept_med), n_administrations)
+    gaps = rng.integers(0, 48, shape)
+    durations = rng.integers(1, 24, shape)
+    ends = (gaps + durations).cumsum(axis=1)
+    starts = ends - durations
+    return pd.DataFrame({
+        'patient': np.repeat(patients, len(kept_med)*n_administrations),
+        'variable': np.tile(np.repeat(kept_med, n_administrations),
+                            len(patients)),
+        'start': starts.ravel()*3600 + rng.random(n)*3599,
+        'end': ends.ravel()*3600 + rng.random(n)*3599,
+        'value': 1})
+
+
+if __name__ == '__main__':
+    timeseries, aggregates = synthetic_chunk()
+    kept_med = ['heparin', 'propofol', 'norepinephrine', 'insulin']
+    tsp = make_processor(pd.concat([aggregates,
+                                    pd.Series('last', index=kept_med)]))
+    tsp.aggregates = tsp.aggregates_blended
+    tsp.kept_med = kept_med
+    tsp.idx_col = 'patient'
+    tsp._build_index(timeseries, cols_index=['patient', 'time'])
+
+    med = synthetic_med(tsp.last_sample.index.values, kept_med)
+
+    pd.testing.assert_frame_equal(legacy_make_med_mask(tsp, med),
+                                  tsp._make_med_mask(med))
+    print(f'{len(med)} administrations, outputs are identical.')
+
+    for name, func in [('legacy', legacy_make_med_mask),
+                       ('current', type(tsp)._make_med_mask)]:
+        durations = timeit.repeat(lambda: func(tsp, med),
+                                  number=1,
+                                  repeat=3)
+        print(f'{name:>8}: {min(durations):.3f} s')
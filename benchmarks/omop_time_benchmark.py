@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the datetime conversions of the OMOP tables.
+
+The functions of utils/time_utils.py are compared to the previous
+implementations, which built a timedelta, Timestamp or datetime.time object
+per element: the visit end datetimes from the lengths of stay in days, the
+drug exposure datetimes from offsets in seconds and their time of day.
+The outputs are checked to be identical.
+
+Run from the root of the repository:
+    python benchmarks/omop_time_benchmark.py
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils.time_utils import offsets_to_datetimes, times_of_day
+
+REF_DATE = datetime(year=2023, month=1, day=1)
+
+
+def legacy_visit_end(lengthofstay):
+    return REF_DATE + lengthofstay.apply(timedelta)
+
+
+def legacy_drug_start(start):
+    return REF_DATE + start.apply(pd.Timedelta, unit='second')
+
+
+def legacy_time_of_day(datetimes):
+    return datetimes.dt.time
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(974)
+    n_stays = 400_000
+    n_drugs = 1_000_000
+    lengthofstay = pd.Series(rng.exponential(3, n_stays))
+    start = pd.Series(rng.uniform(-86_400, 30*86_400, n_drugs).round(3))
+    start[rng.choice(n_drugs, 1000, replace=False)] = np.nan
+    drug_start = offsets_to_datetimes(REF_DATE, start, unit='s')
+
+    pd.testing.assert_series_equal(legacy_visit_end(lengthofstay),
+                                   offsets_to_datetimes(REF_DATE, lengthofstay, unit='D'))
+    pd.testing.assert_series_equal(legacy_drug_start(start), drug_start)
+    legacy_times = legacy_time_of_day(drug_start)
+    current_times = times_of_day(drug_start).astype(object)
+    assert (legacy_times.isna() == current_times.isna()).all()
+    assert (legacy_times.dropna() == current_times.dropna()).all()
+    print(f'{n_stays} lengths of stay, {n_drugs} drug offsets, '
+          'outputs are identical.')
+
+    benchmarks = [
+        ('visit end', lengthofstay,
+         legacy_visit_end,
+         lambda x: offsets_to_datetimes(REF_DATE, x, unit='D')),
+        ('drug start', start,
+         legacy_drug_start,
+         lambda x: offsets_to_datetimes(REF_DATE, x, unit='s')),
+        ('time of day', drug_start,
+         legacy_time_of_day,
+         times_of_day),
+    ]
+    for label, data, legacy, current in benchmarks:
+        for name, func in [('legacy', legacy), ('current', current)]:
+            durations = timeit.repeat(lambda: func(data),
+                                      number=1,
+                                      repeat=3)
+            print(f'{label:>12} {name:>8}: {min(durations):.3f} s')
@@ -0,0 +1,396 @@
+"""
+Benchmark of the stages of the pipeline on synthetic source databases.
+
+The source databases are generated by synthetic_sources.py, then every stage
+of the 1_extract_*.py, 2_*.py, 3_blendedICU.py and 4_write_omop.py scripts
+is run in a fresh process, in the order of the pipeline:
+    <dataset>.<step>: the extraction steps of the preparators, eg.
+        eicu.gen_labels, eicu.gen_timeserieslab...
+    <dataset>.timeseries, <dataset>.labels: the TSP and the FLProcessor of
+        the harmonization step,
+    blended.flat_and_labels, blended.timeseries,
+    omop.tables, omop.measurement, omop.drug_exposure.
+The blended and omop stages are only run when all the databases are
+generated. For each stage, the report records the wall time, the CPU time
+(including the worker processes), the peak RSS, the rows and bytes written
+to the processed directories and the rows written per second. The
+construction of the processing objects is timed separately as setup_time.
+
+Two reports are compared with the compare command, which lists the stages
+whose wall time, CPU time or peak RSS increased by more than the threshold
+and exits with status 1 if there are any.
+
+Run from the root of the repository:
+    python benchmarks/pipeline_benchmark.py run ROOT --patients 1000
+    python benchmarks/pipeline_benchmark.py compare baseline.json report.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+import pyarrow.parquet as pq
+
+from synthetic_sources import DATASETS, REPO_PTH, SyntheticSources
+
+sys.path.insert(0, str(REPO_PTH))
+
+from utils.memory_utils import peak_rss
+
+PREPARATORS = {
+    'eicu': ('eicu_preprocessing.eicupreparator', 'eicuPreparator'),
+    'mimic': ('mimic_preprocessing.mimicpreparator', 'mimicPreparator'),
+    'mimic3': ('mimic3_preprocessing.mimic3preparator', 'mimic3Preparator'),
+    'amsterdam': ('amsterdam_preprocessing.AmsterdamPreparator',
+                  'AmsterdamPreparator'),
+    'hirid': ('hirid_preprocessing.HiridPreparator', 'hiridPreparator'),
+    }
+
+# arguments of the TSPs in the 2_*.py scripts.
+TSPS = {
+    'eicu': ('eicu_preprocessing.timeseries', 'eicuTSP',
+             dict(lab_pth='tslab_1000_patient_chunks/',
+                  resp_pth='tsresp_1000_patient_chunks/',
+                  nurse_pth='tsnurse_1000_patient_chunks/',
+                  aperiodic_pth='tsperiodic_1000_patient_chunks/',
+                  periodic_pth='tsaperiodic_1000_patient_chunks/',
+                  inout_pth='tsintakeoutput_1000_patient_chunks/')),
+    'mimic': ('mimic_preprocessing.timeseries', 'mimicTSP',
+              dict(med_pth='medication.parquet',
+                   ts_pth='timeseries.parquet',
+                   tslab_pth='timeserieslab.parquet',
+                   outputevents_pth='timeseriesoutputs.parquet')),
+    'mimic3': ('mimic3_preprocessing.timeseries', 'mimic3TSP',
+               dict(med_pth='medication.parquet',
+                    ts_pth='timeseries.parquet',
+                    tslab_pth='timeserieslab.parquet',
+                    outputevents_pth='timeseriesoutputs.parquet')),
+    'amsterdam': ('amsterdam_preprocessing.timeseries', 'amsterdamTSP',
+                  dict(ts_chunks='numericitems_1000_patient_chunks/',
+                       listitems_pth='listitems.parquet',
+                       gcs_scores_pth='glasgow_coma_scores.parquet')),
+    'hirid': ('hirid_preprocessing.timeseries', 'hiridTSP',
+              dict(ts_chunks='timeseries_1000_patient_chunks/',
+                   pharma_chunks='pharma_1000_patient_chunks/')),
+    }
+
+FLPS = {
+    'eicu': ('eicu_preprocessing.flat_and_labels', 'eicu_FLProcessor'),
+    'mimic': ('mimic_preprocessing.flat_and_labels', 'mimic_FLProcessor'),
+    'mimic3': ('mimic3_preprocessing.flat_and_labels', 'mimic3_FLProcessor'),
+    'amsterdam': ('amsterdam_preprocessing.flat_and_labels',
+                  'Ams_FLProcessor'),
+    'hirid': ('hirid_preprocessing.flat_and_labels', 'Hir_FLProcessing'),
+    }
+
+COMPARED_METRICS = ['wall_time', 'cpu_time', 'peak_rss']
+
+
+def _import(module, name):
+    return getattr(importlib.import_module(module), name)
+
+
+def _build(module, name, **kwargs):
+    return _import(module, name)(**kwargs)
+
+
+def _preparator(dataset):
+    kwargs = importlib.import_module(f'1_extract_{dataset}').preparator_kwargs
+    if dataset == 'hirid':
+        # the synthetic hirid sources are not tarred.
+        kwargs = kwargs | {'untar': False}
+    return _build(*PREPARATORS[dataset], **kwargs)
+
+
+def _extraction_order(steps):
+    order = []
+    while len(order) < len(steps):
+        order += [step for step, dependencies in steps.items()
+                  if step not in order and set(dependencies) <= set(order)][:1]
+    return order
+
+
+def pipeline_stages(datasets=DATASETS):
+    """
+    Stages of the pipeline, in order. Each stage is a (setup, run) pair,
+    setup builds the processing object and run(obj) runs the stage.
+    The processing objects are imported lazily, some modules read files
+    relatively to the working directory when they are imported.
+    """
+    stages = {}
+    for dataset in datasets:
+        steps = _import(*PREPARATORS[dataset]).extraction_steps
+        for step in _extraction_order(steps):
+            stages[f'{dataset}.{step}'] = (partial(_preparator, dataset),
+                                           lambda obj, step=step: getattr(obj, step)())
+
+        module, name, kwargs = TSPS[dataset]
+        stages[f'{dataset}.timeseries'] = (partial(_build, module, name, **kwargs),
+                                           lambda obj: obj.run())
+        stages[f'{dataset}.labels'] = (partial(_build, *FLPS[dataset]),
+                                       lambda obj: obj.run_labels())
+
+    if set(datasets) != set(DATASETS):
+        return stages
+
+    omop = partial(_build, 'blended_preprocessing.omop_conversion',
+                   'OMOP_converter', initialize_tables=True)
+    stages |= {
+        'blended.flat_and_labels': (partial(_build,
+                                            'blended_preprocessing.flat_and_labels',
+                                            'blended_FLProcessor',
+                                            datasets=[*DATASETS]),
+                                    lambda obj: obj.run_flat_and_labels()),
+        'blended.timeseries': (partial(_build,
+                                       'blended_preprocessing.timeseries',
+                                       'blendedicuTSP'),
+                               lambda obj: obj.run()),
+        'omop.tables': (omop, lambda obj: obj.export_tables()),
+        'omop.measurement': (omop, lambda obj: obj.measurement_table()),
+        'omop.drug_exposure': (omop, lambda obj: obj.drug_exposure_table()),
+        }
+    return stages
+
+
+def _cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def run_stage(name, datasets):
+    """
+    Runs a stage in the current process, which should be a fresh process
+    whose working directory is the root of the synthetic run.
+    """
+    setup, run = pipeline_stages(datasets)[name]
+    start = time.perf_counter()
+    obj = setup()
+    setup_time = time.perf_counter() - start
+
+    start, start_cpu = time.perf_counter(), _cpu_time()
+    run(obj)
+    wall_time = time.perf_counter() - start
+    cpu_time = _cpu_time() - start_cpu
+
+    rss = [r for r in (peak_rss(), peak_rss(children=True)) if r is not None]
+    return {'setup_time': setup_time,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'peak_rss': max(rss, default=None)}
+
+
+def _snapshot(pth):
+    return {p: (p.stat().st_size, p.stat().st_mtime_ns)
+            for p in pth.rglob('*') if p.is_file()}
+
+
+def _written(before, after):
+    """
+    Rows and bytes of the files created or modified between two snapshots.
+    Rows are only counted for parquet files.
+    """
+    written = [p for p, stat in after.items() if before.get(p) != stat]
+    rows = sum(pq.read_metadata(p).num_rows
+               for p in written if p.suffix == '.parquet')
+    return rows, sum(after[p][0] for p in written)
+
+
+class PipelineBenchmark:
+    """
+    root: directory of the synthetic run, the sources are generated in
+        ROOT/sources/ and the pipeline writes to ROOT/processed/.
+    datasets: source databases to generate and process.
+    reuse_sources: does not regenerate the sources when ROOT/paths.json
+        exists.
+    Other keyword arguments are passed to SyntheticSources.
+    """
+    def __init__(self,
+                 root,
+                 datasets=DATASETS,
+                 reuse_sources=False,
+                 **source_kwargs):
+        self.root = Path(root).resolve()
+        self.datasets = [*datasets]
+        self.reuse_sources = reuse_sources
+        self.source_kwargs = source_kwargs
+        self.log_pth = self.root/'benchmark_logs'
+
+    def generate_sources(self):
+        if self.reuse_sources and (self.root/'paths.json').exists():
+            print(f'Reusing the sources in {self.root}')
+            return
+        print(f'Generating the sources in {self.root}...')
+        SyntheticSources(self.root, **self.source_kwargs).run(self.datasets)
+
+    def _run_stage_process(self, name):
+        result_pth = self.log_pth/f'{name}.json'
+        with open(self.log_pth/f'{name}.log', 'w') as log:
+            process = subprocess.run([sys.executable,
+                                      Path(__file__).resolve(),
+                                      '_stage', name, str(result_pth),
+                                      '--datasets', *self.datasets],
+                                     cwd=self.root,
+                                     # answers yes when reset_dir asks to
+                                     # delete the previous outputs.
+                                     input='y\n'*100,
+                                     stdout=log,
+                                     stderr=subprocess.STDOUT,
+                                     text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f'Stage {name} failed, see '
+                               f'{self.log_pth}/{name}.log')
+        with open(result_pth) as file:
+            return json.load(file)
+
+    def run(self):
+        self.generate_sources()
+        processed_pth = self.root/'processed'
+        shutil.rmtree(processed_pth, ignore_errors=True)
+        processed_pth.mkdir()
+        self.log_pth.mkdir(exist_ok=True)
+
+        report = {'date': datetime.now().isoformat(timespec='seconds'),
+                  'commit': self._commit(),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'datasets': self.datasets,
+                  'sources': self.source_kwargs,
+                  'stages': {}}
+        for name in pipeline_stages(self.datasets):
+            before = _snapshot(processed_pth)
+            result = self._run_stage_process(name)
+            rows, n_bytes = _written(before, _snapshot(processed_pth))
+            result |= {'rows_written': rows,
+                       'bytes_written': n_bytes,
+                       'rows_per_s': rows/result['wall_time']}
+            report['stages'][name] = result
+            print(f'{name:>32}: {result["wall_time"]:8.2f} s wall, '
+                  f'{result["cpu_time"]:8.2f} s CPU, '
+                  f'{_format_bytes(result["peak_rss"])} peak RSS, '
+                  f'{rows:>10} rows')
+        return report
+
+    @staticmethod
+    def _commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                  cwd=REPO_PTH,
+                                  capture_output=True,
+                                  text=True).stdout.strip() or None
+        except OSError:
+            return None
+
+
+def _format_bytes(n):
+    return 'n/a' if n is None else f'{n/1024**2:.0f} MB'
+
+
+def compare(baseline, current, threshold=0.1, min_time=1.):
+    """
+    Returns the regressions of the current report with respect to the
+    baseline: the (stage, metric, baseline, current) of the metrics of
+    COMPARED_METRICS that increased by more than threshold. Times below
+    min_time seconds in both reports are not compared, they are dominated
+    by noise.
+    """
+    regressions = []
+    for name, stage in current['stages'].items():
+        if name not in baseline['stages']:
+            print(f'{name:>32}: not in the baseline')
+            continue
+        for metric in COMPARED_METRICS:
+            old = baseline['stages'][name][metric]
+            new = stage[metric]
+            if old is None or new is None or old == 0:
+                continue
+            if metric.endswith('_time') and max(old, new) < min_time:
+                continue
+            change = new/old - 1
+            flag = 'REGRESSION' if change > threshold else ''
+            fmt = _format_bytes if metric == 'peak_rss' else '{:.2f} s'.format
+            print(f'{name:>32} {metric:>10}: {fmt(old):>10} -> {fmt(new):>10} '
+                  f'({change:+7.1%}) {flag}')
+            if flag:
+                regressions.append((name, metric, old, new))
+        if stage['rows_written'] != baseline['stages'][name]['rows_written']:
+            print(f'{name:>32}: rows written changed from '
+                  f'{baseline["stages"][name]["rows_written"]} to '
+                  f'{stage["rows_written"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmarks the pipeline')
+    run_parser.add_argument('root')
+    run_parser.add_argument('--report', default=None,
+                            help='defaults to ROOT/benchmark_report.json')
+    run_parser.add_argument('--reuse-sources', action='store_true')
+    run_parser.add_argument('--datasets', nargs='+', default=DATASETS,
+                            choices=DATASETS)
+    run_parser.add_argument('--patients', type=int, default=1000)
+    run_parser.add_argument('--rows-per-patient-day', type=float, default=200)
+    run_parser.add_argument('--variable-fraction', type=float, default=1.)
+    run_parser.add_argument('--meds-per-patient-day', type=float, default=4)
+    run_parser.add_argument('--seed', type=int, default=0)
+
+    compare_parser = commands.add_parser('compare',
+                                         help='compares two reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('report')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative increase flagged as a '
+                                     'regression')
+    compare_parser.add_argument('--min-time', type=float, default=1.,
+                                help='times below this number of seconds '
+                                     'are not compared')
+
+    # runs a single stage, used by the run command.
+    stage_parser = commands.add_parser('_stage')
+    stage_parser.add_argument('name')
+    stage_parser.add_argument('result')
+    stage_parser.add_argument('--datasets', nargs='+', default=DATASETS)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        benchmark = PipelineBenchmark(args.root,
+                                      datasets=args.datasets,
+                                      reuse_sources=args.reuse_sources,
+                                      n_patients=args.patients,
+                                      rows_per_patient_day=args.rows_per_patient_day,
+                                      variable_fraction=args.variable_fraction,
+                                      meds_per_patient_day=args.meds_per_patient_day,
+                                      seed=args.seed)
+        report = benchmark.run()
+        report_pth = args.report or benchmark.root/'benchmark_report.json'
+        with open(report_pth, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report saved to {report_pth}')
+
+    elif args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.report) as file:
+            report = json.load(file)
+        regressions = compare(baseline, report,
+                              threshold=args.threshold,
+                              min_time=args.min_time)
+        print(f'{len(regressions)} regressions')
+        sys.exit(1 if regressions else 0)
+
+    else:
+        result = run_stage(args.name, args.datasets)
+        with open(args.result, 'w') as file:
+            json.dump(result, file)
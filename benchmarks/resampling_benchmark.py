@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the hourly resampling of TimeseriesPreprocessing.
+
+The current _build_index and _resampling are compared to the previous 
+implementation (outer join with a grid built from a list of tuples, then
+forward fill of the bins) on a synthetic chunk of 1000 patients. 
+The outputs are checked to be identical.
+
+Run from the root of the repository:
+    python benchmarks/resampling_benchmark.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
+
+
+def legacy_build_index(self, timeseries, cols_index, freq=3600):
+    observation_times = pd.DataFrame(timeseries.index.tolist(),
+                                     columns=cols_index)
+
+    self.last_sample = (observation_times.groupby('patient')['time']
+                                         .max().astype(int)
+                                         .clip(lower=freq+1))
+
+    tuples = [(i, t) for i, T in self.last_sample.items()
+              for t in np.arange(0, T, freq).astype(int)]
+    self.mux = pd.MultiIndex.from_tuples(tuples, names=cols_index)
+
+    self.df_resampler = pd.DataFrame(self.mux.get_level_values(1).values,
+                                     index=self.mux,
+                                     columns=['new_time'])
+    return self.mux
+
+
+def legacy_resampling(self, df):
+    aggregates = self.aggregates_blended.loc[df.columns]
+    df = self.df_resampler.join(df, how='outer')
+
+    df['new_time'] = df.groupby(level=0).new_time.ffill()
+
+    df = (df.droplevel(1)
+            .rename(columns={'new_time': self.time_col})
+            .set_index(self.time_col, append=True)
+            .groupby(level=[0, 1])
+            .agg(aggregates))
+    return df
+
+
+def synthetic_chunk(n_patients=1000, n_rows=500_000, seed=0):
+    """
+    Long-format chunk of hourly-resampled variables: 'mean' variables, a
+    'last' variable and a string variable, with float32 times in seconds
+    over stays of up to 14 days.
+    """
+    rng = np.random.default_rng(seed)
+    patients = np.array([f'synthetic-{i}' for i in range(n_patients)])
+    los = rng.integers(3600, 14*24*3600, n_patients)
+    idx = rng.integers(0, n_patients, n_rows)
+    times = (rng.random(n_rows)*los[idx]).astype(np.float32)
+
+    timeseries = pd.DataFrame({
+        'patient': patients[idx],
+        'time': times,
+        'heart_rate': rng.normal(80, 10, n_rows).astype(np.float32),
+        'temperature': rng.normal(37, 1, n_rows).astype(np.float32),
+        'glasgow_coma_score': rng.integers(3, 16, n_rows).astype(np.float32),
+        'ventilator_mode': rng.choice(['A', 'B', None], n_rows),
+        })
+    sparse = rng.random((n_rows, 3)) < 0.7
+    timeseries.loc[sparse[:, 0], 'heart_rate'] = np.nan
+    timeseries.loc[sparse[:, 1], 'temperature'] = np.nan
+    timeseries.loc[sparse[:, 2], 'glasgow_coma_score'] = np.nan
+
+    aggregates = pd.Series({'heart_rate': 'mean',
+                            'temperature': 'mean',
+                            'glasgow_coma_score': 'last',
+                            'ventilator_mode': 'last'})
+    return timeseries.set_index(['patient', 'time']), aggregates
+
+
+def make_processor(aggregates):
+    """
+    The resampling only needs the aggregation methods of the variables, 
+    so the config files are not read.
+    """
+    tsp = object.__new__(TimeseriesPreprocessing)
+    tsp.time_col = 'time'
+    tsp.aggregates_blended = aggregates
+    return tsp
+
+
+def run_legacy(tsp, timeseries):
+    legacy_build_index(tsp, timeseries, cols_index=['patient', 'time'])
+    return legacy_resampling(tsp, timeseries)
+
+
+def run_current(tsp, timeseries):
+    tsp._build_index(timeseries, cols_index=['patient', 'time'])
+    return tsp._resampling(timeseries)
+
+
+if __name__ == '__main__':
+    timeseries, aggregates = synthetic_chunk()
+    tsp = make_processor(aggregates)
+
+    pd.testing.assert_frame_equal(run_legacy(tsp, timeseries),
+                                  run_current(tsp, timeseries))
+    print(f'{len(timeseries)} rows, outputs are identical.')
+
+    for name, func in [('legacy', run_legacy), ('current', run_current)]:
+        durations = timeit.repeat(lambda: func(tsp, timeseries),
+                                  number=1,
+                                  repeat=3)
+        print(f'{name:>8}: {min(durations):.3f} s')
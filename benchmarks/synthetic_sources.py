@@ -0,0 +1,883 @@
+"""
+Synthetic source databases for benchmarks and regression tests.
+
+Writes synthetic versions of the raw tables that the preparators of
+1_extract_*.py read, for the five source databases:
+    eicu: patient, lab, nurseCharting, respiratoryCharting, intakeOutput,
+          vitalPeriodic, vitalAperiodic, medication, infusionDrug,
+          admissionDrug, diagnosis, pastHistory, admissionDx
+    mimic: core/admissions, core/patients, icu/icustays, icu/d_items,
+           icu/chartevents, icu/inputevents, icu/outputevents,
+           hosp/d_labitems, hosp/labevents
+    mimic3: the same tables in the MIMIC-III layout
+    amsterdam: admissions, numericitems, listitems, drugitems
+    hirid: reference_data/general_table.csv, observation_tables/parquet,
+           pharma_records/parquet, imputed_stage/parquet and the variable
+           reference.
+The tables have the file names, columns, identifiers and time units of the
+source databases. The timeseries labels are taken from
+timeseries_variables.csv and the drug names from medications_v10.json, so
+that the data goes through every stage of the pipeline. The values are
+random.
+
+The sources are written to ROOT/sources/<dataset>/, and the paths.json and
+config.json of the synthetic run are written to ROOT. The auxillary files
+are copied to ROOT/auxillary_files/ with a synthetic OMOP_vocabulary/ that
+only contains the concepts used by the OMOP conversion. The pipeline is run
+with ROOT as working directory, eg.
+    cd ROOT && python /path/to/BlendedICU/1_extract_eicu.py
+The hirid sources are already untarred, 1_extract_hirid.py should be
+answered 'n' when it asks to untar them.
+
+Run from the root of the repository:
+    python benchmarks/synthetic_sources.py ROOT --patients 1000
+"""
+import argparse
+import gzip
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_PTH = Path(__file__).resolve().parents[1]
+AUX_PTH = REPO_PTH/'auxillary_files'
+
+DATASETS = ('eicu', 'mimic', 'mimic3', 'amsterdam', 'hirid')
+
+LAB_VARIABLES = ['O2_arterial_saturation', 'lactate', 'blood_glucose',
+                 'magnesium', 'sodium', 'creatinine', 'calcium', 'chloride',
+                 'potassium', 'PTT', 'bilirubine', 'alanine_aminotransferase',
+                 'aspartate_aminotransferase', 'alkaline_phosphatase',
+                 'albumin', 'phosphate', 'bicarbonate', 'blood_urea_nitrogen',
+                 'pH', 'paO2', 'paCO2', 'hemoglobin', 'white_blood_cells',
+                 'platelets']
+
+RESP_VARIABLES = ['expiratory_tidal_volume', 'plateau_pressure',
+                  'respiratory_rate_setting', 'tidal_volume_setting', 'FiO2',
+                  'PEEP', 'ventilator_mode']
+
+GCS_VARIABLES = ['glasgow_coma_score', 'glasgow_coma_score_eye',
+                 'glasgow_coma_score_motor', 'glasgow_coma_score_verbal']
+
+VENTILATOR_MODES = ['CMV', 'SIMV', 'PSV', 'CPAP']
+
+# some of the eicu hospitals that have a location in the OMOP conversion.
+EICU_HOSPITAL_IDS = [404, 420, 252, 90, 94, 385, 136, 259, 301, 227, 449, 345,
+                     248, 279, 122, 264, 436, 391, 338, 63]
+
+# Amsterdam has no GCS variables, they are computed from these listitems.
+AMSTERDAM_GCS_ITEMS = {
+    'glasgow_coma_score_eye': (6732, 'Actief openen van de ogen', 4),
+    'glasgow_coma_score_motor': (6734, 'Beste motore reactie van de armen', 6),
+    'glasgow_coma_score_verbal': (6735, 'Beste verbale reactie', 5)}
+
+# heights and weights are read from the timeseries of mimic and hirid.
+MIMIC_HW_ITEMS = {226512: 'Admission Weight (Kg)',
+                  226730: 'Height (cm)'}
+HIRID_HW_ITEMS = {10000400: 'Body weight',
+                  10000450: 'Body height measure'}
+
+# concepts looked up by OMOP_converter, besides the timeseries variables and
+# the drugs.
+OMOP_UNIT_CONCEPTS = {0: 'No matching concept', 8482: 'mmHg', 8510: 'K/uL',
+                      8541: '/min', 8554: '%', 8555: 's', 8582: 'cm',
+                      8636: 'g/L', 8645: 'U/L', 8713: 'g/dL', 8749: 'umol/L',
+                      8753: 'mmol/L', 8840: 'mg/dL', 8861: 'mmol/L',
+                      8876: 'mmHg', 9448: 'year', 9529: 'kg', 9571: 'mL',
+                      44777590: 'cm[H2O]', 44777613: 'mL/h', 586323: 'Cel'}
+OMOP_MISC_CONCEPTS = [8844, 38004285, 32037, 9203, 4021813, 44818518,
+                      38000280, 43542358, 4318944, 40481392, 4149943,
+                      4305366, 763903, 4148496, 4160026, 4330427, 4320169,
+                      4330442, 4265453, 4099154, 607590]
+
+
+def _append_csv(df, pth, encoding='utf-8'):
+    """
+    Appends df to a gzipped csv file. The header is written with the first
+    batch, the batches are separate gzip members of the same file.
+    """
+    header = not Path(pth).exists()
+    with gzip.open(pth, 'at', encoding=encoding, newline='') as file:
+        df.to_csv(file, header=header, index=False)
+
+
+def _datetime_str(times):
+    return pd.Series(times).dt.strftime('%Y-%m-%d %H:%M:%S').values
+
+
+class SyntheticSources:
+    """
+    n_patients: number of ICU stays of each database.
+    rows_per_patient_day: number of timeseries measurements per day of
+        stay, shared by all the selected variables.
+    variable_fraction: fraction of the variables of timeseries_variables.csv
+        that are measured. The same variables are drawn in every database.
+    variables: list of blended variable names, overrides variable_fraction.
+    meds_per_patient_day: number of drug administrations per day of stay.
+    batch_size: number of stays generated at once, the large tables are
+        appended batch by batch.
+    """
+    def __init__(self,
+                 root,
+                 n_patients=1000,
+                 rows_per_patient_day=200,
+                 variable_fraction=1.,
+                 variables=None,
+                 meds_per_patient_day=4,
+                 batch_size=1000,
+                 seed=0):
+        self.root = Path(root).resolve()
+        self.source_root = self.root/'sources'
+        self.n_patients = n_patients
+        self.rows_per_patient_day = rows_per_patient_day
+        self.meds_per_patient_day = meds_per_patient_day
+        self.batch_size = batch_size
+        self.seed = seed
+
+        ts_variables = pd.read_csv(AUX_PTH/'user_input/timeseries_variables.csv',
+                                   sep=';').set_index('blended')
+        if variables is None:
+            rng = np.random.default_rng(seed)
+            n_kept = max(1, round(variable_fraction*len(ts_variables)))
+            variables = rng.choice(ts_variables.index, n_kept, replace=False)
+        self.variables = ts_variables.loc[ts_variables.index.isin(variables)]
+        self.all_labels = set(ts_variables[[*DATASETS]].values.ravel())
+
+        with open(AUX_PTH/'medications_v10.json', encoding='ISO-8859-1') as file:
+            self.medications = json.load(file)
+
+        self.unit_types = self._json_values('unit_type_v2.json')
+        self.discharge_locations = self._json_values('discharge_location_v2.json')
+        self.origins = self._json_values('admission_origins_v2.json')
+
+    def _json_values(self, fname):
+        with open(AUX_PTH/'user_input'/fname) as file:
+            mapping = json.load(file)
+        return [v for values in mapping.values() for v in values]
+
+    def source_pth(self, dataset):
+        return self.source_root/dataset
+
+    def _rng(self, dataset):
+        return np.random.default_rng([self.seed, DATASETS.index(dataset)])
+
+    def _batches(self, stays):
+        for start in range(0, len(stays), self.batch_size):
+            yield stays.iloc[start:start+self.batch_size]
+
+    def _reset_source(self, dataset):
+        pth = self.source_pth(dataset)
+        shutil.rmtree(pth, ignore_errors=True)
+        pth.mkdir(parents=True)
+        return pth
+
+    def _stays(self, rng):
+        """
+        Lengths of stay in hours, log-normally distributed around 2 days,
+        from 4 hours to 30 days.
+        """
+        los = np.exp(rng.normal(np.log(48), 0.8, self.n_patients))
+        return pd.DataFrame({'pos': np.arange(self.n_patients),
+                             'los_hours': los.clip(4, 30*24)})
+
+    def _route(self, dataset, tables, default=None):
+        """
+        Assigns the selected variables that have a label in dataset to the
+        source tables in which they are found. tables maps table names to
+        lists of blended variables, the other variables go to default.
+        Returns a dict {table: {blended variable: source label}}.
+        """
+        labels = self.variables[dataset].dropna()
+        routes = {table: {} for table in [*tables, default] if table}
+        for var, label in labels.items():
+            table = next((t for t, v in tables.items() if var in v), default)
+            if table is not None:
+                routes[table][var] = label
+        return routes
+
+    def _n_rows_per_day(self, n_variables):
+        return self.rows_per_patient_day*n_variables/max(1, len(self.variables))
+
+    def _events(self, rng, stays, rows_per_day):
+        """
+        Random event times of each stay, in hours since admission, from one
+        hour before admission to one hour after discharge.
+        Returns the position of the stay of each event and its time.
+        """
+        n = rng.poisson(stays.los_hours.values/24*rows_per_day)
+        idx = np.repeat(np.arange(len(stays)), n)
+        times = rng.uniform(-1, stays.los_hours.values[idx]+1)
+        return stays.pos.values[idx], times
+
+    def _values(self, rng, variables):
+        """
+        Random values of an array of blended variables. The values of
+        variables with a user_min and a user_max are uniform in this range,
+        GCS values are integers. Ventilator modes are strings.
+        """
+        n = len(variables)
+        lower = self.variables.user_min.reindex(variables).values
+        upper = self.variables.user_max.reindex(variables).values
+        bounded = ~np.isnan(lower) & ~np.isnan(upper)
+
+        values = np.exp(rng.normal(np.log(40), 0.6, n))
+        values[bounded] = rng.uniform(lower[bounded], upper[bounded])
+        is_gcs = np.isin(variables, GCS_VARIABLES)
+        values[is_gcs] = np.round(values[is_gcs])
+        is_ph = variables == 'pH'
+        values[is_ph] = rng.normal(7.4, 0.08, is_ph.sum())
+
+        is_mode = variables == 'ventilator_mode'
+        if not is_mode.any():
+            return values.round(2)
+        values = values.round(2).astype(object)
+        values[is_mode] = rng.choice(VENTILATOR_MODES, is_mode.sum())
+        return values
+
+    def _long_table(self, rng, stays, route):
+        """
+        Measurements of the variables of route in long format: position of
+        the stay, time in hours, blended variable, source label and value.
+        """
+        variables = np.array([*route.keys()], dtype=object)
+        pos, hours = self._events(rng, stays,
+                                  self._n_rows_per_day(len(variables)))
+        if not len(variables):
+            pos, hours = pos[:0], hours[:0]
+        var = rng.choice(variables, len(pos)) if len(variables) else variables
+        return pd.DataFrame({'pos': pos,
+                             'hours': hours,
+                             'variable': var,
+                             'label': pd.Series(var).map(route).values,
+                             'value': self._values(rng, var)})
+
+    def _wide_table(self, rng, stays, columns, route):
+        """
+        Measurements in wide format: one column per source variable. The
+        columns of variables that are not selected are empty, the columns
+        that are not in timeseries_variables.csv are always filled.
+        """
+        pos, hours = self._events(rng, stays,
+                                  self._n_rows_per_day(max(1, len(route))))
+        labels_to_var = {label: var for var, label in route.items()}
+        table = pd.DataFrame({'pos': pos, 'hours': hours})
+        for col in columns:
+            if col in labels_to_var:
+                var = np.full(len(pos), labels_to_var[col], dtype=object)
+                table[col] = self._values(rng, var)
+            elif col in self.all_labels:
+                table[col] = np.nan
+            else:
+                table[col] = np.exp(rng.normal(np.log(40), 0.6, len(pos))).round(2)
+        return table
+
+    def _medications(self, rng, stays, dataset):
+        """
+        Drug administrations: position of the stay, time in hours and drug
+        name of the dataset from medications_v10.json.
+        """
+        drugnames = sorted({name for med in self.medications.values()
+                            for name in med.get(dataset, [])})
+        pos, hours = self._events(rng, stays, self.meds_per_patient_day)
+        return pd.DataFrame({'pos': pos,
+                             'hours': hours,
+                             'drugname': rng.choice(drugnames, len(pos))})
+
+    def gen_eicu(self):
+        print('eicu...')
+        rng = self._rng('eicu')
+        pth = self._reset_source('eicu')
+        stays = self._stays(rng)
+        stay_ids = 141000 + stays.pos.values
+        n = len(stays)
+
+        periodic_cols = ['temperature', 'sao2', 'heartrate', 'respiration',
+                         'cvp', 'systemicsystolic', 'systemicdiastolic',
+                         'systemicmean', 'st1', 'st2', 'st3']
+        aperiodic_cols = ['noninvasivesystolic', 'noninvasivediastolic',
+                          'noninvasivemean']
+        periodic = [v for v, label in self.variables.eicu.dropna().items()
+                    if label in periodic_cols]
+        aperiodic = [v for v, label in self.variables.eicu.dropna().items()
+                     if label in aperiodic_cols]
+        routes = self._route('eicu',
+                             {'vitalPeriodic': periodic,
+                              'vitalAperiodic': aperiodic,
+                              'lab': LAB_VARIABLES+['O2_pulseoxymetry_saturation'],
+                              'respiratoryCharting': RESP_VARIABLES,
+                              'intakeOutput': ['urine_output']},
+                             default='nurseCharting')
+
+        age = rng.integers(18, 95, n).astype(str)
+        age[age.astype(int) > 89] = '> 89'
+        hospital_ids = rng.choice(EICU_HOSPITAL_IDS, n)
+        patient = pd.DataFrame({
+            'patientunitstayid': stay_ids,
+            'patienthealthsystemstayid': 128000 + stays.pos.values,
+            'gender': rng.choice(['Male', 'Female'], n),
+            'age': age,
+            'ethnicity': rng.choice(['Caucasian', 'African American',
+                                          'Hispanic', 'Asian',
+                                          'Other/Unknown'], n),
+            'hospitalid': hospital_ids,
+            'apacheadmissiondx': rng.choice(['Sepsis, pulmonary',
+                                                  'CHF, congestive heart failure',
+                                                  'Overdose, other toxin'], n),
+            'admissionheight': rng.normal(170, 10, n).round(1),
+            'unitadmittime24': [f'{h:02d}:{m:02d}:00' for h, m in
+                                zip(rng.integers(0, 24, n),
+                                    rng.integers(0, 60, n))],
+            'unitadmitsource': rng.choice(self.origins, n),
+            'unitvisitnumber': 1,
+            'unitstaytype': 'admit',
+            'admissionweight': rng.normal(80, 15, n).round(1),
+            'unittype': rng.choice(self.unit_types, n),
+            'unitdischargeoffset': (stays.los_hours.values*60).astype(int),
+            'unitdischargelocation': rng.choice(self.discharge_locations, n),
+            'unitdischargestatus': rng.choice(['Alive', 'Expired'], n),
+            'uniquepid': [f'{h:03d}-{i}' for h, i in zip(hospital_ids,
+                                                          stays.pos.values)]})
+        patient.to_csv(pth/'patient.csv.gz', index=False)
+
+        diagnoses = {'diagnosis': ('diagnosisoffset', 'diagnosisstring'),
+                     'pastHistory': ('pasthistoryoffset', 'pasthistorypath'),
+                     'admissionDx': ('admitdxenteredoffset', 'admitdxpath')}
+        for table, (col_offset, col_string) in diagnoses.items():
+            pos, hours = self._events(rng, stays, 2)
+            pd.DataFrame({
+                'patientunitstayid': stay_ids[pos],
+                col_offset: (hours*60).astype(int),
+                col_string: rng.choice(['cardiovascular|shock|septic',
+                                             'pulmonary|respiratory failure',
+                                             'renal|acute renal failure'],
+                                       len(pos))
+                }).to_csv(pth/f'{table}.csv.gz', index=False)
+
+        long_cols = {'lab': ('labresultoffset', 'labname', 'labresult'),
+                     'nurseCharting': ('nursingchartoffset',
+                                       'nursingchartcelltypevallabel',
+                                       'nursingchartvalue'),
+                     'respiratoryCharting': ('respchartoffset',
+                                             'respchartvaluelabel',
+                                             'respchartvalue'),
+                     'intakeOutput': ('intakeoutputoffset', 'celllabel',
+                                      'cellvaluenumeric')}
+        med_tables = {'medication': 'drugstartoffset',
+                      'infusionDrug': 'infusionoffset',
+                      'admissionDrug': 'drugoffset'}
+
+        for batch in self._batches(stays):
+            for table, (col_offset, col_label, col_value) in long_cols.items():
+                df = self._long_table(rng, batch, routes[table])
+                if table == 'respiratoryCharting':
+                    is_fio2 = (df.variable == 'FiO2').values
+                    df['value'] = df['value'].astype(str)
+                    df.loc[is_fio2, 'value'] = df.loc[is_fio2, 'value'] + '%'
+                df = pd.DataFrame({
+                    'patientunitstayid': stay_ids[df.pos],
+                    col_offset: (df.hours*60).astype(int),
+                    col_label: df.label,
+                    col_value: df.value})
+                _append_csv(df.sort_values(['patientunitstayid', col_offset]),
+                            pth/f'{table}.csv.gz')
+
+            for table, cols in [('vitalPeriodic', periodic_cols),
+                                ('vitalAperiodic', aperiodic_cols)]:
+                df = self._wide_table(rng, batch, cols, routes[table])
+                df.insert(0, 'patientunitstayid', stay_ids[df.pos])
+                df.insert(1, 'observationoffset', (df.hours*60).astype(int))
+                df = df.drop(columns=['pos', 'hours'])
+                _append_csv(df.sort_values(['patientunitstayid',
+                                            'observationoffset']),
+                            pth/f'{table}.csv.gz')
+
+            meds = self._medications(rng, batch, 'eicu')
+            med_table = rng.choice([*med_tables], len(meds))
+            for table, col_offset in med_tables.items():
+                df = meds.loc[med_table == table]
+                _append_csv(pd.DataFrame({
+                    'patientunitstayid': stay_ids[df.pos],
+                    col_offset: (df.hours*60).astype(int),
+                    'drugname': df.drugname}), pth/f'{table}.csv.gz')
+
+    def _mimic_tables(self, dataset):
+        """
+        Builds the tables of MIMIC-IV, the MIMIC-III tables are the same
+        tables with different names, columns and identifiers.
+        """
+        rng = self._rng(dataset)
+        stays = self._stays(rng)
+        n = len(stays)
+        stays['subject_id'] = 10_000_000 + stays.pos.values
+        stays['hadm_id'] = 20_000_000 + stays.pos.values
+        stays['stay_id'] = 30_000_000 + stays.pos.values
+        intime = (pd.Timestamp('2110-01-01')
+                  + pd.to_timedelta(rng.integers(0, 60*365*24, n), unit='h')
+                  + pd.to_timedelta(rng.integers(0, 3600, n), unit='s'))
+        stays['intime'] = intime
+        stays['admittime'] = intime - pd.to_timedelta(rng.integers(0, 72, n),
+                                                      unit='h')
+        stays['outtime'] = intime + pd.to_timedelta(stays.los_hours, unit='h')
+
+        routes = self._route(dataset,
+                             {'labevents': [v for v in LAB_VARIABLES
+                                            if v != 'pH'],
+                              'outputevents': ['urine_output']},
+                             default='chartevents')
+        drugnames = sorted({name for med in self.medications.values()
+                            for name in med.get(dataset, [])})
+
+        chart_labels = sorted(set(routes['chartevents'].values()))
+        output_labels = sorted(set(routes['outputevents'].values()))
+        d_items = pd.DataFrame({
+            'itemid': [*MIMIC_HW_ITEMS,
+                       *range(220000, 220000+len(chart_labels)),
+                       *range(226000, 226000+len(output_labels)),
+                       *range(221000, 221000+len(drugnames))],
+            'label': [*MIMIC_HW_ITEMS.values(), *chart_labels,
+                      *output_labels, *drugnames],
+            'linksto': (['chartevents']*(len(MIMIC_HW_ITEMS)+len(chart_labels))
+                        + ['outputevents']*len(output_labels)
+                        + ['inputevents']*len(drugnames))})
+        lab_labels = sorted(set(routes['labevents'].values()))
+        d_labitems = pd.DataFrame({
+            'itemid': range(50800, 50800+len(lab_labels)),
+            'label': lab_labels,
+            'fluid': 'Blood',
+            'category': 'Chemistry'})
+        itemids = dict(zip(d_items.label, d_items.itemid))
+        labitemids = dict(zip(d_labitems.label, d_labitems.itemid))
+
+        admissions = pd.DataFrame({
+            'subject_id': stays.subject_id,
+            'hadm_id': stays.hadm_id,
+            'admittime': _datetime_str(stays.admittime),
+            'dischtime': _datetime_str(stays.outtime + pd.Timedelta(days=2)),
+            'admission_location': rng.choice(self.origins, n),
+            'discharge_location': rng.choice(self.discharge_locations, n),
+            'insurance': rng.choice(['Medicare', 'Medicaid', 'Other'], n),
+            'ethnicity': rng.choice(['WHITE', 'BLACK/AFRICAN AMERICAN',
+                                          'HISPANIC/LATINO', 'ASIAN',
+                                          'OTHER'], n),
+            'hospital_expire_flag': rng.integers(0, 2, n)})
+        age = rng.integers(18, 92, n)
+        patients = pd.DataFrame({
+            'subject_id': stays.subject_id,
+            'gender': rng.choice(['M', 'F'], n),
+            'anchor_age': age,
+            'dob': _datetime_str(stays.intime - pd.to_timedelta(age*365.25,
+                                                                unit='D'))})
+        icustays = pd.DataFrame({
+            'subject_id': stays.subject_id,
+            'hadm_id': stays.hadm_id,
+            'stay_id': stays.stay_id,
+            'first_careunit': rng.choice(self.unit_types, n),
+            'last_careunit': rng.choice(self.unit_types, n),
+            'intime': _datetime_str(stays.intime),
+            'outtime': _datetime_str(stays.outtime),
+            'los': stays.los_hours/24})
+
+        tables = {'admissions': admissions,
+                  'patients': patients,
+                  'icustays': icustays,
+                  'd_items': d_items,
+                  'd_labitems': d_labitems}
+        yield tables
+
+        def _times(pos, hours):
+            intime = stays.intime.values[pos]
+            return _datetime_str(intime + pd.to_timedelta(hours*3600, unit='s'))
+
+        for batch in self._batches(stays):
+            chart = self._long_table(rng, batch, routes['chartevents'])
+            # admission heights and weights, in the first hour of the stay.
+            pos = np.repeat(batch.pos.values, len(MIMIC_HW_ITEMS))
+            hw = pd.DataFrame({
+                'pos': pos,
+                'hours': rng.uniform(0, 1, len(pos)),
+                'label': np.tile([*MIMIC_HW_ITEMS.values()], len(batch)),
+                'value': np.column_stack([rng.normal(80, 15, len(batch)),
+                                          rng.normal(170, 10, len(batch))]
+                                         ).ravel().round(1)})
+            chart = pd.concat([chart, hw]).sort_values(['pos', 'hours'])
+            valuenum = pd.to_numeric(chart.value, errors='coerce')
+            chartevents = pd.DataFrame({
+                'subject_id': stays.subject_id.values[chart.pos],
+                'hadm_id': stays.hadm_id.values[chart.pos],
+                'stay_id': stays.stay_id.values[chart.pos],
+                'charttime': _times(chart.pos.values, chart.hours.values),
+                'itemid': chart.label.map(itemids).values,
+                'value': chart.value.values,
+                'valuenum': valuenum.values})
+
+            lab = (self._long_table(rng, batch, routes['labevents'])
+                       .sort_values(['pos', 'hours']))
+            labevents = pd.DataFrame({
+                'subject_id': stays.subject_id.values[lab.pos],
+                'hadm_id': stays.hadm_id.values[lab.pos],
+                'itemid': lab.label.map(labitemids).values,
+                'charttime': _times(lab.pos.values, lab.hours.values),
+                'value': lab.value.astype(str).values,
+                'valuenum': lab.value.values})
+
+            output = (self._long_table(rng, batch, routes['outputevents'])
+                          .sort_values(['pos', 'hours']))
+            outputevents = pd.DataFrame({
+                'subject_id': stays.subject_id.values[output.pos],
+                'hadm_id': stays.hadm_id.values[output.pos],
+                'stay_id': stays.stay_id.values[output.pos],
+                'charttime': _times(output.pos.values,
+                                    output.hours.values),
+                'itemid': output.label.map(itemids).values,
+                'value': output.value.values})
+
+            meds = (self._medications(rng, batch, dataset)
+                        .sort_values(['pos', 'hours']))
+            inputevents = pd.DataFrame({
+                'subject_id': stays.subject_id.values[meds.pos],
+                'hadm_id': stays.hadm_id.values[meds.pos],
+                'stay_id': stays.stay_id.values[meds.pos],
+                'starttime': _times(meds.pos.values, meds.hours.values),
+                'endtime': _times(meds.pos.values, meds.hours.values+1),
+                'itemid': meds.drugname.map(itemids).values,
+                'amount': rng.uniform(0, 100, len(meds)).round(2)})
+
+            yield {'chartevents': chartevents,
+                   'labevents': labevents,
+                   'outputevents': outputevents,
+                   'inputevents': inputevents}
+
+    def gen_mimic(self):
+        print('mimic...')
+        pth = self._reset_source('mimic')
+        for d in ['core', 'hosp', 'icu']:
+            (pth/d).mkdir()
+        locations = {'admissions': 'core', 'patients': 'core',
+                     'd_labitems': 'hosp', 'labevents': 'hosp',
+                     'icustays': 'icu', 'd_items': 'icu',
+                     'chartevents': 'icu', 'inputevents': 'icu',
+                     'outputevents': 'icu'}
+
+        tables = self._mimic_tables('mimic')
+        static_tables = next(tables)
+        static_tables['patients'] = static_tables['patients'].drop(columns='dob')
+        for table, df in static_tables.items():
+            df.to_csv(pth/locations[table]/f'{table}.csv.gz', index=False)
+        for batch_tables in tables:
+            for table, df in batch_tables.items():
+                _append_csv(df, pth/locations[table]/f'{table}.csv.gz')
+
+    def gen_mimic3(self):
+        print('mimic3...')
+        pth = self._reset_source('mimic3')
+        rename = {'stay_id': 'ICUSTAY_ID', 'dob': 'DOB'}
+
+        def _to_mimic3(df):
+            df = df.rename(columns=rename)
+            df.columns = df.columns.str.upper()
+            return df
+
+        rng = self._rng('mimic3')
+        tables = self._mimic_tables('mimic3')
+        static_tables = next(tables)
+        static_tables['patients'] = static_tables['patients'].drop(columns='anchor_age')
+        for table, df in static_tables.items():
+            _to_mimic3(df).to_csv(pth/f'{table.upper()}.csv.gz', index=False)
+
+        for batch_tables in tables:
+            # the carevue inputevents have a charttime instead of a starttime.
+            inputevents = batch_tables.pop('inputevents')
+            is_cv = rng.random(len(inputevents)) < 0.5
+            batch_tables['inputevents_mv'] = inputevents.loc[~is_cv]
+            batch_tables['inputevents_cv'] = (inputevents.loc[is_cv]
+                                              .drop(columns='endtime')
+                                              .rename(columns={'starttime':
+                                                               'charttime'}))
+            for table, df in batch_tables.items():
+                _append_csv(_to_mimic3(df), pth/f'{table.upper()}.csv.gz')
+
+    def gen_amsterdam(self):
+        print('amsterdam...')
+        rng = self._rng('amsterdam')
+        pth = self._reset_source('amsterdam')
+        stays = self._stays(rng)
+        n = len(stays)
+        encoding = 'ISO-8859-1'
+
+        routes = self._route('amsterdam',
+                             {'listitems': ['ventilator_mode']},
+                             default='numericitems')
+        for var in GCS_VARIABLES:
+            routes['numericitems'].pop(var, None)
+        gcs_items = {v: item for v, item in AMSTERDAM_GCS_ITEMS.items()
+                     if v in self.variables.index
+                     or 'glasgow_coma_score' in self.variables.index}
+
+        itemids = {label: 6600+i for i, label in
+                   enumerate(sorted(routes['numericitems'].values()))}
+        itemids |= {label: 9500+i for i, label in
+                    enumerate(sorted(routes['listitems'].values()))}
+        drugnames = sorted({name for med in self.medications.values()
+                            for name in med.get('amsterdam', [])})
+        drugitemids = {name: 7000+i for i, name in enumerate(drugnames)}
+
+        def _group(values, width=10):
+            lower = (values//width*width).astype(int)
+            return [f'{low}-{low+width-1}' for low in lower]
+
+        agegroup = np.array(_group(rng.integers(18, 90, n)), dtype=object)
+        agegroup[rng.random(n) < 0.1] = '80+'
+        admissions = pd.DataFrame({
+            'admissionid': stays.pos.values,
+            'patientid': stays.pos.values,
+            'admissioncount': 1,
+            'location': rng.choice(['IC', 'MC', 'IC&MC'], n),
+            'urgency': rng.integers(0, 2, n),
+            'origin': rng.choice(['Verpleegafdeling zelfde ziekenhuis',
+                                       'Eerste Hulp afdeling zelfde ziekenhuis',
+                                       'Huis', 'Anders'], n),
+            'admittedat': 0,
+            'admissionyeargroup': '2010-2016',
+            'dischargedat': (stays.los_hours.values*3600*1000).astype(int),
+            'lengthofstay': stays.los_hours.values.astype(int),
+            'destination': rng.choice(['Overleden', '15', '16', '19'], n),
+            'gender': rng.choice(['Man', 'Vrouw', None], n),
+            'agegroup': agegroup,
+            'weightgroup': _group(rng.normal(80, 15, n)),
+            'heightgroup': _group(rng.normal(170, 10, n)),
+            'specialty': rng.choice(self.unit_types, n)})
+        admissions.to_csv(pth/'admissions.csv.gz', index=False,
+                          encoding=encoding)
+
+        for batch in self._batches(stays):
+            num = (self._long_table(rng, batch, routes['numericitems'])
+                       .sort_values(['pos', 'hours']))
+            _append_csv(pd.DataFrame({
+                'admissionid': num.pos.values,
+                'itemid': num.label.map(itemids).values,
+                'item': num.label.values,
+                'value': num.value.values,
+                'measuredat': (num.hours*3600*1000).astype(int).values}),
+                pth/'numericitems.csv.gz', encoding=encoding)
+
+            lst = self._long_table(rng, batch, routes['listitems'])
+            lst['itemid'] = lst.label.map(itemids)
+            lst['valueid'] = rng.integers(1, len(VENTILATOR_MODES)+1, len(lst))
+            # the components of the GCS are charted at the same times.
+            pos, hours = self._events(rng, batch, self._n_rows_per_day(1))
+            for var, (itemid, label, n_values) in gcs_items.items():
+                valueid = rng.integers(1, n_values+1, len(pos))
+                lst = pd.concat([lst, pd.DataFrame({
+                    'pos': pos,
+                    'hours': hours,
+                    'label': label,
+                    'itemid': itemid,
+                    'valueid': valueid,
+                    'value': valueid.astype(str)})])
+            lst = lst.sort_values(['pos', 'hours'])
+            _append_csv(pd.DataFrame({
+                'admissionid': lst.pos.values,
+                'itemid': lst.itemid.values,
+                'item': lst.label.values,
+                'valueid': lst.valueid.values,
+                'value': lst.value.values,
+                'measuredat': (lst.hours*3600*1000).astype(int).values}),
+                pth/'listitems.csv.gz', encoding=encoding)
+
+            meds = (self._medications(rng, batch, 'amsterdam')
+                        .sort_values(['pos', 'hours']))
+            start = (meds.hours*3600*1000).astype(int).values
+            _append_csv(pd.DataFrame({
+                'admissionid': meds.pos.values,
+                'itemid': meds.drugname.map(drugitemids).values,
+                'item': meds.drugname.values,
+                'start': start,
+                'stop': start + 3600*1000,
+                'dose': rng.uniform(0, 100, len(meds)).round(2)}),
+                pth/'drugitems.csv.gz', encoding=encoding)
+
+    def gen_hirid(self):
+        print('hirid...')
+        rng = self._rng('hirid')
+        pth = self._reset_source('hirid')
+        for d in ['reference_data', 'observation_tables/parquet',
+                  'pharma_records/parquet', 'imputed_stage/parquet']:
+            (pth/d).mkdir(parents=True)
+        stays = self._stays(rng)
+        n = len(stays)
+        patient_ids = 1 + stays.pos.values
+        admissiontime = (pd.Timestamp('2130-01-01')
+                         + pd.to_timedelta(rng.integers(0, 10*365*24*3600, n),
+                                           unit='s'))
+
+        route = self._route('hirid', {}, default='observation')['observation']
+        drugnames = sorted({name for med in self.medications.values()
+                            for name in med.get('hirid', [])})
+        obs_labels = sorted(set(route.values()))
+        variable_ref = pd.DataFrame({
+            'Source Table': (['Observation']*(len(HIRID_HW_ITEMS)+len(obs_labels))
+                             + ['Pharma']*len(drugnames)),
+            'ID': [*HIRID_HW_ITEMS, *range(100, 100+len(obs_labels)),
+                   *range(1000, 1000+len(drugnames))],
+            'Variable Name': [*HIRID_HW_ITEMS.values(), *obs_labels,
+                              *drugnames],
+            'Unit': ''})
+        variable_ref.to_csv(pth/'hirid_variable_reference_v1.csv', sep=';',
+                            index=False)
+        variableids = dict(zip(variable_ref['Variable Name'], variable_ref.ID))
+
+        pd.DataFrame({
+            'patientid': patient_ids,
+            'admissiontime': _datetime_str(admissiontime),
+            'sex': rng.choice(['M', 'F'], n),
+            'age': rng.integers(16, 90, n)//5*5,
+            'discharge_status': rng.choice(['alive', 'dead'], n)
+            }).to_csv(pth/'reference_data/general_table.csv', index=False)
+
+        for i, batch in enumerate(self._batches(stays)):
+            obs = self._long_table(rng, batch, route)
+            pos = np.repeat(batch.pos.values, len(HIRID_HW_ITEMS))
+            hw = pd.DataFrame({
+                'pos': pos,
+                'hours': rng.uniform(0, 1, len(pos)),
+                'label': np.tile([*HIRID_HW_ITEMS.values()], len(batch)),
+                'value': np.column_stack([rng.normal(80, 15, len(batch)),
+                                          rng.normal(170, 10, len(batch))]
+                                         ).ravel().round(1)})
+            # ventilator modes are coded as numbers in hirid.
+            is_mode = (obs.variable == 'ventilator_mode').values
+            obs.loc[is_mode, 'value'] = rng.integers(1, 5, is_mode.sum())
+            obs = pd.concat([obs, hw]).sort_values(['pos', 'hours'])
+            obs_time = (admissiontime[obs.pos.values]
+                        + pd.to_timedelta((obs.hours.values*3600).astype(int), unit='s'))
+            pd.DataFrame({
+                'datetime': obs_time,
+                'entertime': obs_time,
+                'patientid': patient_ids[obs.pos],
+                'status': 8,
+                'stringvalue': None,
+                'type': None,
+                'value': pd.to_numeric(obs.value, errors='coerce').values,
+                'variableid': obs.label.map(variableids).values,
+                }).to_parquet(pth/f'observation_tables/parquet/part-{i}.parquet',
+                              index=False)
+
+            meds = (self._medications(rng, batch, 'hirid')
+                        .sort_values(['pos', 'hours']))
+            givenat = (admissiontime[meds.pos.values]
+                       + pd.to_timedelta((meds.hours.values*3600).astype(int), unit='s'))
+            pd.DataFrame({
+                'patientid': patient_ids[meds.pos],
+                'pharmaid': meds.drugname.map(variableids).values,
+                'givenat': givenat,
+                'enteredentryat': givenat,
+                'givendose': rng.uniform(0, 100, len(meds)).round(2),
+                }).to_parquet(pth/f'pharma_records/parquet/part-{i}.parquet',
+                              index=False)
+
+            # the length of stay is the time of the last imputed sample.
+            n_steps = (batch.los_hours.values*12).astype(int) + 1
+            idx = np.repeat(np.arange(len(batch)), n_steps)
+            steps = np.arange(len(idx)) - np.repeat(np.cumsum(n_steps)-n_steps,
+                                                    n_steps)
+            pd.DataFrame({
+                'patientid': patient_ids[batch.pos.values[idx]],
+                'reldatetime': steps*300,
+                }).to_parquet(pth/f'imputed_stage/parquet/part-{i}.parquet',
+                              index=False)
+
+    def gen_vocabulary(self):
+        """
+        Copies the auxillary files to ROOT/auxillary_files/ and writes a
+        CONCEPT.parquet with the concepts of the units, visits, locations,
+        timeseries variables and drugs of the OMOP conversion. The names and
+        codes of the concepts are placeholders.
+        """
+        aux_pth = self.root/'auxillary_files'
+        shutil.copytree(AUX_PTH, aux_pth, dirs_exist_ok=True)
+        pth = aux_pth/'OMOP_vocabulary/CONCEPT.parquet'
+        if pth.exists():
+            return
+        ts_variables = pd.read_csv(AUX_PTH/'user_input/timeseries_variables.csv',
+                                   sep=';')
+        concepts = pd.concat([
+            pd.DataFrame({'concept_name': [f'concept {c}'
+                                           for c in OMOP_MISC_CONCEPTS],
+                          'domain_id': 'Observation'},
+                         index=OMOP_MISC_CONCEPTS),
+            pd.DataFrame({'concept_name': ts_variables['blended'].values,
+                          'domain_id': 'Measurement'},
+                         index=ts_variables['concept_id'].values),
+            pd.DataFrame({'concept_name': [*self.medications],
+                          'domain_id': 'Drug'},
+                         index=[m['blended'] for m in self.medications.values()]),
+            pd.DataFrame({'concept_name': OMOP_UNIT_CONCEPTS.values(),
+                          'domain_id': 'Unit'},
+                         index=[*OMOP_UNIT_CONCEPTS])])
+        concepts = (concepts.loc[~concepts.index.duplicated()]
+                            .rename_axis('concept_id')
+                            .assign(concept_code=lambda x: x.concept_name,
+                                    vocabulary_id='Synthetic',
+                                    concept_class_id=lambda x: x.domain_id,
+                                    standard_concept='S'))
+        pth.parent.mkdir(exist_ok=True)
+        concepts.to_parquet(pth)
+
+    def write_paths(self):
+        """
+        Writes the paths.json of the synthetic run, the processed data is
+        written to ROOT/processed/ and the auxillary files are read from
+        ROOT/auxillary_files/. config.json is copied from the repository if
+        ROOT does not have one.
+        """
+        aux_pth = self.root/'auxillary_files'
+        paths = ({f'{d}_source_path': f'{self.source_pth(d)}/'
+                  for d in DATASETS}
+                 | {d: f'{self.root}/processed/{d}/'
+                    for d in [*DATASETS, 'blended']}
+                 | {'results': f'{self.root}/results/',
+                    'auxillary_files': f'{aux_pth}/',
+                    'vocabulary': f'{aux_pth}/OMOP_vocabulary/',
+                    'user_input': f'{aux_pth}/user_input/',
+                    'medication_mapping_files': f'{aux_pth}/medication_mapping_files/'})
+        with open(self.root/'paths.json', 'w') as file:
+            json.dump(paths, file, indent=2)
+        if not (self.root/'config.json').exists():
+            shutil.copy(REPO_PTH/'config.json', self.root/'config.json')
+
+    def run(self, datasets=DATASETS):
+        self.root.mkdir(parents=True, exist_ok=True)
+        for dataset in datasets:
+            getattr(self, f'gen_{dataset}')()
+        self.gen_vocabulary()
+        self.write_paths()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root')
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--rows-per-patient-day', type=float, default=200)
+    parser.add_argument('--variable-fraction', type=float, default=1.)
+    parser.add_argument('--variables', nargs='+', default=None,
+                        help='blended variable names, overrides '
+                             '--variable-fraction')
+    parser.add_argument('--meds-per-patient-day', type=float, default=4)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datasets', nargs='+', default=DATASETS,
+                        choices=DATASETS)
+    args = parser.parse_args()
+
+    sources = SyntheticSources(args.root,
+                               n_patients=args.patients,
+                               rows_per_patient_day=args.rows_per_patient_day,
+                               variable_fraction=args.variable_fraction,
+                               variables=args.variables,
+                               meds_per_patient_day=args.meds_per_patient_day,
+                               batch_size=args.batch_size,
+                               seed=args.seed)
+    sources.run(args.datasets)
@@ -12,6 +12,8 @@ def _take_sample(df, size, groupcol='source_dataset'):
 
 
 class blended_FLProcessor(FlatAndLabelsProcessor):
+    stage_config_keys = ['FLAT_FILL_MEDIAN', 'FLAT_NORMALIZE', 'FLAT_CLIP']
+
     def __init__(self, datasets, size=None):
         super().__init__(dataset='blended')
         self.size = size
@@ -26,6 +28,10 @@ class blended_FLProcessor(FlatAndLabelsProcessor):
                        for d in self.datasets}
         return {d: self.load(p).reset_index() for d, p in labels_pths.items()}
 
+    def stage_inputs(self):
+        return super().stage_inputs() + [f'{self.pth_dic[d]}/preprocessed_labels.parquet'
+                                         for d in self.datasets]
+
     def _fill_flat(self, df, **kwargs):
         """
         Missing values imputation of flat variables. This is optionnal using
@@ -0,0 +1,238 @@
+"""
+Chunks of the MEASUREMENT and DRUG_EXPOSURE tables of the OMOP export.
+
+Once the person and visit tables exist, each chunk of timeseries or
+medications only depends on a few lookups: the visits, the admission heights
+and weights, the measurement concepts and the drug concepts. The chunks can
+then be written by worker processes, the lookups are broadcast to the
+workers once as Arrow IPC files that each worker memory-maps.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from omop_cdm import cdm
+from utils.time_utils import offsets_to_datetimes, times_of_day
+
+_worker_writer = None
+
+
+def _init_worker(broadcast_pth, params):
+    global _worker_writer
+    _worker_writer = OMOPChunkWriter.from_broadcast(broadcast_pth, **params)
+
+
+def _write_chunk(name, chunk_idx, pth_chunk):
+    return _worker_writer.write_chunk(name, chunk_idx, pth_chunk)
+
+
+def save_chunk(table, savedir, name, chunkindex, schema=None):
+    """
+    Saves a chunk of a table to {savedir}/{name}/{name}_{chunkindex}.parquet.
+    The table may be a DataFrame or a pyarrow Table, which is written through
+    a ParquetWriter without conversion.
+    Returns the path of the saved file.
+    """
+    savedir = f'{savedir}/{name}/'
+    Path(savedir).mkdir(exist_ok=True, parents=True)
+    savepath = f'{savedir}{name}_{chunkindex}.parquet'
+    print(f'Saving {savepath}')
+    if isinstance(table, pa.Table):
+        with pq.ParquetWriter(savepath, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        table.to_parquet(savepath, schema=schema)
+    return savepath
+
+
+class OMOPChunkWriter:
+    """
+    Builds and saves the chunks of the MEASUREMENT and DRUG_EXPOSURE tables.
+
+    lookups: dict of DataFrames
+        'visits': visit_occurrence_id, visit_start_date and person_id,
+            indexed by visit_source_value.
+        'admission_values': admission measurements of the labels, with a
+            'patient' column.
+        'measurement_lookup': measurement_concept_id, unit_concept_id and
+            unit_source_value, indexed by variable.
+        'drug_concepts': drug_concept_id, indexed by drug_source_value.
+    start_ids: first id of each table, eg. {'measurement': 5000000000}.
+
+    The ids of chunk i start at start_ids[table]+i*ids_per_chunk, so that
+    they are unique without coordination between the workers and do not
+    depend on the chunks that were skipped.
+    """
+    ids_per_chunk = 10**9
+    lookup_names = ['visits',
+                    'admission_values',
+                    'measurement_lookup',
+                    'drug_concepts']
+
+    def __init__(self,
+                 savedir,
+                 lookups,
+                 ts_measurements,
+                 ref_date,
+                 adm_measuredat,
+                 start_ids,
+                 measurement_schema,
+                 drug_exposure_schema):
+        self.savedir = savedir
+        self.lookups = lookups
+        self.ts_measurements = ts_measurements
+        self.ref_date = ref_date
+        self.adm_measuredat = adm_measuredat
+        self.start_ids = start_ids
+        self.measurement_schema = measurement_schema
+        self.drug_exposure_schema = drug_exposure_schema
+
+    def params(self):
+        """
+        Arguments of the writer besides the lookups.
+        """
+        return {'savedir': self.savedir,
+                'ts_measurements': self.ts_measurements,
+                'ref_date': self.ref_date,
+                'adm_measuredat': self.adm_measuredat,
+                'start_ids': self.start_ids,
+                'measurement_schema': self.measurement_schema,
+                'drug_exposure_schema': self.drug_exposure_schema}
+
+    def broadcast(self, pth):
+        """
+        Writes the lookups to Arrow IPC files in the directory pth.
+        Returns the arguments of from_broadcast.
+        """
+        for name in self.lookup_names:
+            table = pa.Table.from_pandas(self.lookups[name])
+            with pa.ipc.new_file(f'{pth}/{name}.arrow', table.schema) as writer:
+                writer.write_table(table)
+        return self.params()
+
+    @classmethod
+    def from_broadcast(cls, pth, **params):
+        lookups = {}
+        for name in cls.lookup_names:
+            with pa.memory_map(f'{pth}/{name}.arrow') as source:
+                lookups[name] = pa.ipc.open_file(source).read_all().to_pandas()
+        return cls(lookups=lookups, **params)
+
+    def first_id(self, name, chunk_idx):
+        return self.start_ids[name.lower()] + chunk_idx*self.ids_per_chunk
+
+    def measurement_chunk(self, chunk, first_id):
+        """
+        MEASUREMENT rows of a chunk of wide timeseries. The admission heights
+        and weights of the labels and the timeseries variables are melted to
+        a long table once, which is joined to the visits once. The rows are
+        ordered by variable, then as in the labels or in the chunk, their
+        measurement_ids start at first_id.
+        Returns a pyarrow Table with the measurement schema.
+        """
+        admission_values = self.lookups['admission_values']
+        admission_measurements = admission_values.columns.drop('patient').to_list()
+        admission_vals = (admission_values.loc[admission_values.patient.isin(chunk.patient.unique())]
+                          .melt(id_vars='patient',
+                                var_name='variable',
+                                value_name='value_as_number'))
+        admission_vals['time'] = self.adm_measuredat
+
+        ts_measurements = [v for v in self.ts_measurements if v in chunk.columns]
+        for varname in self.ts_measurements:
+            if varname not in chunk.columns:
+                print(f'Key {varname} not found')
+        ts_vals = (chunk.loc[:, ['time', 'patient', *ts_measurements]]
+                        .melt(id_vars=['time', 'patient'],
+                              var_name='variable',
+                              value_name='value_as_number')
+                        .dropna())
+
+        varnames = admission_measurements + ts_measurements
+        vals = pd.concat([admission_vals, ts_vals], ignore_index=True)
+
+        visits = self.lookups['visits']
+        visit_pos = visits.index.get_indexer(vals['patient'])
+        vals = vals.loc[visit_pos >= 0]
+        visit_pos = visit_pos[visit_pos >= 0]
+        vals['visit_source_value'] = vals['patient']
+        for col in visits.columns:
+            vals[col] = visits[col].array.take(visit_pos)
+
+        codes = pd.Categorical(vals['variable'], categories=varnames).codes
+        lookup = self.lookups['measurement_lookup'].loc[varnames]
+        for col in lookup.columns:
+            vals[col] = lookup[col].values[codes]
+
+        measurement_datetime = offsets_to_datetimes(self.ref_date, vals['time'], unit='s')
+        vals['measurement_datetime'] = measurement_datetime
+        vals['measurement_date'] = measurement_datetime.dt.normalize()
+        vals['measurement_source_value'] = vals['value_as_number']
+        vals['value_source_value'] = vals['value_as_number']
+        if len(vals) > self.ids_per_chunk:
+            raise ValueError(f'{len(vals)} measurements in a chunk, more than '
+                             f'the {self.ids_per_chunk} ids of a chunk.')
+        vals['measurement_id'] = np.arange(len(vals)) + first_id
+
+        time_field = self.measurement_schema.field('measurement_time')
+        schema = self.measurement_schema.remove(self.measurement_schema.get_field_index('measurement_time'))
+        vals = vals.reindex(columns=schema.names)
+        table = pa.Table.from_pandas(vals, schema=schema, preserve_index=False)
+
+        seconds = (measurement_datetime - measurement_datetime.dt.normalize()).dt.total_seconds()
+        measurement_time = pa.array(seconds.to_numpy().astype('int32')).cast(time_field.type)
+        return table.add_column(self.measurement_schema.get_field_index('measurement_time'),
+                                time_field,
+                                measurement_time)
+
+    def drug_exposure_chunk(self, chunk, first_id):
+        """
+        DRUG_EXPOSURE rows of a chunk of medications. The drug_exposure_ids
+        are first_id plus the position of the rows in the chunk.
+        """
+        visits = self.lookups['visits']
+        df = pd.DataFrame()
+        df['_patient'] = chunk.patient
+        df['drug_source_value'] = chunk['variable']
+        df['drug_type_concept_id'] = 43542358 # Physician administered drug (identified from EHR observation)
+        df['visit_occurrence_id'] = df['_patient'].map(visits['visit_occurrence_id'])
+        df['person_id'] = df['_patient'].map(visits['person_id'])
+
+        start = offsets_to_datetimes(self.ref_date, chunk['start'], unit='s')
+        end = offsets_to_datetimes(self.ref_date, chunk['end'], unit='s')
+        df['drug_exposure_start_date'] = start.dt.normalize()
+        df['drug_exposure_start_datetime'] = times_of_day(start)
+        df['drug_exposure_end_date'] = end.dt.normalize()
+        df['drug_exposure_end_datetime'] = times_of_day(end)
+        df['drug_concept_id'] = df['drug_source_value'].map(self.lookups['drug_concepts']['drug_concept_id'])
+        df = (df.drop(columns='_patient')
+                .dropna(subset='visit_occurrence_id'))
+        df['drug_exposure_id'] = first_id + df.index
+
+        template = cdm.tables['DRUG_EXPOSURE'].drop(columns=df.columns,
+                                                    errors='ignore')
+        return pd.concat([template, df]).set_index('drug_exposure_id')
+
+    def write_chunk(self, name, chunk_idx, pth_chunk):
+        """
+        Builds the chunk chunk_idx of the table name, 'MEASUREMENT' or
+        'DRUG_EXPOSURE', from the files pth_chunk and saves it.
+        Returns the path of the saved file.
+        """
+        chunk = pd.read_parquet(pth_chunk).reset_index()
+        first_id = self.first_id(name, chunk_idx)
+        if name == 'MEASUREMENT':
+            return save_chunk(self.measurement_chunk(chunk, first_id),
+                              self.savedir,
+                              name,
+                              chunk_idx)
+        if name == 'DRUG_EXPOSURE':
+            return save_chunk(self.drug_exposure_chunk(chunk, first_id),
+                              self.savedir,
+                              name,
+                              chunk_idx,
+                              schema=self.drug_exposure_schema)
+        raise ValueError(f'Unknown chunked table {name}')
@@ -1,15 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from datetime import datetime, timedelta
-import hashlib
+from datetime import datetime
+from tempfile import TemporaryDirectory
 import pandas as pd
 import numpy as np
 import pyarrow as pa
+from natsort import natsorted
 
+from blended_preprocessing import omop_chunks
+from blended_preprocessing.omop_chunks import OMOPChunkWriter, save_chunk
+from blended_preprocessing.omop_csv import CSV_SUFFIXES, export_chunks
 from blended_preprocessing.timeseries import blendedicuTSP
+from database_processing.chunkmanifest import ChunkManifest, fingerprint
+from database_processing.stagecache import cached_stage
 from omop_cdm import cdm
+from utils.id_utils import hash_ids
+from utils.time_utils import offsets_to_datetimes, times_of_day, years_to_datetimes
 
 
 class OMOP_converter(blendedicuTSP):
+    stage_config_keys = ['flat_hr_from_adm', 'TS_STORAGE']
+    chunked_tables = ['MEASUREMENT', 'DRUG_EXPOSURE']
+    admission_measurements = ['raw_height', 'raw_weight']
+    ts_measurements = [
+        'heart_rate', 'invasive_systolic_blood_pressure',
+        'invasive_diastolic_blood_pressure',
+        'invasive_mean_blood_pressure',
+        'noninvasive_systolic_blood_pressure',
+        'noninvasive_diastolic_blood_pressure',
+        'noninvasive_mean_blood_pressure',
+        'O2_pulseoxymetry_saturation', 'O2_arterial_saturation',
+        'lactate', 'blood_glucose', 'magnesium', 'sodium',
+        'creatinine', 'calcium', 'temperature', 'FiO2', 'hemoglobin',
+        'chloride', 'pH', 'paO2', 'paCO2', 'plateau_pressure',
+        'respiratory_rate_setting', 'tidal_volume_setting', 'potassium',
+        'PTT', 'bilirubine', 'alanine_aminotransferase',
+        'aspartate_aminotransferase', 'respiratory_rate', 'albumin',
+        'blood_urea_nitrogen', 'expiratory_tidal_volume',
+        'white_blood_cells', 'platelets', 'phosphate', 'bicarbonate',
+        'alkaline_phosphatase', 'PEEP', 'urine_output',
+        'glasgow_coma_score', 'glasgow_coma_score_eye',
+        'glasgow_coma_score_motor', 'glasgow_coma_score_verbal']
+
     def __init__(self,
                  initialize_tables=False,
                  parquet_format=True,
@@ -143,15 +175,16 @@ class OMOP_converter(blendedicuTSP):
         '''
         rglob lists all files, then sorts them and shuffle them with a seed 
         to make a reproducible unsorted order.
+        With TS_STORAGE='chunked', the files are chunks of patients.
         then paths are split into a list of chunks.
         '''
         ts_pths = self.rglob(self.data_pth+'formatted_timeseries/',
-                                         '*.parquet',
+                                         self.ts_file_pattern,
                                          verbose=True,
                                          sort=True,
                                          shuffleseed=shuffleseed)
         med_pths = self.rglob(self.data_pth+'formatted_medications/',
-                                          '*.parquet',
+                                          self.ts_file_pattern,
                                           verbose=True,
                                           sort=True,
                                           shuffleseed=shuffleseed)
@@ -163,10 +196,10 @@ class OMOP_converter(blendedicuTSP):
     def _measurement_schema(self):
         schema = pa.schema([('value_as_number', pa.float32()),
                             ('time', pa.float32()),
-                            ('visit_occurrence_id', pa.string()),
+                            ('visit_occurrence_id', pa.int64()),
                             ('visit_start_date', pa.date32()),
                             ('visit_source_value', pa.string()),
-                            ('person_id', pa.string()),
+                            ('person_id', pa.int64()),
                             ('measurement_datetime', pa.date64()),
                             ('measurement_date', pa.date32()),
                             ('measurement_time', pa.time32('s')),
@@ -174,7 +207,7 @@ class OMOP_converter(blendedicuTSP):
                             ('measurement_source_value', pa.float32()),
                             ('unit_source_value', pa.string()),
                             ('unit_concept_id', pa.int32()),
-                            ('measurement_id', pa.float32()),
+                            ('measurement_id', pa.int64()),
                             ('measurement_type_concept_id', pa.int32()),
                             ('operator_concept_id', pa.int32()),
                             ('value_as_concept_id', pa.int32()),
@@ -192,7 +225,7 @@ class OMOP_converter(blendedicuTSP):
     
     def _observation_schema(self):
         schema = pa.schema([('observation_id', pa.int32()),
-                            ('person_id', pa.string()),
+                            ('person_id', pa.int64()),
                             ('observation_concept_id', pa.int32()),
                             ('observation_date', pa.date32()),
                             ('observation_datetime', pa.time32('s')),
@@ -203,7 +236,7 @@ class OMOP_converter(blendedicuTSP):
                             ('qualifier_concept_id', pa.float32()),
                             ('unit_concept_id', pa.int32()),
                             ('provider_id', pa.float32()),
-                            ('visit_occurrence_id', pa.string()),
+                            ('visit_occurrence_id', pa.int64()),
                             ('visit_detail_id', pa.float32()),
                             ('observation_source_value', pa.float32()),
                             ('observation_source_concept_id', pa.int32()),
@@ -218,14 +251,14 @@ class OMOP_converter(blendedicuTSP):
     def _drug_exposure_schema(self):
         schema = pa.schema([('drug_source_value', pa.string()),
                             ('drug_type_concept_id', pa.int32()),
-                            ('visit_occurrence_id', pa.string()),
-                            ('person_id', pa.string()),
+                            ('visit_occurrence_id', pa.int64()),
+                            ('person_id', pa.int64()),
                             ('drug_exposure_start_date', pa.date32()),
-                            ('drug_exposure_start_datetime', pa.string()),
+                            ('drug_exposure_start_datetime', pa.time64('us')),
                             ('drug_exposure_end_date', pa.date32()),
-                            ('drug_exposure_end_datetime', pa.string()),
+                            ('drug_exposure_end_datetime', pa.time64('us')),
                             ('drug_concept_id', pa.int32()),
-                            ('drug_exposure_id', pa.int32()),
+                            ('drug_exposure_id', pa.int64()),
                             ('verbatim_end_date', pa.date32()),
                             ('stop_reason', pa.string()),
                             ('refills', pa.string()),
@@ -242,6 +275,33 @@ class OMOP_converter(blendedicuTSP):
                             ])
         return schema
         
+    def stage_inputs(self):
+        return [self.med_file,
+                self.user_input_pth,
+                self.aux_pth+'OMOP_vocabulary/CONCEPT.parquet',
+                self.data_pth+'preprocessed_labels.parquet',
+                self.formatted_ts_dirs['blended'],
+                self.formatted_med_dirs['blended']]
+
+    def stage_outputs(self, name):
+        if name == 'measurement_table':
+            return [f'{self.savedir}/MEASUREMENT/']
+        if name == 'drug_exposure_table':
+            return [f'{self.savedir}/DRUG_EXPOSURE/']
+        return [f'{self.savedir}/{table}.csv' for table in cdm.tables
+                if table not in self.chunked_tables]
+
+    def _table_manifest(self, name):
+        """
+        Manifest of the chunks of a table exported by chunks. It is discarded
+        when the configuration or the labels change.
+        """
+        config_hash = self.config_hash(name,
+                                       fingerprint(self.data_pth+'preprocessed_labels.parquet'))
+        return ChunkManifest(f'{self.savedir}/{name}/_chunk_manifest/',
+                             config_hash,
+                             output_dirs=[f'{self.savedir}/{name}/'])
+
     def _get_chunks(self, pths):
         return map(list, np.array_split(pths, self.n_chunks))
         
@@ -281,22 +341,22 @@ class OMOP_converter(blendedicuTSP):
 
     def _load_med(self):
         self.med_pths = self.rglob(self.data_pth+'formatted_medications',
-                                   '*.parquet')
+                                   self.ts_file_pattern)
         print(f'Loading med for {len(self.med_pths)} patients...')
         df = self.load(self.med_pths, verbose=False)
         print('   -> done')
         return df.reset_index()
 
-    def _hash_values(self, series, prefix):
+    def _id_mapper(self, hashed_series, prefix):
         '''
-        16 character should be more than enough for patients or visits.
+        Integer ids of the patients or visits, hashed from their source
+        values for all rows at once. The mapper has the nullable Int64 dtype
+        so that the ids of unknown values are mapped to <NA> without a cast
+        to float.
         '''
-        hashed = hashlib.md5(series.encode('utf-8')).hexdigest()[:16]
-        return prefix+'_'+hashed
-        
-    def _id_mapper(self, hashed_series, prefix):
-        return pd.Series(hashed_series.apply(self._hash_values, prefix=prefix).values,
-                         index=hashed_series)
+        return pd.Series(hash_ids(hashed_series, prefix=prefix),
+                         index=hashed_series.values,
+                         dtype='Int64')
     
     def person_table(self):
         print('Person table...')
@@ -305,10 +365,7 @@ class OMOP_converter(blendedicuTSP):
         person['gender_concept_id'] = person_labels.sex.map({1: 8507,
                                                                   0: 8532})
         person['year_of_birth'] = self.ref_date.year - person_labels['raw_age']
-        person['birth_datetime'] = (person.year_of_birth
-                                         .apply(lambda x: datetime(year=int(x),
-                                                                   month=1,
-                                                                   day=1)))
+        person['birth_datetime'] = years_to_datetimes(person.year_of_birth)
         person['person_source_value'] = person_labels.uniquepid
         person['gender_source_value'] = person_labels.sex
         person['location_id'] = (person_labels.source_dataset.map(
@@ -341,9 +398,11 @@ class OMOP_converter(blendedicuTSP):
                                                 .map(self.admission_origins)
                                                 .map(self.concept_mapping))
         visit_occurrence['admitted_from_source_value'] = self.labels.origin
-        visit_end_datetime = self.ref_date + self.labels.lengthofstay.apply(timedelta)
-        visit_occurrence['visit_end_date'] = visit_end_datetime.dt.date
-        visit_occurrence['visit_end_datetime'] = visit_end_datetime.dt.time
+        visit_end_datetime = offsets_to_datetimes(self.ref_date,
+                                                  self.labels.lengthofstay,
+                                                  unit='D')
+        visit_occurrence['visit_end_date'] = visit_end_datetime.dt.normalize()
+        visit_occurrence['visit_end_datetime'] = times_of_day(visit_end_datetime)
         visit_occurrence['person_id'] = visit_occurrence['_source_person_id'].map(self.person_id_mapper)
         visit_occurrence['discharged_to_source_value'] = self.labels.discharge_location
         visit_occurrence['discharged_to_concept_id'] = self.labels.discharge_location.map(self.concept_mapping)
@@ -367,112 +426,112 @@ class OMOP_converter(blendedicuTSP):
         self.death = cdm.tables['DEATH']
         self.death['person_id'] = self.death_labels.index.map(self.visit_occurrence.person_id)
         self.death.index = self.death_labels.index
-        death_datetimes = self.ref_date + self.death_labels.lengthofstay.apply(timedelta)
+        death_datetimes = offsets_to_datetimes(self.ref_date,
+                                               self.death_labels.lengthofstay,
+                                               unit='D')
 
-        self.death['death_date'] = death_datetimes.dt.date
-        self.death['death_datetime'] = death_datetimes.dt.time
+        self.death['death_date'] = death_datetimes.dt.normalize()
+        self.death['death_datetime'] = times_of_day(death_datetimes)
         self.death = (self.death
                       .reset_index(drop=True)
                       .drop_duplicates(subset='person_id'))
 
-    def _add_measurement(self, varname, timeseries=None, patients=[]):
-        self.ts = timeseries
-
-        print(f'collecting {varname}')
-        if timeseries is None:
-            keep_idx = self.labels.patient.isin(patients)
-            vals = self.labels.loc[keep_idx, ['patient', varname]]
-            vals['time'] = self.adm_measuredat
-        else:
-            try:
-                vals = timeseries.loc[:, ['time', 'patient', varname]].dropna()
-            except KeyError:
-                print(f'Key {varname} not found')
-                return self.measurement
-
-        vals = vals.rename(columns={varname: 'value_as_number'})
-        self.vals = vals
-        unit = self.concept.loc[self.unit_mapping[varname]]
-        if len(unit.shape) == 2:
-            # There may be several duplicate matches, in which case we convert
-            # the dataframe to series.
-            unit = unit.iloc[0]
-
-        vals = vals.merge(self.visit_occurrence[['visit_occurrence_id',
-                                                 'visit_start_date',
-                                                 'visit_source_value',
-                                                 'person_id']],
-                          left_on='patient',
-                          right_on='visit_source_value')
-
-        vals['measurement_datetime'] = (self.ref_date 
-                                        + vals['time'].apply(pd.Timedelta,
-                                                             unit='second')
-                                        ).astype('datetime64[ns]')
-        
-        vals['measurement_date'] = vals['measurement_datetime'].dt.date
-        vals['measurement_time'] = vals['measurement_datetime'].dt.time
-
-        vals['visit_occurrence_id'] = vals['visit_occurrence_id']
-        vals['measurement_concept_id'] = self.concept_mapping[varname]
-        vals['measurement_source_value'] = vals['value_as_number']
-        vals['unit_source_value'] = unit['concept_code']
-        vals['unit_concept_id'] = unit.name
-        vals = vals.drop(columns=['patient'])
-        return pd.concat([self.measurement, vals])
-
-
-    def measurement_table(self, start_chunk=0):
-        start_index = self.start_index['measurement']
-        self.admission_measurements = ['raw_height', 'raw_weight']
-        self.ts_measurements = [
-            'heart_rate', 'invasive_systolic_blood_pressure',
-            'invasive_diastolic_blood_pressure',
-            'invasive_mean_blood_pressure',
-            'noninvasive_systolic_blood_pressure',
-            'noninvasive_diastolic_blood_pressure',
-            'noninvasive_mean_blood_pressure',
-            'O2_pulseoxymetry_saturation', 'O2_arterial_saturation',
-            'lactate', 'blood_glucose', 'magnesium', 'sodium',
-            'creatinine', 'calcium', 'temperature', 'FiO2', 'hemoglobin',
-            'chloride', 'pH', 'paO2', 'paCO2', 'plateau_pressure',
-            'respiratory_rate_setting', 'tidal_volume_setting', 'potassium',
-            'PTT', 'bilirubine', 'alanine_aminotransferase',
-            'aspartate_aminotransferase', 'respiratory_rate', 'albumin',
-            'blood_urea_nitrogen', 'expiratory_tidal_volume',
-            'white_blood_cells', 'platelets', 'phosphate', 'bicarbonate',
-            'alkaline_phosphatase', 'PEEP', 'urine_output',
-            'glasgow_coma_score', 'glasgow_coma_score_eye',
-            'glasgow_coma_score_motor', 'glasgow_coma_score_verbal']
-
-        for i, pth_chunk in enumerate(self.ts_pths_chunks):
-            if i< start_chunk:
+    def _measurement_lookup(self, varnames):
+        """
+        Concept id, unit concept id and unit code of each variable, in the
+        order of varnames. The unit concept may have duplicate matches, the
+        first one is kept.
+        """
+        units = self.concept.loc[[self.unit_mapping[v] for v in varnames],
+                                 'concept_code']
+        units = units.groupby(level=0, sort=False).first()
+        unit_ids = np.array([self.unit_mapping[v] for v in varnames])
+        return pd.DataFrame({'measurement_concept_id': self.concept_mapping.reindex(varnames).values,
+                             'unit_concept_id': unit_ids,
+                             'unit_source_value': units.loc[unit_ids].values},
+                            index=varnames)
+
+    def _chunk_writer(self):
+        """
+        Writer of the MEASUREMENT and DRUG_EXPOSURE chunks, holding the
+        lookups built from the person and visit tables.
+        """
+        visits = (self.visit_occurrence[['visit_occurrence_id',
+                                         'visit_start_date',
+                                         'person_id']]
+                  .set_index(self.visit_occurrence['visit_source_value'])
+                  .astype({'visit_start_date': 'datetime64[ns]'}))
+        varnames = self.admission_measurements + self.ts_measurements
+        drug_concepts = (self.source_to_concept_mapping
+                         .rename_axis('drug_source_value')
+                         .to_frame('drug_concept_id'))
+        lookups = {'visits': visits,
+                   'admission_values': (self.labels[['patient', *self.admission_measurements]]
+                                        .reset_index(drop=True)),
+                   'measurement_lookup': self._measurement_lookup(varnames),
+                   'drug_concepts': drug_concepts}
+        return OMOPChunkWriter(self.savedir,
+                               lookups,
+                               ts_measurements=self.ts_measurements,
+                               ref_date=self.ref_date,
+                               adm_measuredat=self.adm_measuredat,
+                               start_ids=self.start_index,
+                               measurement_schema=self.measurement_schema,
+                               drug_exposure_schema=self.drug_exposure_schema)
+
+    def _export_chunks(self, name, pths_chunks, start_chunk=0):
+        """
+        Writes the chunks of the table name from the lists of files
+        pths_chunks. Chunks before start_chunk are skipped. With
+        RESUME_CHUNKS, the chunks that were completed by a previous run are
+        skipped as well.
+        Chunks are independent: if n_workers > 1 they are written by a pool
+        of processes, which receive the lookups of the chunk writer once
+        through memory-mapped Arrow files.
+        """
+        manifest = self._table_manifest(name)
+        pending_chunks = []
+        for i, pth_chunk in enumerate(pths_chunks):
+            inputs_hash = fingerprint(pth_chunk)
+            if i < start_chunk or (self.RESUME_CHUNKS
+                                   and manifest.is_done(i, inputs_hash)):
                 continue
-            print(f'Measurement chunk {i}/{self.n_chunks}')
-            self.measurement = cdm.tables['MEASUREMENT'].copy()
-            chunk = pd.read_parquet(pth_chunk).reset_index()
-            self.chunk = chunk
-
-            for varname in self.admission_measurements:
-                self.measurement = self._add_measurement(varname,
-                                                         patients=chunk.patient.unique())
-
-            for varname in self.ts_measurements:
-                self.measurement = self._add_measurement(varname,
-                                                         timeseries=chunk)
-
-            self.measurement['measurement_id'] = (np.arange(len(self.measurement)) + start_index).astype('float32')
-            start_index = start_index+self.start_index['measurement']
-
-            self.measurement['visit_start_date'] = pd.to_datetime(self.measurement['visit_start_date'])
-            self.measurement['measurement_date'] = pd.to_datetime(self.measurement['measurement_date'])
-            self.measurement['value_source_value'] = self.measurement['value_as_number']
-            self.export_table(self.measurement,
-                              'MEASUREMENT',
-                              mode='parquet',
-                              chunkindex=i,
-                              schema=self.measurement_schema)
-
+            pending_chunks.append((i, inputs_hash, pth_chunk))
+
+        writer = self._chunk_writer()
+        if self.n_workers == 1:
+            for i, inputs_hash, pth_chunk in pending_chunks:
+                manifest.start(i, inputs_hash)
+                print(f'{name} chunk {i}/{self.n_chunks}')
+                savepath = writer.write_chunk(name, i, pth_chunk)
+                manifest.done(i, inputs_hash, [savepath])
+            return
+
+        Path(self.savedir).mkdir(exist_ok=True, parents=True)
+        with TemporaryDirectory(prefix='_broadcast_', dir=self.savedir) as broadcast_pth:
+            params = writer.broadcast(broadcast_pth)
+            running = {}
+            with ProcessPoolExecutor(max_workers=self.n_workers,
+                                     initializer=omop_chunks._init_worker,
+                                     initargs=(broadcast_pth, params)) as executor:
+                for i, inputs_hash, pth_chunk in pending_chunks:
+                    manifest.start(i, inputs_hash)
+                    print(f'{name} chunk {i}/{self.n_chunks}')
+                    future = executor.submit(omop_chunks._write_chunk,
+                                             name,
+                                             i,
+                                             pth_chunk)
+                    running[future] = (i, inputs_hash)
+                for future in as_completed(running):
+                    manifest.done(*running[future], [future.result()])
+
+    @cached_stage
+    def measurement_table(self, start_chunk=0):
+        """
+        Chunks before start_chunk are skipped. With RESUME_CHUNKS, the chunks
+        that were completed by a previous run are skipped as well.
+        """
+        self._export_chunks('MEASUREMENT', self.ts_pths_chunks, start_chunk)
 
     def _add_observation(self, breaks, column, concept_id, unit_concept_id):
         obs = pd.DataFrame(columns=self.observation.columns)
@@ -521,56 +580,13 @@ class OMOP_converter(blendedicuTSP):
         self.observation['observation_date'] = pd.to_datetime(self.observation['observation_date'])
 
 
-    def _add_drugs(self, chunk):
-        df = pd.DataFrame()
-        df['_patient'] = chunk.patient
-        df['drug_source_value'] = chunk['variable']
-        df['drug_type_concept_id'] = 43542358 # Physician administered drug (identified from EHR observation)
-        df['visit_occurrence_id'] = df['_patient'].map(self.visit_mapper)
-        df['person_id'] = df['_patient'].map(self.person_id_mapper)
-        
-        delta_start = chunk['start'].apply(pd.Timedelta, unit='second')
-        delta_end = chunk['end'].apply(pd.Timedelta, unit='second')
-        df['_start'] = self.ref_date + delta_start
-        df['_end'] = self.ref_date + delta_end
-        df['drug_exposure_start_date'] = df._start.dt.date
-        df['drug_exposure_start_datetime'] = df._start.dt.time
-        df['drug_exposure_end_date'] = df._end.dt.date
-        df['drug_exposure_end_datetime'] = df._end.dt.time
-        df['drug_concept_id'] = df['drug_source_value'].map(self.source_to_concept_mapping)
-        df = (df.drop(columns=['_start', '_end'])
-                .dropna(subset='visit_occurrence_id'))
-        if len(self.drug_exposure)==0:
-            df['drug_exposure_id'] = self.start_index['drug_exposure'] + df.index
-        else:
-            df['drug_exposure_id'] = self.drug_exposure.index.max() + 1 + df.index
-        return pd.concat([self.drug_exposure, df]).set_index('drug_exposure_id')
-
-
+    @cached_stage
     def drug_exposure_table(self, start_chunk=0):
-        for i, pth_chunk in enumerate(self.med_pths_chunks):
-            if i < start_chunk:
-                continue
-            self.drug_exposure = cdm.tables['DRUG_EXPOSURE'].copy()
-            print(f'Drug exposure chunk {i}/{self.n_chunks}')
-            chunk = pd.read_parquet(pth_chunk).reset_index()
-            self.chunk = chunk
-            self.drug_exposure = (chunk.pipe(self._add_drugs)
-                                  .drop(columns='_patient'))
-            
-            self.drug_exposure['drug_exposure_start_date'] = pd.to_datetime(self.drug_exposure['drug_exposure_start_date'])
-            self.drug_exposure['drug_exposure_end_date'] = pd.to_datetime(self.drug_exposure['drug_exposure_end_date'])
-            self.drug_exposure['person_id'] = self.drug_exposure.visit_occurrence_id.map(self.visit_occurrence.person_id)
-            self.drug_exposure = self.drug_exposure.astype({
-                'drug_exposure_start_datetime': str,
-                'drug_exposure_end_datetime': str
-                })
-            
-            self.export_table(self.drug_exposure,
-                              'DRUG_EXPOSURE',
-                              mode='parquet',
-                              chunkindex=i,
-                              schema=self.drug_exposure_schema)
+        """
+        Chunks before start_chunk are skipped. With RESUME_CHUNKS, the chunks
+        that were completed by a previous run are skipped as well.
+        """
+        self._export_chunks('DRUG_EXPOSURE', self.med_pths_chunks, start_chunk)
 
     def care_site_table(self):
         print('Care_site table...')
@@ -764,27 +780,49 @@ class OMOP_converter(blendedicuTSP):
         * to csv file if mode is "w" or "a" with the corresponding mode.
         * to parquet if mode is "parquet". This mode requires to specify 
         a chunkindex for saving several parquet files in the same directory.
+        The table may be a DataFrame or a pyarrow Table, which is written
+        through a ParquetWriter without conversion.
+        Returns the path of the saved file.
         """
         if mode in ['w', 'a']:
             savepath = f'{self.savedir}/{name}.csv'
             print(f'Saving {savepath}')
             table.to_csv(savepath, sep=';', index=False, mode=mode)
         elif mode == 'parquet':
-            savedir = f'{self.savedir}/{name}/'
-            Path(savedir).mkdir(exist_ok=True, parents=True)
-            savepath = f'{savedir}{name}_{chunkindex}.parquet'
-            print(f'Saving {savepath}')
-            table.to_parquet(savepath, schema=schema)
+            savepath = save_chunk(table, self.savedir, name, chunkindex,
+                                  schema=schema)
+        return savepath
 
-    def export_tables(self):
+    def export_chunked_csv(self, name, compression='csv'):
+        """
+        Streams the parquet chunks of a table exported by chunks to a single
+        csv file, uncompressed or compressed with 'gzip' or 'zstd'. The chunks
+        are converted in parallel when n_workers > 1.
+        Returns the path of the saved file.
+        """
+        pths = natsorted(str(p) for p in Path(f'{self.savedir}/{name}/').glob(f'{name}_*.parquet'))
+        savepath = f'{self.savedir}/{name}{CSV_SUFFIXES[compression]}'
+        return export_chunks(pths,
+                             savepath,
+                             compression=compression,
+                             n_workers=self.n_workers)
+
+    @cached_stage
+    def export_tables(self, chunked_csv='none'):
         """
-        saves tables to csv, except the measurements and drug exposure tables
-        that are much larger and should be handled differently.
+        saves tables to csv. The measurements and drug exposure tables are
+        much larger, they are saved by chunks of parquet files.
+        chunked_csv: 'none' to only save the header of their csv files,
+            'csv', 'gzip' or 'zstd' to stream their parquet chunks to a csv
+            file, uncompressed or compressed.
         """
         Path(self.savedir).mkdir(exist_ok=True)
 
         for name, table in cdm.tables.items():
-            self.export_table(table, name)
+            if chunked_csv != 'none' and name in self.chunked_tables:
+                self.export_chunked_csv(name, compression=chunked_csv)
+            else:
+                self.export_table(table, name)
 
         self.export_table(self.concept.reset_index(), 'CONCEPT')
         self.export_table(self.death, 'DEATH')
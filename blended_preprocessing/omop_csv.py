@@ -0,0 +1,91 @@
+"""
+Streaming export of the OMOP tables saved by chunks of parquet files, such as
+MEASUREMENT and DRUG_EXPOSURE, to a single csv file.
+
+The parquet chunks are read by batches and written with the pyarrow csv
+writer, so that a table is never held in memory. The chunks are converted
+to csv parts in parallel, the parts are then appended to the output file in
+the order of the chunks. A gzip or zstd file made of concatenated compressed
+parts is a valid compressed file, so each part is compressed by its worker.
+"""
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+CSV_SUFFIXES = {'csv': '.csv',
+                'gzip': '.csv.gz',
+                'zstd': '.csv.zst'}
+
+
+def _open_output(pth, compression):
+    if compression == 'csv':
+        return pa.OSFile(str(pth), 'wb')
+    return pa.CompressedOutputStream(str(pth), compression)
+
+
+def write_csv(parquet_pth,
+              csv_pth,
+              compression='csv',
+              include_header=True,
+              delimiter=';',
+              batch_size=100_000):
+    """
+    Writes a parquet file to csv, batch_size rows at a time.
+    compression: 'csv' for an uncompressed file, 'gzip' or 'zstd'.
+    Returns csv_pth.
+    """
+    parquet_file = pq.ParquetFile(parquet_pth)
+    schema = parquet_file.schema_arrow.remove_metadata()
+    write_options = pcsv.WriteOptions(include_header=include_header,
+                                      delimiter=delimiter)
+    with _open_output(csv_pth, compression) as sink:
+        with pcsv.CSVWriter(sink, schema, write_options=write_options) as writer:
+            for batch in parquet_file.iter_batches(batch_size=batch_size):
+                writer.write_batch(batch)
+    return csv_pth
+
+
+def export_chunks(parquet_pths,
+                  savepath,
+                  compression='csv',
+                  n_workers=1,
+                  delimiter=';'):
+    """
+    Writes the parquet chunks of a table, in the order of parquet_pths, to
+    the csv file savepath. The header is written once, from the schema of
+    the first chunk, the chunks must have the same columns.
+    With n_workers > 1, the chunks are converted by a pool of processes.
+    """
+    if compression not in CSV_SUFFIXES:
+        raise ValueError(f'Unknown csv compression {compression}, expected '
+                         f'one of {list(CSV_SUFFIXES)}')
+    if not parquet_pths:
+        raise ValueError(f'No parquet chunk to export to {savepath}')
+    savepath = Path(savepath)
+    print(f'Saving {savepath}')
+    with TemporaryDirectory(prefix='_csv_parts_', dir=savepath.parent) as tmp_dir:
+        part_args = [(pth,
+                      f'{tmp_dir}/part_{i}',
+                      compression,
+                      i == 0,
+                      delimiter) for i, pth in enumerate(parquet_pths)]
+        if n_workers == 1:
+            part_pths = [write_csv(*args) for args in part_args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                part_pths = list(executor.map(write_csv, *zip(*part_args)))
+
+        tmp_pth = f'{tmp_dir}/{savepath.name}'
+        with open(tmp_pth, 'wb') as output:
+            for part_pth in part_pths:
+                with open(part_pth, 'rb') as part:
+                    shutil.copyfileobj(part, output)
+                os.remove(part_pth)
+        os.replace(tmp_pth, savepath)
+    return savepath
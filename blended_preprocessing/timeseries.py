@@ -1,15 +1,27 @@
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 
+from database_processing.chunkmanifest import fingerprint
+from database_processing.stagecache import cached_stage
 from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
+from utils.profiling import traced
 
 np.random.seed(974)
 
 
 class blendedicuTSP(TimeseriesPreprocessing):
+    stage_config_keys = ['TS_CLIP',
+                         'TS_NORMALIZE',
+                         'FORWARD_FILL',
+                         'TS_FILL_MEDIAN',
+                         'TS_STORAGE']
+
     def __init__(self):
         super().__init__(dataset='blended')
+        self.chunk_output_dirs = [self.preprocessed_ts_dir]
+        self.manifest_pth = self.preprocessed_ts_dir+'_chunk_manifest/'
         self.partially_processed_pths = self._get_ts_pths()
         self.labels = self.load(self.savepath+'preprocessed_labels.parquet')
 
@@ -17,6 +29,15 @@ class blendedicuTSP(TimeseriesPreprocessing):
                                   + self.labels.index
                                   + '.parquet')
 
+    def stage_inputs(self):
+        return ([self.med_file,
+                 self.user_input_pth,
+                 self.savepath+'preprocessed_labels.parquet']
+                + [self.partiallyprocessed_ts_dirs[d] for d in self.datasets])
+
+    def stage_outputs(self, name):
+        return [self.preprocessed_ts_dir]
+
     def _get_ts_pths(self):
         dirname = 'partially_processed_timeseries'
         return {d: Path(f'{self.pth_dic[d]}/{dirname}').iterdir()
@@ -27,20 +48,66 @@ class blendedicuTSP(TimeseriesPreprocessing):
                     .ts_path.to_list())
         return map(list, np.array_split(pths, 1+len(pths)/1000))
 
+    def _make_patient_chunks(self):
+        """
+        With TS_STORAGE='chunked', chunks are made of patients instead of 
+        paths. Each chunk is a subset of the patient index of the 
+        partially processed timeseries.
+        """
+        patient_index = pd.concat([self.patient_index(self.partiallyprocessed_ts_dirs[d])
+                                   for d in self.datasets])
+        patients = (self.labels.sample(frac=1, random_state=self.SEED)
+                               .index
+                               .intersection(patient_index.index, sort=False))
+        patient_index = patient_index.loc[patients]
+        return (patient_index.iloc[idx] for idx in 
+                np.array_split(np.arange(len(patient_index)),
+                               1+len(patient_index)/1000))
+
+    def _chunk_fingerprint(self, chunk):
+        if self.TS_STORAGE == 'chunked':
+            return fingerprint([chunk, chunk.file.unique().tolist()])
+        return fingerprint(chunk)
+
+    def _load_chunk(self, chunk):
+        if self.TS_STORAGE == 'chunked':
+            return self.load_patients(chunk)
+        return self.load(chunk)
+
+    @cached_stage
     def run(self):
         """
         Applies the processing pipeline to the 'partially_processed_timeseries'
         files. These files are already resampled 
+        The completed chunks are recorded in the chunk manifest, with
+        RESUME_CHUNKS they are skipped when the run is restarted. The first
+        chunk is always processed, its quantiles are used to clip and
+        normalize all chunks.
         """
         scalecols = [c for c in self.numeric_ts if c not in ['time', 'hour']]
 
         self.reset_dir()
 
-        self.pth_chunks = self._make_pth_chunks()
+        if self.TS_STORAGE == 'chunked':
+            self.pth_chunks = self._make_patient_chunks()
+        else:
+            self.pth_chunks = self._make_pth_chunks()
+
+        manifest = self.chunk_manifest()
+        if self.RESUME_CHUNKS and manifest.completed():
+            manifest.clean()
 
-        for i, pths in enumerate(self.pth_chunks):
+        for i, chunk in enumerate(self.pth_chunks):
             comp_quantiles = i == 0
-            self.timeseries = self.load(pths)
+            inputs_hash = self._chunk_fingerprint(chunk)
+            if (self.RESUME_CHUNKS and not comp_quantiles
+                    and manifest.is_done(i, inputs_hash)):
+                print(f'Chunk {i} already processed, skipping.')
+                continue
+            manifest.start(i, inputs_hash)
+            self.written_pths = []
+            self.profiler.chunk = i
+            self.timeseries = self._load_chunk(chunk)
             timeseries = self.timeseries.loc[:, self.cols.index]
 
             timeseries = (timeseries.pipe(self.clip_and_norm,
@@ -54,7 +121,9 @@ class blendedicuTSP(TimeseriesPreprocessing):
                                     .reset_index())
 
             self.save_timeseries(timeseries, self.preprocessed_ts_dir)
+            manifest.done(i, inputs_hash, self.written_pths)
 
+    @traced
     def _time_to_hours(self, timeseries):
         """
         The time column is initially in seconds.
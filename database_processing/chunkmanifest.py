@@ -0,0 +1,157 @@
+"""
+Manifest of the chunks processed by a stage of the pipeline, used to resume
+an interrupted run.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+def _update(digest, obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        if isinstance(obj, pd.DataFrame):
+            digest.update(repr(obj.columns.to_list()).encode())
+        digest.update(pd.util.hash_pandas_object(obj).values.tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
+            digest.update(repr(key).encode())
+            _update(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _update(digest, value)
+    elif isinstance(obj, (str, Path)) and Path(obj).is_file():
+        stat = Path(obj).stat()
+        digest.update(f'{obj}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    else:
+        digest.update(repr(obj).encode())
+
+
+def fingerprint(obj):
+    """
+    Hash of the inputs of a chunk. DataFrames are hashed by content, paths
+    of existing files by their size and modification time, nested lists and
+    dicts are hashed recursively.
+    """
+    digest = hashlib.sha1()
+    _update(digest, obj)
+    return digest.hexdigest()
+
+
+def is_bookkeeping(pth, root):
+    """
+    Whether a path under root is bookkeeping rather than an output, ie.
+    whether its name or one of its directories below root starts with '_',
+    such as the chunk manifests or the patient indexes.
+    """
+    return any(part.startswith('_')
+               for part in Path(pth).relative_to(root).parts)
+
+
+class ChunkManifest:
+    """
+    Records the chunks completed by a stage in a directory with a small json
+    record per chunk, {chunk_id}.json:
+    {'config': config_hash, 'inputs': hash, 'outputs': [...], 'status': 'done'}
+    Only the record of a chunk is rewritten, atomically, when the chunk
+    starts and when it is done. The records written with another
+    configuration are ignored.
+
+    pth: directory of the chunk records.
+    config_hash: hash of the parameters of the stage.
+    output_dirs: directories written by the stage. The files that were not
+        written by a completed chunk are removed by clean().
+    """
+    def __init__(self, pth, config_hash, output_dirs=()):
+        self.pth = Path(pth)
+        self.config_hash = config_hash
+        self.output_dirs = [Path(d) for d in output_dirs]
+        self.chunks = self._read()
+        self._listings = {}
+
+    def _read(self):
+        chunks = {}
+        for record_pth in self.pth.glob('*.json'):
+            try:
+                with open(record_pth) as file:
+                    record = json.load(file)
+            except json.JSONDecodeError:
+                continue
+            if record.get('config') == self.config_hash:
+                chunks[record_pth.stem] = record
+        return chunks
+
+    def _write(self, chunk_id):
+        self.pth.mkdir(parents=True, exist_ok=True)
+        record_pth = self.pth/f'{chunk_id}.json'
+        tmp_pth = self.pth/f'_{chunk_id}.json.tmp'
+        with open(tmp_pth, 'w') as file:
+            json.dump({'config': self.config_hash, **self.chunks[str(chunk_id)]},
+                      file)
+        os.replace(tmp_pth, record_pth)
+
+    def _exists(self, pth):
+        """
+        Whether a file exists, from a listing of its directory made once
+        instead of a stat per file.
+        """
+        pth = Path(pth)
+        if pth.parent not in self._listings:
+            try:
+                self._listings[pth.parent] = set(os.listdir(pth.parent))
+            except FileNotFoundError:
+                self._listings[pth.parent] = set()
+        return pth.name in self._listings[pth.parent]
+
+    def completed(self):
+        return [c for c, chunk in self.chunks.items()
+                if chunk['status'] == 'done']
+
+    def is_done(self, chunk_id, inputs_hash):
+        chunk = self.chunks.get(str(chunk_id))
+        return (chunk is not None
+                and chunk['status'] == 'done'
+                and chunk['inputs'] == inputs_hash
+                and all(self._exists(p) for p in chunk['outputs']))
+
+    def start(self, chunk_id, inputs_hash):
+        """
+        Removes the outputs of a previous run of the chunk, which may have
+        been computed from other inputs.
+        """
+        previous = self.chunks.get(str(chunk_id))
+        if previous is not None:
+            for pth in previous['outputs']:
+                Path(pth).unlink(missing_ok=True)
+        self.chunks[str(chunk_id)] = {'inputs': inputs_hash,
+                                      'outputs': [],
+                                      'status': 'running'}
+        self._write(chunk_id)
+
+    def done(self, chunk_id, inputs_hash, outputs):
+        self.chunks[str(chunk_id)] = {'inputs': inputs_hash,
+                                      'outputs': sorted(str(Path(p)) for p in outputs),
+                                      'status': 'done'}
+        self._write(chunk_id)
+
+    def clean(self):
+        """
+        Removes the files of the output directories that were not written by
+        a completed chunk, eg. the half-written outputs of an interrupted run.
+        The bookkeeping files, such as the manifest or the patient indexes,
+        are kept.
+        """
+        kept = {p for c in self.completed() for p in self.chunks[c]['outputs']}
+        n_removed = 0
+        for output_dir in self.output_dirs:
+            for pth in output_dir.rglob('*'):
+                if (pth.is_file()
+                        and not is_bookkeeping(pth, output_dir)
+                        and str(pth) not in kept):
+                    pth.unlink()
+                    n_removed += 1
+        self._listings = {}
+        if n_removed:
+            print(f'   removed {n_removed} files of incomplete chunks')
@@ -1,22 +1,106 @@
 from pathlib import Path
 
 from database_processing.dataprocessor import DataProcessor
+from database_processing import sourcecache, sourcereader
+from utils.profiling import traced
 
 
 class DataPreparator(DataProcessor):
+    stage_config_keys = ['preadm_anteriority',
+                         'drug_exposure_time',
+                         'flat_hr_from_adm']
+    # csv tables converted by build_source_cache: {path attribute: column
+    # of the icu stays, by which the table is sorted}
+    source_tables = {}
+    source_encoding = 'utf8'
+
     def __init__(self, dataset, col_stayid):
         super().__init__(dataset)
         self.col_stayid = col_stayid
 
         self.chunksize = 10_000_000  # chunksize in csv reader
+        self.source_cache_pth = f'{self.parquet_pth}source_cache/'
         self.inch_to_cm = 2.54
         self.lbs_to_kg = 0.454
-
+        # files and chunk directories written by each extraction step, set by
+        # the subclasses: {step: [paths]}
+        self.step_outputs = {}
+
+    def stage_inputs(self):
+        if self.source_pth is None:
+            return super().stage_inputs()
+        return super().stage_inputs() + [self.source_pth]
+
+    def stage_outputs(self, name):
+        """
+        Files written by an extraction step, the step is run again when one
+        of them is missing.
+        """
+        if name == 'build_source_cache':
+            if not self.SOURCE_CACHE:
+                return []
+            return [self._source_cache_path(getattr(self, attribute))
+                    for attribute in self.source_tables]
+        if name not in self.step_outputs:
+            raise ValueError(f'The outputs of the extraction step {name} of '
+                             f'{type(self).__name__} are not declared in '
+                             'step_outputs.')
+        return self.step_outputs[name]
+
+    def _source_cache_path(self, pth):
+        return f'{self.source_cache_pth}{Path(pth).name.split(".")[0]}.parquet'
+
+    def build_source_cache(self):
+        """
+        Converts the csv tables of source_tables to parquet, sorted by icu
+        stay. The conversion is done once, a table is only converted again
+        when its csv file changes.
+        """
+        if not self.SOURCE_CACHE:
+            return
+        for attribute, sort_col in self.source_tables.items():
+            csv_pth = getattr(self, attribute)
+            cache_pth = self._source_cache_path(csv_pth)
+            if sourcecache.is_current(csv_pth, cache_pth):
+                print(f'{cache_pth} is up to date.')
+                continue
+            Path(self.source_cache_pth).mkdir(exist_ok=True, parents=True)
+            sourcecache.convert_table(csv_pth,
+                                      cache_pth,
+                                      sort_col,
+                                      encoding=self.source_encoding,
+                                      chunk_rows=self.chunksize)
+
+    def read_table(self, pth, columns=None, chunk_rows=None, filters=None):
+        """
+        Reads a csv table of the source database with pyarrow, see
+        sourcereader.read_table. Returns an iterator of DataFrames of
+        chunk_rows rows if chunk_rows is set.
+        The parquet table converted by build_source_cache is read instead
+        when it is up to date, the filters are then pushed down to the
+        parquet reader.
+        """
+        cache_pth = self._source_cache_path(pth)
+        if self.SOURCE_CACHE and sourcecache.is_current(pth, cache_pth):
+            print(f'Reading {cache_pth}')
+            return sourcecache.scan_table(cache_pth,
+                                          columns=columns,
+                                          chunk_rows=chunk_rows,
+                                          filters=filters)
+        print(f'Reading {pth}')
+        return sourcereader.read_table(pth,
+                                       columns=columns,
+                                       chunk_rows=chunk_rows,
+                                       encoding=self.source_encoding,
+                                       filters=filters)
+
+    @traced
     def _clip_time(self, df, col_offset='resultoffset'):
         idx = ((df[col_offset] < df[self.col_los])
                & (df[col_offset] > -self.preadm_anteriority*24*3600))
         return df.loc[idx].drop(columns=self.col_los)
 
+    @traced
     def _keepvars(self, df, col_variable, keepvars=None):
         if keepvars is None:
             return df
@@ -30,6 +114,7 @@ class DataPreparator(DataProcessor):
 
         self.stays = self.labels[self.col_stayid].unique()
 
+    @traced
     def _to_seconds(self, df, col, unit='second'):
         k = {'day': 86400,
              'hour': 3600,
@@ -57,6 +142,7 @@ class DataPreparator(DataProcessor):
         self.save(chunk, chunk_savepath)
         self.chunk_idx += 1
 
+    @traced
     def prepare_tstable(self,
                         table,
                         col_offset,
@@ -1,5 +1,6 @@
 from pathlib import Path
 from functools import reduce
+import hashlib
 import operator
 import json
 import shutil
@@ -8,13 +9,28 @@ import random
 
 import natsort
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from database_processing import sourcereader
+from database_processing.stagecache import (StageCache,
+                                            code_fingerprint,
+                                            inputs_fingerprint)
+from utils.profiling import Profiler, traced
 
 
 class DataProcessor:
+    # parameters of config.json read by the stages of the class, see
+    # run_stage.
+    stage_config_keys = []
+
     def __init__(self, dataset):
         self.dataset = dataset
         self.SEED = 974
         self.n_patient_chunk = 1000
+        self.n_patient_row_group = 50
+        self.n_rows_row_group = 100_000
         self.pth_dic = self._read_json('paths.json')
         self.config = self._read_json('config.json')
 
@@ -73,6 +89,20 @@ class DataProcessor:
         self.FLAT_NORMALIZE = self.config['FLAT_NORMALIZE']['value']
         self.FLAT_CLIP = self.config['FLAT_CLIP']['value']
         self.FORWARD_FILL = self.config['FORWARD_FILL']['value']
+        self.TS_MASK_FORMAT = self.config['TS_MASK_FORMAT']['value']
+        self.N_WORKERS = self.config['N_WORKERS']['value']
+        self.TS_STORAGE = self.config['TS_STORAGE']['value']
+        self.RESUME_CHUNKS = self.config['RESUME_CHUNKS']['value']
+        self.STAGE_CACHE = self.config['STAGE_CACHE']['value']
+        self.SOURCE_CACHE = self.config['SOURCE_CACHE']['value']
+        self.OMOP_CSV = self.config['OMOP_CSV']['value']
+        if self.TS_STORAGE not in ('patient_files', 'chunked'):
+            raise ValueError('TS_STORAGE should be "patient_files" or '
+                             f'"chunked", got {self.TS_STORAGE}')
+        self.ts_file_pattern = ('chunk_*.parquet' if self.TS_STORAGE == 'chunked'
+                                else '*.parquet')
+        self.profiler = Profiler(self.config['PROFILE']['value'],
+                                 dataset=self.dataset)
 
         self.admission_origins = self._load_mapping(self.admissionorigin_file)
         self.discharge_locations = self._load_mapping(self.dischargeloc_file)
@@ -96,6 +126,73 @@ class DataProcessor:
             df_list = self._concat(*df_list[:2]) + df_list[2:]
         return df_list[0]
 
+    def config_hash(self, *extra):
+        """
+        Hash of the configuration parameters that change the outputs of the
+        processing, and of extra strings, eg. the content of input files.
+        """
+        ignored = ['N_WORKERS', 'PROFILE', 'RESUME_CHUNKS', 'STAGE_CACHE',
+                   'SOURCE_CACHE', 'OMOP_CSV']
+        config = {k: v['value'] for k, v in self.config.items()
+                  if k not in ignored}
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+        for value in extra:
+            digest.update(str(value).encode())
+        return digest.hexdigest()
+
+    def stage_inputs(self):
+        """
+        Files and directories read by the stages of the class.
+        """
+        return [self.med_file, self.user_input_pth]
+
+    def stage_outputs(self, name):
+        """
+        Files and directories written by the stage.
+        """
+        return []
+
+    def load_stage_outputs(self, name):
+        """
+        Result of a stage skipped by run_stage, loaded from its outputs.
+        Most stages are only run for the files they write and return None
+        when they are skipped, the stages whose result is used by the caller
+        override this method to load it.
+        """
+        return None
+
+    def stage_cache(self, name, *args, **kwargs):
+        """
+        Cache of a stage, keyed on the config.json parameters listed in
+        stage_config_keys, the files of stage_inputs(), the code of the class
+        and the arguments of the stage.
+        """
+        config = {k: self.config[k]['value'] for k in self.stage_config_keys}
+        stage = f'{type(self).__name__}.{name}'
+        digest = hashlib.sha1(json.dumps([stage, config], sort_keys=True).encode())
+        digest.update(repr((args, sorted(kwargs.items()))).encode())
+        digest.update(code_fingerprint(type(self)).encode())
+        digest.update(inputs_fingerprint(self.stage_inputs()).encode())
+        return StageCache(f'{self.savepath}_stage_cache/{stage}.json',
+                          digest.hexdigest(),
+                          outputs=self.stage_outputs(name))
+
+    def run_stage(self, name, func, *args, **kwargs):
+        """
+        Runs a stage of the pipeline unless, with STAGE_CACHE, its outputs
+        are up to date. A skipped stage returns load_stage_outputs(name).
+        """
+        if not self.STAGE_CACHE:
+            return func(*args, **kwargs)
+        cache = self.stage_cache(name, *args, **kwargs)
+        if cache.is_valid():
+            print(f'{type(self).__name__}.{name} is up to date, skipping.')
+            return self.load_stage_outputs(name)
+        cache.invalidate()
+        result = func(*args, **kwargs)
+        cache.validate()
+        return result
+
     def _med_concept_id_mapping(self):
         dic = {ing: m['blended'] for ing, m in self.ohdsi_med.items()}
         return pd.Series(dic)
@@ -107,23 +204,47 @@ class DataProcessor:
         
         with open(pth, 'r', encoding=encoding) as file:
             return json.load(file)
-            
-    def load(self, pth, verbose=True, **kwargs):
+
+    @traced
+    def load(self, pth, verbose=True, columns=None, filters=None, **kwargs):
         """
         alias for pd.read_parquet
+        columns: columns to read, all columns if None.
+        filters: rows to read, in the format of pd.read_parquet, eg. a list
+            of patients, of variables or a time range:
+            [('admissionid', 'in', chunk_ids), ('measuredat', '<', end)].
+            The filters are pushed down to the pyarrow dataset scan, which
+            skips the row groups whose statistics do not match. When the
+            file was saved sorted by patient (see save), loading a chunk of
+            patients only reads their row groups.
         """
         if verbose:
             print(f'Loading {pth}')
-        return pd.read_parquet(pth, **kwargs)
+        return pd.read_parquet(pth,
+                               columns=columns,
+                               filters=sourcereader.with_bounds(filters),
+                               **kwargs)
 
-    def save(self, df, savepath, pyarrow_schema=None):
+    @traced
+    def save(self, df, savepath, pyarrow_schema=None, sort_by=None):
         """
         convenience function: save safely a file to parquet by creating the 
         parent directory if it does not exist.
+        sort_by: if specified, the rows are sorted on this column, eg. the
+            patient ids, and written in row groups of self.n_rows_row_group
+            rows so that the filtered loads only read a few row groups.
         """
         Path(savepath).parents[0].mkdir(parents=True, exist_ok=True)
         print(f'   saving {savepath}')
-        df.to_parquet(savepath, schema=pyarrow_schema)
+        if sort_by is None:
+            df.to_parquet(savepath, schema=pyarrow_schema)
+            return df
+        df = df.sort_values(sort_by,
+                            kind='stable',
+                            ignore_index=isinstance(df.index, pd.RangeIndex))
+        df.to_parquet(savepath,
+                      schema=pyarrow_schema,
+                      row_group_size=self.n_rows_row_group)
         return df
 
     def rmdir(self, pth):
@@ -163,6 +284,66 @@ class DataProcessor:
             pth_preprocessed_ts.mkdir(parents=True)
             pth_partprocessed_ts.mkdir(parents=True)
 
+    def patient_index(self, ts_dir):
+        """
+        Index of a timeseries directory written with TS_STORAGE='chunked'.
+        Returns a DataFrame indexed by patient, with the 'file' and 
+        'row_group' where the data of each patient is stored.
+        The index is built by reading the patient column of the chunk files.
+        It is cached in the directory until a chunk file is added or modified.
+        """
+        index_pth = Path(ts_dir, '_patient_index.parquet')
+        chunk_pths = sorted(map(str, Path(ts_dir).glob('chunk_*.parquet')))
+        if index_pth.exists():
+            index = pd.read_parquet(index_pth)
+            index_mtime = index_pth.stat().st_mtime
+            up_to_date = all(Path(pth).stat().st_mtime <= index_mtime
+                             for pth in chunk_pths)
+            if up_to_date and set(index.file) == set(chunk_pths):
+                return index
+
+        row_groups = []
+        for pth in chunk_pths:
+            parquet_file = pq.ParquetFile(pth)
+            for row_group in range(parquet_file.num_row_groups):
+                patients = (parquet_file.read_row_group(row_group,
+                                                        columns=[self.idx_col])
+                                        .column(self.idx_col)
+                                        .unique()
+                                        .to_pylist())
+                row_groups.append(pd.DataFrame({'file': pth,
+                                                'row_group': row_group},
+                                               index=pd.Index(patients, name=self.idx_col)))
+
+        if not row_groups:
+            return pd.DataFrame(columns=['file', 'row_group'],
+                                index=pd.Index([], name=self.idx_col))
+        index = pd.concat(row_groups)
+        index.to_parquet(index_pth)
+        return index
+
+    @traced
+    def load_patients(self, patient_index, columns=None, verbose=True):
+        """
+        Loads the timeseries of the patients in patient_index, a subset of
+        the output of self.patient_index. The files are opened once, only 
+        the row groups containing the requested patients are read.
+        """
+        if verbose:
+            print(f'Loading {len(patient_index)} patients')
+        dfs = []
+        for pth, rows in patient_index.groupby('file', sort=False):
+            table = (pq.ParquetFile(pth)
+                       .read_row_groups(sorted(rows.row_group.unique()),
+                                        columns=columns,
+                                        use_pandas_metadata=True))
+            is_requested = pc.is_in(table.column(self.idx_col),
+                                    value_set=pa.array(rows.index))
+            dfs.append(table.filter(is_requested).to_pandas())
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs)
+
     def _load_mapping(self, pth):
         """
         Loads the mappings from the user_input folder, and converts them to 
@@ -187,6 +368,7 @@ class DataProcessor:
     def reset_chunk_idx(self):
         self.chunk_idx = 0
 
+    @traced
     def compute_offset(self, df, col_measuretime, col_intime):
         """
         Some databases are already "offset" based: admission is taken as the 
@@ -228,6 +410,7 @@ class DataProcessor:
 
         self.clipping_quantiles = mins, meds, maxs
 
+    @traced
     def clip_and_norm(self,
                       df,
                       cols=None,
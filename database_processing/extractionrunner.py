@@ -0,0 +1,86 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
+
+
+def _run_step(preparator, preparator_kwargs, step):
+    """
+    Runs one extraction step in a worker process. Each worker builds its own
+    preparator, the steps communicate only through the files they save.
+    """
+    prep = preparator(**preparator_kwargs)
+    prep.run_stage(step, getattr(prep, step))
+    return step
+
+
+class ExtractionRunner:
+    """
+    Runs the extraction steps of a DataPreparator subclass.
+    The steps and their dependencies are read from the extraction_steps
+    attribute of the preparator, eg. {'gen_labels': [],
+                                      'gen_flat': ['gen_labels']}
+    Steps whose dependencies are done are run in a pool of n_workers
+    processes. With n_workers=1, the steps are run one after another by a
+    single preparator, in the order of extraction_steps.
+    With STAGE_CACHE, the steps whose inputs did not change since their last
+    run are skipped.
+    """
+    def __init__(self, preparator, n_workers=None, **preparator_kwargs):
+        self.preparator = preparator
+        self.preparator_kwargs = preparator_kwargs
+        self.steps = preparator.extraction_steps
+        if n_workers is None:
+            with open('config.json', 'r') as file:
+                n_workers = json.load(file)['N_WORKERS']['value']
+        self.n_workers = max(1, int(n_workers))
+        self._check_graph()
+
+    def _check_graph(self):
+        for step, dependencies in self.steps.items():
+            unknown = set(dependencies) - set(self.steps)
+            if unknown:
+                raise ValueError(f'{step} depends on unknown steps {unknown}')
+        pending = set(self.steps)
+        done = set()
+        while pending:
+            ready = self._ready_steps(done, done)
+            if not ready:
+                raise ValueError(f'Cyclic dependencies between {pending}')
+            done |= set(ready)
+            pending -= set(ready)
+
+    def _ready_steps(self, done, submitted):
+        return [step for step, dependencies in self.steps.items()
+                if step not in submitted and set(dependencies) <= done]
+
+    def run(self):
+        if self.n_workers == 1:
+            return self._run_sequential()
+        return self._run_parallel()
+
+    def _run_sequential(self):
+        prep = self.preparator(**self.preparator_kwargs)
+        done = set()
+        while len(done) < len(self.steps):
+            step = self._ready_steps(done, done)[0]
+            prep.run_stage(step, getattr(prep, step))
+            done.add(step)
+
+    def _run_parallel(self):
+        done = set()
+        submitted = set()
+        running = set()
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            while len(done) < len(self.steps):
+                for step in self._ready_steps(done, submitted):
+                    print(f'Starting {step}')
+                    running.add(executor.submit(_run_step,
+                                                self.preparator,
+                                                self.preparator_kwargs,
+                                                step))
+                    submitted.add(step)
+
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = future.result()
+                    print(f'Finished {step}')
+                    done.add(step)
@@ -3,9 +3,12 @@ from pathlib import Path
 import pandas as pd
 
 from database_processing.dataprocessor import DataProcessor
+from database_processing.stagecache import cached_stage
 
 
 class FlatAndLabelsProcessor(DataProcessor):
+    stage_config_keys = ['upper_los', 'TS_STORAGE']
+
     def __init__(self,
                  dataset):
         super().__init__(dataset)
@@ -61,7 +64,10 @@ class FlatAndLabelsProcessor(DataProcessor):
         """
         preprocessed_ts_dir = Path(self.savepath+'partially_processed_timeseries/')
         preprocessed_ts_dir.mkdir(exist_ok=True, parents=True)
-        stems = [f.stem for f in Path(preprocessed_ts_dir).iterdir()]
+        if self.TS_STORAGE == 'chunked':
+            stems = self.patient_index(preprocessed_ts_dir).index.to_list()
+        else:
+            stems = [f.stem for f in Path(preprocessed_ts_dir).glob('*.parquet')]
         try:
             ts_patients = pd.to_numeric(stems, downcast='integer')
         except ValueError:
@@ -75,6 +81,29 @@ class FlatAndLabelsProcessor(DataProcessor):
                   .astype(astypes)
                   .dropna(how='all'))
 
+    def stage_inputs(self):
+        return super().stage_inputs() + [self.parquet_pth,
+                                         self.partiallyprocessed_ts_dir]
+
+    def stage_outputs(self, name):
+        if name == 'run_flat_and_labels':
+            return [f'{self.savepath}preprocessed_flat.parquet',
+                    f'{self.savepath}preprocessed_labels.parquet']
+        return [f'{self.savepath}preprocessed_labels.parquet']
+
+    def load_stage_outputs(self, name):
+        """
+        Loads the labels, and the flat features for run_flat_and_labels,
+        saved by a previous run so that a skipped stage sets the same
+        attributes and returns the same values as when it is run.
+        """
+        self.labels = self.load(f'{self.savepath}preprocessed_labels.parquet')
+        if name == 'run_flat_and_labels':
+            self.flat = self.load(f'{self.savepath}preprocessed_flat.parquet')
+            return self.flat, self.labels
+        return self.labels
+
+    @cached_stage
     def run_labels(self):
         self.labels = self.preprocess_labels()
         
@@ -86,6 +115,7 @@ class FlatAndLabelsProcessor(DataProcessor):
         self.save(self.labels, f'{self.savepath}preprocessed_labels.parquet')
         return self.labels
         
+    @cached_stage
     def run_flat_and_labels(self):        
         self.labels, self.flat = self.preprocess_flat_and_labels()
 
@@ -0,0 +1,120 @@
+"""
+One-time conversion of the large csv tables of the source databases to
+parquet.
+
+The cached tables have the column types of sourcereader.SOURCE_SCHEMAS,
+dictionary-encoded pages and are sorted by icu stay, so the row group
+statistics of the stay column let filtered reads skip most of the file.
+A cached table is rebuilt when the size or the modification time of its
+csv file changes.
+"""
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from database_processing import sourcereader
+
+_SOURCE_KEY = b'blendedicu_source'
+
+
+def _source_stamp(csv_pth):
+    stat = Path(csv_pth).stat()
+    return f'{Path(csv_pth).name}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+
+
+def is_current(csv_pth, parquet_pth):
+    """
+    Whether parquet_pth was converted from the current version of csv_pth.
+    """
+    try:
+        metadata = pq.read_schema(parquet_pth).metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return False
+    return metadata.get(_SOURCE_KEY) == _source_stamp(csv_pth)
+
+
+def _key_ranges(key_counts, chunk_rows):
+    """
+    Consecutive ranges of sort keys holding about chunk_rows rows each.
+    """
+    key_counts = key_counts.groupby(level=0).sum().sort_index()
+    groups = (key_counts.cumsum() - 1) // chunk_rows
+    bounds = key_counts.index.to_series().groupby(groups.values).agg(['min', 'max'])
+    return list(bounds.itertuples(index=False, name=None))
+
+
+def convert_table(csv_pth,
+                  parquet_pth,
+                  sort_col,
+                  encoding='utf8',
+                  chunk_rows=10_000_000,
+                  row_group_size=1_000_000):
+    """
+    Converts a csv table to parquet, sorted by sort_col, with an external
+    sort bounded by chunk_rows rows in memory:
+        1. the csv is streamed by chunks of chunk_rows rows, each chunk is
+        sorted and written to a run file with small row groups,
+        2. the sort keys are split into ranges of about chunk_rows rows, each
+        range is read from all runs, using the row group statistics, sorted
+        and appended to the output file.
+    The rows with a missing sort key are written last.
+    """
+    parquet_pth = Path(parquet_pth)
+    runs_dir = parquet_pth.with_name(f'_{parquet_pth.stem}_runs')
+    shutil.rmtree(runs_dir, ignore_errors=True)
+    runs_dir.mkdir(parents=True)
+
+    print(f'Converting {csv_pth} to {parquet_pth}')
+    reader = sourcereader.open_table(csv_pth, encoding=encoding)
+    key_counts = []
+    n_rows = 0
+    for i, table in enumerate(sourcereader.iter_tables(reader,
+                                                       reader.schema,
+                                                       chunk_rows)):
+        table = table.sort_by(sort_col)
+        pq.write_table(table,
+                       runs_dir/f'run_{i:05d}.parquet',
+                       row_group_size=65_536)
+        counts = pc.value_counts(table[sort_col].drop_null())
+        key_counts.append(pd.Series(counts.field('counts').to_numpy(),
+                                    index=counts.field('values').to_numpy(zero_copy_only=False)))
+        n_rows += table.num_rows
+        print(f'   sorted {n_rows} lines')
+
+    schema = reader.schema.with_metadata({_SOURCE_KEY: _source_stamp(csv_pth)})
+    runs = ds.dataset(runs_dir, format='parquet', schema=reader.schema)
+    key = ds.field(sort_col)
+    filters = [(key >= lo) & (key <= hi)
+               for lo, hi in _key_ranges(pd.concat(key_counts), chunk_rows)]
+    filters.append(key.is_null())
+
+    tmp_pth = parquet_pth.with_name(parquet_pth.name+'.tmp')
+    with pq.ParquetWriter(tmp_pth, schema, use_dictionary=True) as writer:
+        for expression in filters:
+            table = runs.to_table(filter=expression).sort_by(sort_col)
+            if table.num_rows:
+                writer.write_table(table.replace_schema_metadata(schema.metadata),
+                                   row_group_size=row_group_size)
+    os.replace(tmp_pth, parquet_pth)
+    shutil.rmtree(runs_dir)
+
+
+def scan_table(parquet_pth, columns=None, chunk_rows=None, filters=None):
+    """
+    Reads a cached table as sourcereader.read_table reads the csv table.
+    The filters are pushed down to the parquet reader.
+    """
+    dataset = ds.dataset(parquet_pth, format='parquet')
+    expression = sourcereader.filter_expression(filters)
+    if chunk_rows is None:
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+    schema = (dataset.schema if columns is None
+              else pa.schema([dataset.schema.field(c) for c in columns]))
+    batches = dataset.to_batches(columns=columns, filter=expression)
+    return sourcereader.iter_chunks(batches, schema, chunk_rows)
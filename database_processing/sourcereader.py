@@ -0,0 +1,238 @@
+"""
+Reading of the csv tables of the source databases with pyarrow.
+
+The large tables are streamed by blocks and only the requested columns are
+converted. The types of the columns are read from SOURCE_SCHEMAS: the
+streaming reader infers the types of unregistered columns from the first
+block, which fails when a later block does not match, eg. an integer column
+with a decimal value further down the table.
+"""
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+_ts = pa.timestamp('s')
+
+# column types of the source tables, by file name without extension.
+SOURCE_SCHEMAS = {
+    # eicu
+    'nurseCharting': {'nursingchartid': pa.int64(),
+                      'patientunitstayid': pa.int64(),
+                      'nursingchartoffset': pa.int64(),
+                      'nursingchartentryoffset': pa.int64(),
+                      'nursingchartcelltypecat': pa.string(),
+                      'nursingchartcelltypevallabel': pa.string(),
+                      'nursingchartcelltypevalname': pa.string(),
+                      'nursingchartvalue': pa.string()},
+    'vitalPeriodic': {'vitalperiodicid': pa.int64(),
+                      'patientunitstayid': pa.int64(),
+                      'observationoffset': pa.int64(),
+                      'temperature': pa.float64(),
+                      'sao2': pa.float64(),
+                      'heartrate': pa.float64(),
+                      'respiration': pa.float64(),
+                      'cvp': pa.float64(),
+                      'etco2': pa.float64(),
+                      'systemicsystolic': pa.float64(),
+                      'systemicdiastolic': pa.float64(),
+                      'systemicmean': pa.float64(),
+                      'pasystolic': pa.float64(),
+                      'padiastolic': pa.float64(),
+                      'pamean': pa.float64(),
+                      'st1': pa.float64(),
+                      'st2': pa.float64(),
+                      'st3': pa.float64(),
+                      'icp': pa.float64()},
+    # mimic
+    'chartevents': {'subject_id': pa.int64(),
+                    'hadm_id': pa.int64(),
+                    'stay_id': pa.int64(),
+                    'caregiver_id': pa.int64(),
+                    'charttime': _ts,
+                    'storetime': _ts,
+                    'itemid': pa.int64(),
+                    'value': pa.string(),
+                    'valuenum': pa.float64(),
+                    'valueuom': pa.string(),
+                    'warning': pa.int64()},
+    'labevents': {'labevent_id': pa.int64(),
+                  'subject_id': pa.int64(),
+                  'hadm_id': pa.int64(),
+                  'specimen_id': pa.int64(),
+                  'itemid': pa.int64(),
+                  'order_provider_id': pa.string(),
+                  'charttime': _ts,
+                  'storetime': _ts,
+                  'value': pa.string(),
+                  'valuenum': pa.float64(),
+                  'valueuom': pa.string(),
+                  'ref_range_lower': pa.float64(),
+                  'ref_range_upper': pa.float64(),
+                  'flag': pa.string(),
+                  'priority': pa.string(),
+                  'comments': pa.string()},
+    # mimic3
+    'CHARTEVENTS': {'ROW_ID': pa.int64(),
+                    'SUBJECT_ID': pa.int64(),
+                    'HADM_ID': pa.int64(),
+                    'ICUSTAY_ID': pa.int64(),
+                    'ITEMID': pa.int64(),
+                    'CHARTTIME': _ts,
+                    'STORETIME': _ts,
+                    'CGID': pa.int64(),
+                    'VALUE': pa.string(),
+                    'VALUENUM': pa.float64(),
+                    'VALUEUOM': pa.string(),
+                    'WARNING': pa.int64(),
+                    'ERROR': pa.int64(),
+                    'RESULTSTATUS': pa.string(),
+                    'STOPPED': pa.string()},
+    # amsterdam
+    'numericitems': {'admissionid': pa.int64(),
+                     'itemid': pa.int64(),
+                     'item': pa.string(),
+                     'tag': pa.string(),
+                     'value': pa.float64(),
+                     'unitid': pa.int64(),
+                     'unit': pa.string(),
+                     'comment': pa.string(),
+                     'measuredat': pa.int64(),
+                     'registeredat': pa.int64(),
+                     'registeredby': pa.string(),
+                     'updatedat': pa.int64(),
+                     'updatedby': pa.string(),
+                     'islabresult': pa.int64(),
+                     'fluidout': pa.float64()},
+}
+
+
+def table_schema(pth):
+    """
+    Registered column types of a source table, eg. 'vitalPeriodic' for
+    '.../vitalPeriodic.csv.gz'. Empty for unregistered tables.
+    """
+    return SOURCE_SCHEMAS.get(Path(pth).name.split('.')[0], {})
+
+
+def with_bounds(filters):
+    """
+    Adds the range of the values of the 'in' filters, eg.
+    [('admissionid', 'in', [3, 1, 2])] ->
+    [('admissionid', 'in', [3, 1, 2]),
+     ('admissionid', '>=', 1),
+     ('admissionid', '<=', 3)]
+    pyarrow skips the row groups whose statistics do not match a comparison,
+    but reads all row groups for an 'in' filter.
+    """
+    if not filters:
+        return filters
+    conjunctions = [filters] if isinstance(filters[0], tuple) else filters
+    bounded = []
+    for conjunction in conjunctions:
+        bounded.append(list(conjunction))
+        for col, op, values in conjunction:
+            if op == 'in' and len(values):
+                bounded[-1].extend([(col, '>=', min(values)),
+                                    (col, '<=', max(values))])
+    return bounded[0] if isinstance(filters[0], tuple) else bounded
+
+
+def filter_expression(filters):
+    """
+    Converts filters in the format of pd.read_parquet, eg.
+    [('itemid', 'in', [220045, 220179])], to a pyarrow expression.
+    """
+    if not filters:
+        return None
+    return pq.filters_to_expression(with_bounds(filters))
+
+
+def iter_tables(batches, schema, chunk_rows):
+    """
+    Regroups record batches into tables of chunk_rows rows, the last one may
+    be shorter.
+    """
+    buffered = []
+    n_rows = 0
+    for batch in batches:
+        buffered.append(batch)
+        n_rows += batch.num_rows
+        while n_rows >= chunk_rows:
+            table = pa.Table.from_batches(buffered, schema=schema)
+            yield table.slice(0, chunk_rows)
+            remainder = table.slice(chunk_rows)
+            buffered = remainder.to_batches()
+            n_rows = remainder.num_rows
+    if n_rows:
+        yield pa.Table.from_batches(buffered, schema=schema)
+
+
+def _filtered(batches, expression):
+    for batch in batches:
+        yield from pa.Table.from_batches([batch]).filter(expression).to_batches()
+
+
+def iter_chunks(batches, schema, chunk_rows, filters=None):
+    """
+    DataFrames of chunk_rows rows from record batches, keeping the rows that
+    match the filters.
+    """
+    expression = filter_expression(filters)
+    if expression is not None:
+        batches = _filtered(batches, expression)
+    return (table.to_pandas()
+            for table in iter_tables(batches, schema, chunk_rows))
+
+
+def open_table(pth, columns=None, encoding='utf8', block_size=1 << 24):
+    """
+    Streaming reader of a csv table, with the registered column types.
+    """
+    read_options = pcsv.ReadOptions(use_threads=True,
+                                    block_size=block_size,
+                                    encoding=encoding)
+    return pcsv.open_csv(pth,
+                         read_options=read_options,
+                         convert_options=_convert_options(pth, columns))
+
+
+def _convert_options(pth, columns):
+    schema = table_schema(pth)
+    column_types = (schema if columns is None
+                    else {c: schema[c] for c in columns if c in schema})
+    return pcsv.ConvertOptions(include_columns=columns,
+                               column_types=column_types,
+                               strings_can_be_null=True)
+
+
+def read_table(pth,
+               columns=None,
+               chunk_rows=None,
+               encoding='utf8',
+               filters=None,
+               block_size=1 << 24):
+    """
+    Reads a csv table, compressed or not, as pd.read_csv(pth, usecols=columns,
+    chunksize=chunk_rows) would.
+    columns: columns to read, all columns if None.
+    chunk_rows: if None, the table is read at once with multithreaded
+        parsing and returned as a DataFrame. Otherwise, the table is streamed
+        and an iterator of DataFrames of chunk_rows rows is returned.
+    filters: rows to keep, in the format of pd.read_parquet. They are
+        applied to the arrow blocks, before the conversion to pandas.
+    """
+    if chunk_rows is None:
+        read_options = pcsv.ReadOptions(use_threads=True,
+                                        block_size=block_size,
+                                        encoding=encoding)
+        table = pcsv.read_csv(pth,
+                              read_options=read_options,
+                              convert_options=_convert_options(pth, columns))
+        expression = filter_expression(filters)
+        if expression is not None:
+            table = table.filter(expression)
+        return table.to_pandas()
+    reader = open_table(pth, columns, encoding=encoding, block_size=block_size)
+    return iter_chunks(reader, reader.schema, chunk_rows, filters=filters)
@@ -0,0 +1,178 @@
+"""
+Cache of the processing stages, used to skip the stages whose outputs are
+up to date when the pipeline is run again.
+"""
+import ast
+import functools
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+from database_processing.chunkmanifest import is_bookkeeping
+
+_REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def _files(pth):
+    """
+    Files of a path, recursively for directories. The files or directories
+    starting with '_', such as the chunk manifests or the patient indexes,
+    are bookkeeping and are not inputs of the next stages.
+    """
+    pth = Path(pth)
+    if pth.is_file():
+        return [pth]
+    if pth.is_dir():
+        return sorted(p for p in pth.rglob('*')
+                      if p.is_file() and not is_bookkeeping(p, pth))
+    return []
+
+
+def inputs_fingerprint(pths):
+    """
+    Hash of the files under a list of paths, by their path, size and
+    modification time. Missing paths are hashed as missing.
+    """
+    digest = hashlib.sha1()
+    for pth in pths:
+        digest.update(str(pth).encode())
+        files = _files(pth)
+        if not files:
+            digest.update(b':missing')
+        for file in files:
+            stat = file.stat()
+            digest.update(f'{file}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+def _module_files(name):
+    """
+    Source files of a module of the repository and of its parent packages,
+    eg. 'utils.time_utils' -> [utils/__init__.py, utils/time_utils.py].
+    Modules outside the repository have no file.
+    """
+    files = []
+    parts = name.split('.')
+    for i in range(1, len(parts)+1):
+        pth = _REPO_ROOT.joinpath(*parts[:i])
+        for candidate in (pth.with_suffix('.py'), pth/'__init__.py'):
+            if candidate.is_file():
+                files.append(candidate)
+    return files
+
+
+def _imported_files(source):
+    """
+    Source files of the repository modules imported by a source file.
+    """
+    names = []
+    for node in ast.walk(ast.parse(source.read_bytes())):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.append(node.module)
+            # from package import module
+            names.extend(f'{node.module}.{alias.name}' for alias in node.names)
+    return [f for name in names for f in _module_files(name)]
+
+
+def code_files(cls):
+    """
+    Source files of a class, of its parent classes and of the repository
+    modules they import, directly or through other modules, eg. the helpers
+    of utils/ or the readers of database_processing/ that the stages call.
+    """
+    pending = []
+    for parent in cls.__mro__:
+        try:
+            source = inspect.getsourcefile(parent)
+        except TypeError:
+            continue
+        if source is not None:
+            pending.append(Path(source).resolve())
+    files = set()
+    while pending:
+        source = pending.pop()
+        if source in files:
+            continue
+        files.add(source)
+        if source.is_relative_to(_REPO_ROOT):
+            pending.extend(_imported_files(source))
+    return sorted(files)
+
+
+def code_fingerprint(cls):
+    """
+    Hash of the source files of a class, of its parent classes and of the
+    repository modules they import.
+    """
+    digest = hashlib.sha1()
+    for source in code_files(cls):
+        if source.is_relative_to(_REPO_ROOT):
+            source_name = source.relative_to(_REPO_ROOT).as_posix()
+        else:
+            source_name = str(source)
+        digest.update(source_name.encode())
+        digest.update(source.read_bytes())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Records the key of the last successful run of a stage in a json file.
+    The key is a hash of the config.json parameters, the input files and the
+    code the stage depends on. Only the outputs of the last run are kept: the
+    stage is skipped when its key did not change and its outputs exist and
+    are not empty directories.
+
+    pth: path of the stamp file.
+    key: hash of the dependencies of the stage.
+    outputs: paths written by the stage.
+    """
+    def __init__(self, pth, key, outputs=()):
+        self.pth = Path(pth)
+        self.key = key
+        self.outputs = [Path(p) for p in outputs]
+
+    def _read(self):
+        try:
+            with open(self.pth) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def is_valid(self):
+        return (self._read().get('key') == self.key
+                and all(_files(p) for p in self.outputs))
+
+    def invalidate(self):
+        """
+        Called when the stage starts, an interrupted run leaves no stamp.
+        """
+        self.pth.unlink(missing_ok=True)
+
+    def validate(self):
+        self.pth.parent.mkdir(parents=True, exist_ok=True)
+        tmp_pth = self.pth.with_name(self.pth.name+'.tmp')
+        with open(tmp_pth, 'w') as file:
+            json.dump({'key': self.key,
+                       'outputs': [str(p) for p in self.outputs]},
+                      file,
+                      indent=1)
+        os.replace(tmp_pth, self.pth)
+
+
+def cached_stage(func):
+    """
+    Decorator of the stage methods of DataProcessor objects, the method is
+    skipped when its stage cache is valid.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self.run_stage(func.__name__,
+                              functools.partial(func, self),
+                              *args,
+                              **kwargs)
+    return wrapper
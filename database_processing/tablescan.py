@@ -0,0 +1,103 @@
+"""
+Single pass over a large table shared by several consumers.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _conjunctions(filters):
+    """
+    Filters in the format of pd.read_parquet, as a list of conjunctions:
+    [('a', '=', 1)] -> [[('a', '=', 1)]]
+    """
+    if filters and isinstance(filters[0], tuple):
+        return [list(filters)]
+    return [list(c) for c in filters]
+
+
+def _mask(df, conjunction):
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in conjunction:
+        values = df[col]
+        if op in ('=', '=='):
+            mask &= (values == value).to_numpy()
+        elif op == '!=':
+            mask &= (values != value).to_numpy()
+        elif op == '<':
+            mask &= (values < value).to_numpy()
+        elif op == '<=':
+            mask &= (values <= value).to_numpy()
+        elif op == '>':
+            mask &= (values > value).to_numpy()
+        elif op == '>=':
+            mask &= (values >= value).to_numpy()
+        elif op == 'in':
+            mask &= values.isin(value).to_numpy()
+        elif op == 'not in':
+            mask &= ~values.isin(value).to_numpy()
+        else:
+            raise ValueError(f'Unknown filter operator {op}')
+    return mask
+
+
+def filters_mask(df, filters):
+    """
+    Boolean mask of the rows of df matching filters.
+    """
+    if not filters:
+        return np.ones(len(df), dtype=bool)
+    return np.logical_or.reduce([_mask(df, c) for c in _conjunctions(filters)])
+
+
+class TableScan:
+    """
+    Reads a table once for several consumers, eg. the timeseries and the
+    admission heights and weights of the chartevents table.
+    Each consumer is registered with the filters of the rows it needs, the
+    table is read with the union of these filters and each chunk is handed
+    to every consumer, restricted to the rows matching its filters.
+
+        scan = TableScan()
+        scan.register('heights', select_heights, [('itemid', 'in', ids)])
+        scan.register('timeseries', prepare_timeseries)
+        chunks = preparator.read_table(pth, chunk_rows=n, filters=scan.filters())
+        results = scan.run(chunks)  # {'heights': df, 'timeseries': df}
+    """
+    def __init__(self):
+        self.consumers = {}
+
+    def register(self, name, consumer, filters=None):
+        """
+        consumer: function of a DataFrame chunk, returning a DataFrame. The
+            outputs of the chunks are concatenated.
+        filters: rows of the table needed by the consumer, in the format of
+            pd.read_parquet. All rows if None.
+        """
+        self.consumers[name] = (consumer, filters)
+
+    def filters(self):
+        """
+        Union of the filters of the consumers, None if a consumer needs all
+        the rows.
+        """
+        conjunctions = []
+        for _, filters in self.consumers.values():
+            if not filters:
+                return None
+            conjunctions.extend(_conjunctions(filters))
+        return conjunctions
+
+    def run(self, chunks):
+        outputs = {name: [] for name in self.consumers}
+        n_rows = 0
+        for chunk in chunks:
+            n_rows += len(chunk)
+            print(f'   scanned {n_rows} lines')
+            for name, (consumer, filters) in self.consumers.items():
+                if filters:
+                    chunk_in = chunk.loc[filters_mask(chunk, filters)]
+                else:
+                    chunk_in = chunk
+                outputs[name].append(consumer(chunk_in))
+        return {name: pd.concat(dfs) if dfs else pd.DataFrame()
+                for name, dfs in outputs.items()}
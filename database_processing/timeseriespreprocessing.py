@@ -4,19 +4,72 @@ dataset.
 It contains useful functions to convert the format of data, harmonize units and 
 labels and save the timeseries variables as parquet files.
 """
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 
 import pandas as pd
 import pyarrow as pa
+import pyarrow.parquet as pq
 import numpy as np
 from natsort import natsorted
 
+from database_processing.chunkmanifest import ChunkManifest, fingerprint
 from database_processing.dataprocessor import DataProcessor
+from utils.profiling import traced
+
+
+_worker_tsp = None
+
+
+def _init_worker(dataset):
+    """
+    Each worker process holds its own TimeseriesPreprocessing object. Only the
+    chunk inputs are sent to the workers, which save the processed chunks.
+    """
+    global _worker_tsp
+    _worker_tsp = TimeseriesPreprocessing(dataset, n_workers=1)
+
+
+def _process_chunk(chunk_idx, chunk_inputs):
+    _worker_tsp.profiler.chunk = chunk_idx
+    return _worker_tsp.process_tables(**chunk_inputs)
+
+
+class PatientIndex:
+    """
+    Rows of a long table by patient. The table is sorted once by patient,
+    keeping the order of the rows of each patient, and the start and stop
+    positions of each patient are stored. Selecting the rows of a chunk of
+    patients then costs O(rows in the chunk) instead of a boolean scan of the
+    whole table.
+    """
+    def __init__(self, table, col_id='patient'):
+        self.table = table.sort_values(col_id, kind='stable')
+        ids = self.table[col_id].to_numpy()
+        changes = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        self.starts = np.r_[0, changes] if len(ids) else changes
+        self.stops = np.r_[changes, len(ids)] if len(ids) else changes
+        self.patients = pd.Index(ids[self.starts])
+
+    def get(self, patients):
+        """
+        Rows of the patients, in the order of the sorted table. Unknown
+        patients are ignored.
+        """
+        pos = self.patients.get_indexer(pd.unique(np.asarray(patients)))
+        pos = np.sort(pos[pos >= 0])
+        lengths = self.stops[pos] - self.starts[pos]
+        offsets = np.repeat(self.starts[pos] - np.cumsum(lengths) + lengths,
+                            lengths)
+        return self.table.iloc[offsets + np.arange(lengths.sum())]
 
 
 class TimeseriesPreprocessing(DataProcessor):
-    def __init__(self, dataset):
+    stage_config_keys = ['upper_los', 'TS_MASK_FORMAT', 'TS_STORAGE']
+
+    def __init__(self, dataset, n_workers=None):
         super().__init__(dataset)
+        self.n_workers = self.N_WORKERS if n_workers is None else n_workers
         self.ts_variables_pth = self.user_input_pth+'timeseries_variables.csv'
         self.ts_variables = self._load_tsvariables()
 
@@ -24,6 +77,11 @@ class TimeseriesPreprocessing(DataProcessor):
 
         self.kept_med = self._kept_meds()
         self.index = None
+        self.written_pths = []
+        self.chunk_output_dirs = [self.formatted_ts_dir,
+                                  self.formatted_med_dir,
+                                  self.partiallyprocessed_ts_dir]
+        self.manifest_pth = self.partiallyprocessed_ts_dir+'_chunk_manifest/'
 
         d = ({'time':{'blended':'time', 'eicu': 'time', 'mimic':'time', 'mimic3': 'time', 'amsterdam': 'time', 'hirid': 'time', 'is_numeric':1,'agg_method': 'last'}, 
              'hour':{'blended':'hour', 'eicu': 'hour', 'mimic':'hour', 'mimic3': 'time','amsterdam': 'hour', 'hirid': 'hour', 'is_numeric':1,'agg_method': 'last'}}
@@ -51,6 +109,7 @@ class TimeseriesPreprocessing(DataProcessor):
             'blended': (lambda x: x)
         }[self.dataset]
 
+    @traced
     def process_tables(self,
                        ts_ver=None,
                        ts_hor=None,
@@ -71,7 +130,10 @@ class TimeseriesPreprocessing(DataProcessor):
              if True, the code will stop after processing of the first chunk.
              This can be useful for debugging or testing the pipeline on a 
              single chunk
+
+        Returns the paths of the files written for the chunk.
         '''
+        self.written_pths = []
         t_max = self.upper_los*24*3600
 
         timeseries = self.format_raw_data(ts_ver=ts_ver,
@@ -102,12 +164,99 @@ class TimeseriesPreprocessing(DataProcessor):
                                 .reset_index())
 
         self.chunk = (pd.concat([self.chunk, self.column_template])
-                      .astype(self.dtypes))
+                      .astype(self.dtypes)
+                      .pipe(self._mask_dtypes))
 
         if stop_at_first_chunk:
             raise Exception('Stopped after 1st chunk, deactivate '
                             '"stop_at_first_chunk" to keep running.')
         self.save_timeseries(self.chunk, self.partiallyprocessed_ts_dir)
+        return self.written_pths
+
+    def chunk_manifest(self):
+        """
+        Manifest of the chunks processed by the run method. It is discarded
+        when the configuration, the timeseries variables or the medications
+        change.
+        """
+        config_hash = self.config_hash(self.dataset,
+                                       self.ts_variables.to_csv(),
+                                       self.ohdsi_med)
+        return ChunkManifest(self.manifest_pth,
+                             config_hash,
+                             output_dirs=self.chunk_output_dirs)
+
+    def stage_inputs(self):
+        return super().stage_inputs() + [self.parquet_pth]
+
+    def stage_outputs(self, name):
+        return self.chunk_output_dirs
+
+    def reset_dir(self):
+        """
+        With RESUME_CHUNKS, the output directories are kept when a previous
+        run completed some chunks, the run resumes from these chunks.
+        """
+        if self.RESUME_CHUNKS:
+            completed = self.chunk_manifest().completed()
+            if completed:
+                print(f'Resuming from the {len(completed)} chunks completed '
+                      f'in {self.manifest_pth}')
+                return
+        super().reset_dir()
+
+    def _pending_chunks(self, chunks, manifest):
+        """
+        Yields the index, the inputs hash and the inputs of the chunks that
+        are not completed in the manifest. When resuming, the files of
+        incomplete chunks are removed first.
+        """
+        if self.RESUME_CHUNKS and manifest.completed():
+            manifest.clean()
+        for chunk_idx, chunk_inputs in enumerate(chunks):
+            inputs_hash = fingerprint(chunk_inputs)
+            if self.RESUME_CHUNKS and manifest.is_done(chunk_idx, inputs_hash):
+                print(f'Chunk {chunk_idx} already processed, skipping.')
+                continue
+            yield chunk_idx, inputs_hash, chunk_inputs
+
+    def process_chunks(self, chunks):
+        """
+        Runs process_tables on an iterable of chunk inputs, each one being a
+        dict of keyword arguments of process_tables.
+        Chunks are independent: if n_workers > 1 they are dispatched to a 
+        pool of processes. The chunks are produced lazily, at most 
+        2*n_workers chunks are held in memory at once.
+        The completed chunks are recorded in the chunk manifest, with
+        RESUME_CHUNKS they are skipped when the run is restarted.
+        """
+        manifest = self.chunk_manifest()
+        pending_chunks = self._pending_chunks(chunks, manifest)
+
+        if self.n_workers == 1:
+            for chunk_idx, inputs_hash, chunk_inputs in pending_chunks:
+                manifest.start(chunk_idx, inputs_hash)
+                self.profiler.chunk = chunk_idx
+                outputs = self.process_tables(**chunk_inputs)
+                manifest.done(chunk_idx, inputs_hash, outputs)
+            return
+
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(self.dataset,)) as executor:
+            for chunk_idx, inputs_hash, chunk_inputs in pending_chunks:
+                if len(running) >= 2*self.n_workers:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        manifest.done(*running.pop(future), future.result())
+                manifest.start(chunk_idx, inputs_hash)
+                future = executor.submit(_process_chunk,
+                                         chunk_idx,
+                                         chunk_inputs)
+                running[future] = (chunk_idx, inputs_hash)
+            for future, (chunk_idx, inputs_hash) in running.items():
+                manifest.done(chunk_idx, inputs_hash, future.result())
 
     def filter_tables(self,
                       table,
@@ -134,6 +283,7 @@ class TimeseriesPreprocessing(DataProcessor):
 
         return table.loc[table['variable'].isin(kept_variables)]
 
+    @traced
     def format_raw_data(self,
                         ts_ver=None,
                         ts_hor=None,
@@ -303,6 +453,7 @@ class TimeseriesPreprocessing(DataProcessor):
     def _celsius_to_farenheit(self, series):
         return (series-32)/1.8
 
+    @traced
     def _harmonize_amsterdam(self, df):
         df['O2_arterial_saturation'] = df['O2_arterial_saturation']*100
         df['hemoglobin'] = df['hemoglobin']*1.613
@@ -317,10 +468,12 @@ class TimeseriesPreprocessing(DataProcessor):
         df.loc[idx_nan, 'tidal_volume_setting'] = np.nan
         return df
 
+    @traced
     def _harmonize_hirid(self, df):
         df['hemoglobin'] = df['hemoglobin']/10
         return df
 
+    @traced
     def _harmonize_eicu(self, df):
         """
         Conversion constants were taken from:
@@ -339,6 +492,7 @@ class TimeseriesPreprocessing(DataProcessor):
         df.loc[temp_idx] = self._celsius_to_farenheit(df.loc[temp_idx])
         return df
 
+    @traced
     def _harmonize_mimic(self, df):
         """
         Unit conversion was necessary mostly for lab variables.
@@ -354,6 +508,7 @@ class TimeseriesPreprocessing(DataProcessor):
         df['phosphate'] = df['phosphate']*0.323
         return df
 
+    @traced
     def _harmonize_mimic3(self, df):
         """
         Unit conversion was necessary mostly for lab variables.
@@ -370,23 +525,50 @@ class TimeseriesPreprocessing(DataProcessor):
         df['phosphate'] = df['phosphate']*0.323
         return df
 
+    @traced
     def _resampling(self, df):
         """
         Resamples the input dataframe and applies the aggregate functions 
         that are specified in the input timeseries_variables.csv file.
+        Each measurement goes to the hourly bin of the grid built by 
+        _build_index that contains it, measurements after the last bin of a
+        patient go to its last bin. Measurements of patients that are not 
+        in the grid, or with negative times are dropped.
+        The output contains a row for every bin of the grid.
         """
         aggregates = self.aggregates_blended.loc[df.columns]
-        df = self.df_resampler.join(df, how='outer')
-
-        df['new_time'] = df.groupby(level=0).new_time.ffill()
-        
-        df = (df.droplevel(1)
-                .rename(columns={'new_time': self.time_col})
-                .set_index(self.time_col, append=True)
-                .groupby(level=[0, 1])
-                .agg(aggregates))
-        return df
 
+        # as in an outer join with the grid, integer columns become float.
+        int_cols = df.columns[[pd.api.types.is_integer_dtype(t) 
+                               for t in df.dtypes]]
+        df = (df.astype({c: float for c in int_cols})
+                .sort_index(kind='stable'))
+
+        patients = df.index.get_level_values(0)
+        times = df.index.get_level_values(1).values.astype(float)
+        last_bins = self.last_bins.reindex(patients).values
+        bins = np.minimum(times // self.freq * self.freq, last_bins)
+        keep = (times >= 0) & ~np.isnan(last_bins)
+
+        df = df.loc[keep]
+        keys = [patients[keep], pd.Index(bins[keep], name=self.time_col)]
+
+        resampled = [df[cols].groupby(keys, sort=True).agg(agg_method)
+                     for agg_method, cols in aggregates.groupby(aggregates).groups.items()]
+        if not resampled:
+            return pd.DataFrame(index=self.resampling_grid)
+
+        resampled = (pd.concat(resampled, axis=1)
+                       .reindex(columns=df.columns)
+                       .reindex(self.resampling_grid))
+
+        # groupby.last fills empty bins of object columns with None.
+        obj_cols = resampled.columns[resampled.dtypes == object]
+        resampled[obj_cols] = resampled[obj_cols].where(resampled[obj_cols].notna(),
+                                                        None)
+        return resampled
+
+    @traced
     def _fillna(self, df):
         """
         Fill nans with the medians from each variables. This is used in 
@@ -410,30 +592,54 @@ class TimeseriesPreprocessing(DataProcessor):
         self.medians = self.clipping_quantiles[1]
         return df.fillna(self.medians)
 
+    @traced
     def _make_med_mask(self, med):
         """
         Produces a mask of drug exposure from the list of starts and ends of 
         medications.
+        Each administration covers the hourly bins of the grid from the bin
+        of its start to the bin of its end, excluded. An administration
+        that starts and ends in the same bin covers this bin. Like in 
+        _resampling, times after the last bin of a patient go to its last
+        bin, and administrations of patients that are not in the grid are
+        dropped.
+        The exposures are counted in a difference array with one row per
+        bin of the grid, a drug is given in a bin if its cumulative sum is
+        positive.
         """
         self.med = med
 
-        med_starts = med.set_index(['patient', 'start'])
-        med_ends = med.set_index(['patient', 'end'])
-        med_ends_resampled = (med_ends.pipe(self._extract_variables,
-                                            kept_variables=self.kept_med)
-                              .rename_axis([self.idx_col, self.time_col])
-                              .pipe(self._resampling)
-                              .multiply(0))
-        
-        med_starts_resampled = (med_starts.pipe(self._extract_variables,
-                                                kept_variables=self.kept_med)
-                                .rename_axis([self.idx_col, self.time_col])
-                                .pipe(self._resampling))
-
-        return (pd.concat([med_starts_resampled, med_ends_resampled])
-                .groupby(level=[0, 1]).max()
-                .groupby(level=0).ffill().fillna(0))
-
+        n_rows = len(self.resampling_grid)
+        n_meds = len(self.kept_med)
+
+        med = med.loc[med['variable'].isin(self.kept_med)]
+        first_rows = self.first_rows.reindex(med['patient']).values
+        last_bins = self.last_bins.reindex(med['patient']).values // self.freq
+        keep = ~np.isnan(first_rows)
+
+        first_rows = first_rows[keep].astype(int)
+        last_bins = last_bins[keep].astype(int)
+        start_bins = np.minimum(med['start'].values[keep] // self.freq,
+                                last_bins).astype(int)
+        end_bins = np.minimum(med['end'].values[keep] // self.freq,
+                              last_bins).astype(int)
+        end_bins = np.maximum(end_bins, start_bins + 1)
+
+        med_cols = pd.Index(self.kept_med).get_indexer(
+            np.asarray(med['variable'])[keep])
+        starts = (first_rows + start_bins) * n_meds + med_cols
+        ends = (first_rows + end_bins) * n_meds + med_cols
+
+        n_cells = (n_rows + 1) * n_meds
+        exposure = (np.bincount(starts, minlength=n_cells)
+                    - np.bincount(ends, minlength=n_cells))
+        exposure = exposure.reshape(n_rows + 1, n_meds)[:-1].cumsum(axis=0)
+
+        return pd.DataFrame((exposure > 0).astype(float),
+                            index=self.resampling_grid,
+                            columns=self.kept_med)
+
+    @traced
     def _clip_user_minmax(self, df):
         """
         Clips the values to the user-specified min and max in the 
@@ -447,6 +653,7 @@ class TimeseriesPreprocessing(DataProcessor):
         df[num_cols] = df[num_cols].clip(lower=lower, upper=upper)
         return df
 
+    @traced
     def _convert_col_dtypes(self, df):
         """
         Convert numeric cols to float, a this point every value in the numeric
@@ -456,6 +663,7 @@ class TimeseriesPreprocessing(DataProcessor):
         numeric_cols = set(df.columns).intersection(self.numeric_cols)
         return df.astype({c: float for c in numeric_cols})
 
+    @traced
     def _numericize_cols(self, ts_ver):
         """
         Convert to numeric all columns that were specified as numeric in the 
@@ -471,6 +679,7 @@ class TimeseriesPreprocessing(DataProcessor):
         ts_ver = ts_ver.dropna()
         return ts_ver
 
+    @traced
     def _compute_GCS(self, df):
         """
         Some databases report the three components of the GCS score but do not 
@@ -493,6 +702,7 @@ class TimeseriesPreprocessing(DataProcessor):
                 df[glasgow_col] = np.nan
         return df
 
+    @traced
     def _forward_fill(self, df):
         """
         Forward filling is optional. If FORWARD_FILL is set to 0 in the 
@@ -522,50 +732,104 @@ class TimeseriesPreprocessing(DataProcessor):
 
         return ts_ver, ts_hor
 
+    @traced
     def save_timeseries(self,
                         timeseries,
                         ts_savepath,
                         pyarrow_schema=None):
         """
         Saves a table to parquet. The user may specify a pyarrow schema.
+        With TS_STORAGE='patient_files', a file is saved for each patient,
+        with TS_STORAGE='chunked', the table is saved to a single file with
+        row groups of n_patient_row_group patients, see _save_timeseries_chunk.
+        The paths of the saved files are appended to self.written_pths.
         """
         Path(ts_savepath).mkdir(exist_ok=True, parents=True)
 
+        if self.TS_STORAGE == 'chunked':
+            return self._save_timeseries_chunk(timeseries,
+                                               ts_savepath,
+                                               pyarrow_schema=pyarrow_schema)
+
         patient_ts = (timeseries.reset_index(drop=True)
                                 .set_index('patient')
                                 .groupby(level=0))
 
         for patient, df in patient_ts:
-            self.save(df,
-                      f'{ts_savepath}{patient}.parquet',
-                      pyarrow_schema=pyarrow_schema)
+            savepath = f'{ts_savepath}{patient}.parquet'
+            self.save(df, savepath, pyarrow_schema=pyarrow_schema)
+            self.written_pths.append(savepath)
+
+    def _save_timeseries_chunk(self,
+                               timeseries,
+                               ts_savepath,
+                               pyarrow_schema=None):
+        """
+        The chunk file is named after its first patient, so that chunks 
+        processed by different workers never write to the same file.
+        Patients are never split between row groups. Row groups hold 
+        n_patient_row_group patients: a row group per patient would make
+        the parquet footer and the file much larger, as most columns are
+        sparse.
+        """
+        timeseries = (timeseries.reset_index(drop=True)
+                                .set_index('patient')
+                                .sort_index(kind='stable'))
+        if timeseries.empty:
+            return
+
+        patients = timeseries.index
+        savepath = f'{ts_savepath}chunk_{patients[0]}.parquet'
+        print(f'   saving {savepath}')
+
+        table = pa.Table.from_pandas(timeseries, schema=pyarrow_schema)
+        patient_starts = np.flatnonzero(np.r_[True, patients[1:] != patients[:-1]])
+        starts = patient_starts[::self.n_patient_row_group]
+        lengths = np.diff(np.r_[starts, len(patients)])
+        with pq.ParquetWriter(savepath, table.schema) as writer:
+            for start, length in zip(starts, lengths):
+                writer.write_table(table.slice(start, length),
+                                   row_group_size=length)
+        self.written_pths.append(savepath)
 
     def _kept_meds(self):
         """convenience function to get the list of included medications."""
         return [*self.ohdsi_med.keys()]
 
+    @traced
     def _build_index(self, timeseries, cols_index, freq=3600):
         """
         observation times should be a dataframe with two columns :
             patient and time.
 
         It should contain the times at which values are available.
+        The hourly grid goes from 0 to the last observation time of each 
+        patient.
         """
-        observation_times = pd.DataFrame(timeseries.index.tolist(),
-                                         columns=cols_index)
+        observation_times = pd.DataFrame({
+            cols_index[0]: timeseries.index.get_level_values(0),
+            cols_index[1]: timeseries.index.get_level_values(1)})
 
         # get the timestep of the last value
         self.last_sample = (observation_times.groupby('patient')['time']
                                              .max().astype(int)
                                              .clip(lower=freq+1))
 
-        tuples = [(i, t) for i, T in self.last_sample.items()
-                  for t in np.arange(0, T, freq).astype(int)]
-        self.mux = pd.MultiIndex.from_tuples(tuples, names=cols_index)
-
-        self.df_resampler = pd.DataFrame(self.mux.get_level_values(1).values,
-                                         index=self.mux,
-                                         columns=['new_time'])
+        n_bins = -(-self.last_sample.values // freq)
+        first_row = np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+        grid_times = (np.arange(n_bins.sum()) - first_row) * freq
+
+        self.freq = freq
+        self.first_rows = pd.Series(np.cumsum(n_bins) - n_bins,
+                                    index=self.last_sample.index)
+        self.last_bins = pd.Series((n_bins - 1) * freq, 
+                                   index=self.last_sample.index)
+        self.mux = pd.MultiIndex.from_arrays(
+            [np.repeat(self.last_sample.index.values, n_bins), grid_times],
+            names=cols_index)
+        self.resampling_grid = pd.MultiIndex.from_arrays(
+            [self.mux.get_level_values(0), grid_times.astype(float)],
+            names=cols_index)
         return self.mux
 
     def generate_patient_chunks(self, unique_patients):
@@ -574,11 +838,20 @@ class TimeseriesPreprocessing(DataProcessor):
         of size self.n_patient_chunk.
         """
         patients = unique_patients.to_list()
-        np.random.shuffle(patients)
+        # seeded, so that the chunks are the same when a run is resumed.
+        np.random.RandomState(self.SEED).shuffle(patients)
         return np.split(patients, np.arange(self.n_patient_chunk,
                                             len(patients),
                                             self.n_patient_chunk))
 
+    def index_patients(self, table, col_id=None):
+        """
+        PatientIndex of a table, to select the rows of each patient chunk
+        without scanning the whole table. col_id defaults to self.idx_col.
+        """
+        return PatientIndex(table, self.idx_col if col_id is None else col_id)
+
+    @traced
     def _extract_variables(self, ts_ver, kept_variables):
         """
         ts_ver should have [patient, time] as multiindex
@@ -586,47 +859,109 @@ class TimeseriesPreprocessing(DataProcessor):
 
         The variables in kept_variables are queried in the variable column
 
-        A dataframe created from 'index' is filled with the values.
+        The variable column is encoded as a categorical, and the values of 
+        all variables that share an aggregation method are aggregated by
+        (patient, time, variable) in a single groupby, then unstacked to one
+        column per variable.
         """
-        series = []
-        for var in kept_variables:
-            self.var = var
-            
-            df = (ts_ver.loc[ts_ver['variable'] == var, 'value']
-                  .groupby(level=[0, 1])
-                  .agg(self.aggregates.loc[var])
-                  .rename(var))
-            series.append(df)
-        if series:
-            return pd.concat(series, axis=1)
-        else:
+        kept_variables = list(kept_variables)
+        if not kept_variables:
             return pd.DataFrame(index=self.mux)
 
-    def _apply_mask_decay(self, mask_bool, decay_rate=4/3):
+        aggregates = self.aggregates.loc[kept_variables]
+        ts_ver = ts_ver.loc[ts_ver['variable'].isin(kept_variables)]
+        variables = pd.Categorical(ts_ver['variable'],
+                                   categories=kept_variables)
+        keys = [ts_ver.index.get_level_values(0),
+                ts_ver.index.get_level_values(1),
+                variables]
+
+        extracted = []
+        for agg_method, agg_variables in aggregates.groupby(aggregates).groups.items():
+            is_agg = variables.isin(agg_variables)
+            extracted.append(ts_ver.loc[is_agg, 'value']
+                             .groupby([key[is_agg] for key in keys],
+                                      observed=True)
+                             .agg(agg_method)
+                             .unstack())
+
+        extracted = pd.concat(extracted, axis=1)
+        extracted.columns = extracted.columns.astype(object)
+        return (extracted.reindex(columns=kept_variables)
+                         .rename_axis(columns=None))
+
+    def _hours_since_measurement(self, mask_bool, patients):
+        """
+        mask_bool is a 2-D boolean array of measurements, its rows are the
+        hourly bins of consecutive patients.
+        Returns the number of hours since the last measurement of each
+        variable, and a boolean array that is True where a variable was 
+        never measured since the admission of the patient.
+        """
+        rows = np.arange(len(patients))
+        is_first_row = np.ones(len(patients), dtype=bool)
+        is_first_row[1:] = patients[1:] != patients[:-1]
+        first_row = np.maximum.accumulate(np.where(is_first_row, rows, 0))
+
+        # Unmeasured bins point before the first row of their patient, so 
+        # that the running maximum is reset at each patient.
+        last_measurement = np.maximum.accumulate(
+            np.where(mask_bool, rows[:, None], (first_row - 1)[:, None]),
+            axis=0)
+        never_measured = last_measurement < first_row[:, None]
+        return rows[:, None] - last_measurement, never_measured
+
+    def _apply_mask_decay(self, hours, never_measured, decay_rate=4/3):
         """
         This decaying mask can be used in a model to get an idea of the
         staleness of a measurement. Its value is 1 at the time of measures
         and decays towards zero as the measure gets older.
         """
-        mask = mask_bool.astype(int).replace({0: np.nan})
-        inv_mask_bool = ~mask_bool
-        count_non_measurements = inv_mask_bool.cumsum() \
-            - inv_mask_bool.cumsum().where(mask_bool).ffill().fillna(0)
-        decay_mask = (mask.ffill().fillna(0)
-                      / (count_non_measurements * decay_rate).replace(0, 1))
-        return decay_mask
+        return np.where(never_measured,
+                        0.,
+                        1/np.maximum(hours*decay_rate, 1))
 
+    def _apply_mask_hours(self, hours, never_measured):
+        """
+        Number of hours since the last measurement, stored on a byte.
+        It saturates at 254, 255 means that the variable was never measured.
+        """
+        return np.where(never_measured,
+                        255,
+                        np.minimum(hours, 254)).astype(np.uint8)
+
+    @traced
+    def _mask_dtypes(self, df):
+        """
+        The joins of process_tables upcast the 'hours' masks to float, they
+        are cast back to uint8.
+        """
+        if self.TS_MASK_FORMAT != 'hours':
+            return df
+        mask_cols = df.columns[df.columns.str.endswith('_mask')]
+        return df.astype({c: np.uint8 for c in mask_cols})
+
+    @traced
     def _mask(self, data):
         """
-        Apply a decaying mask for all timeseries variables.
+        Apply a mask for all timeseries variables. By default, it is a 
+        decaying mask, with TS_MASK_FORMAT='hours' it is the number of hours
+        since the last measurement.
         """
-        mask = (data.notna()
-                    .groupby('patient')
-                    .apply(self._apply_mask_decay)
-                    .add_suffix('_mask')
-                    .droplevel(0))
+        patients = data.index.get_level_values(0).values
+        hours, never_measured = self._hours_since_measurement(data.notna().values,
+                                                              patients)
+        if self.TS_MASK_FORMAT == 'hours':
+            mask = self._apply_mask_hours(hours, never_measured)
+        else:
+            mask = self._apply_mask_decay(hours, never_measured)
+
+        mask = pd.DataFrame(mask,
+                            index=data.index,
+                            columns=data.columns + '_mask')
         return pd.concat([data, mask], axis=1)
 
+    @traced
     def _add_hour(self, timeseries, admission_hours):
         '''
         timeseries : index should be multiindex(patient, time)
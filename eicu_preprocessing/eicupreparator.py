@@ -7,6 +7,21 @@ from database_processing.medicationprocessor import MedicationProcessor
 
 
 class eicuPreparator(DataPreparator):
+    extraction_steps = {'build_source_cache': [],
+                        'gen_labels': [],
+                        'gen_flat': ['gen_labels'],
+                        'gen_medication': ['gen_labels'],
+                        'gen_timeseriesintakeoutput': ['gen_labels'],
+                        'gen_timeseriesresp': ['gen_labels'],
+                        'gen_timeserieslab': ['gen_labels'],
+                        'gen_timeseriesnurse': ['gen_labels',
+                                                'build_source_cache'],
+                        'gen_timeseriesaperiodic': ['gen_labels'],
+                        'gen_timeseriesperiodic': ['gen_labels',
+                                                   'build_source_cache']}
+    source_tables = {'nursecharting_pth': 'patientunitstayid',
+                     'periodic_pth': 'patientunitstayid'}
+
     def __init__(self,
                  lab_pth,
                  diag_pth,
@@ -48,6 +63,17 @@ class eicuPreparator(DataPreparator):
         self.periodic_savepath = f'{self.parquet_pth}/tsperiodic{suffix}'
         self.aperiodic_savepath = f'{self.parquet_pth}/tsaperiodic{suffix}'
         self.intakeoutput_savepath = f'{self.parquet_pth}/tsintakeoutput{suffix}'
+        self.step_outputs = {
+            'gen_labels': [self.labels_savepath],
+            'gen_flat': [self.flat_savepath],
+            'gen_medication': [self.med_savepath],
+            'gen_timeseriesintakeoutput': [self.intakeoutput_savepath],
+            'gen_timeseriesresp': [self.resp_savepath],
+            'gen_timeserieslab': [self.lab_savepath],
+            'gen_timeseriesnurse': [self.nurse_savepath],
+            'gen_timeseriesaperiodic': [self.aperiodic_savepath],
+            'gen_timeseriesperiodic': [self.periodic_savepath],
+            }
 
         self.col_los = 'unitdischargeoffset'
         self.unit_los = 'minute'
@@ -277,12 +303,6 @@ class eicuPreparator(DataPreparator):
         """
         self.get_labels()
         print('o Timeseriesnurse')
-        nursecharting = pd.read_csv(self.nursecharting_pth,
-                                    usecols=['patientunitstayid',
-                                             'nursingchartoffset',
-                                             'nursingchartcelltypevallabel',
-                                             'nursingchartvalue'])
-
         keepvars = ['Non-Invasive BP', 'Heart Rate', 'Pain Score/Goal',
                     'Respiratory Rate', 'O2 Saturation', 'Temperature',
                     'Glasgow coma score', 'Invasive BP', 'Bedside Glucose',
@@ -290,6 +310,14 @@ class eicuPreparator(DataPreparator):
                     'O2 Admin Device', 'Sedation Scale/Score/Goal',
                     'Delirium Scale/Score']
 
+        nursecharting = self.read_table(self.nursecharting_pth,
+                                        columns=['patientunitstayid',
+                                                 'nursingchartoffset',
+                                                 'nursingchartcelltypevallabel',
+                                                 'nursingchartvalue'],
+                                        filters=[('nursingchartcelltypevallabel',
+                                                  'in', keepvars)])
+
         tsnurse = (nursecharting.pipe(self.prepare_tstable,
                                       keepvars=keepvars,
                                       col_offset='nursingchartoffset',
@@ -327,19 +355,19 @@ class eicuPreparator(DataPreparator):
         """
         self.get_labels()
         print('o Timeseriesperiodic')
-        vitalperiodic = pd.read_csv(self.periodic_pth,
-                                    chunksize=self.chunksize,
-                                    usecols=['patientunitstayid',
-                                             'observationoffset',
-                                             'temperature',
-                                             'sao2',
-                                             'heartrate',
-                                             'respiration',
-                                             'cvp',
-                                             'systemicsystolic',
-                                             'systemicdiastolic',
-                                             'systemicmean',
-                                             'st1', 'st2', 'st3'])
+        vitalperiodic = self.read_table(self.periodic_pth,
+                                        chunk_rows=self.chunksize,
+                                        columns=['patientunitstayid',
+                                                 'observationoffset',
+                                                 'temperature',
+                                                 'sao2',
+                                                 'heartrate',
+                                                 'respiration',
+                                                 'cvp',
+                                                 'systemicsystolic',
+                                                 'systemicdiastolic',
+                                                 'systemicmean',
+                                                 'st1', 'st2', 'st3'])
 
         prepare_tstable = partial(self.prepare_tstable,
                                   col_offset='observationoffset',
@@ -1,5 +1,6 @@
 import pandas as pd
 
+from database_processing.stagecache import cached_stage
 from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
 
 
@@ -16,10 +17,12 @@ class eicuTSP(TimeseriesPreprocessing):
                  nurse_pth,
                  aperiodic_pth,
                  periodic_pth,
-                 inout_pth):
-        super().__init__(dataset='eicu')
+                 inout_pth,
+                 n_workers=None):
+        super().__init__(dataset='eicu', n_workers=n_workers)
 
-        self.medication = self.load(self.med_savepath)
+        self.medication = self.load(self.med_savepath,
+                                    filters=[('label', 'in', self.kept_med)])
 
         self.flat = self.load(self.flat_savepath)
         self.tslab_files = self.ls(self.parquet_pth+lab_pth)
@@ -74,22 +77,13 @@ class eicuTSP(TimeseriesPreprocessing):
                                     .apply(lambda x: f'{self.dataset}-{x}'))
         return self.flat.loc[:, ['patient', 'hour']].set_index('patient')
 
-    def run(self):
-
-        self.reset_dir()
-
-        self.medication = self.filter_tables(self.medication,
-                                             kept_variables=self.kept_med,
-                                             **self.colnames_med)
-
-        admission_hours = self._get_admission_hours()
-
-        for i, pths in enumerate(zip(self.tslab_files,
-                                     self.tsresp_files,
-                                     self.tsnurse_files,
-                                     self.tsperiodic_files,
-                                     self.tsaperiodic_files,
-                                     self.tsinout_files)):
+    def _chunk_inputs(self, admission_hours):
+        for pths in zip(self.tslab_files,
+                        self.tsresp_files,
+                        self.tsnurse_files,
+                        self.tsperiodic_files,
+                        self.tsaperiodic_files,
+                        self.tsinout_files):
 
             tslab, tsresp, tsnurse, tsperiodic, tsaperiodic, tsinout = map(self.load, pths)
 
@@ -117,19 +111,30 @@ class eicuTSP(TimeseriesPreprocessing):
 
             ts_ver = pd.concat([tslab, tsresp, tsnurse, tsinout])
 
-            idx_chunk = self.medication.patient.isin(ts_ver.patient.unique())
-
-            medication_chunk = self.medication.loc[idx_chunk]
+            medication_chunk = self.medication.get(ts_ver.patient.unique())
 
             ts_hor = tsperiodic.merge(tsaperiodic,
                                       how='outer',
                                       on=['patient', 'time'])
 
-            self.ts_ver=ts_ver
-            self.ts_hor=ts_hor
+            chunk_patients = pd.concat([ts_ver.patient, ts_hor.patient])
+            idx_hours = admission_hours.index.isin(chunk_patients)
+            admission_hours_chunk = admission_hours.loc[idx_hours]
+
+            yield {'ts_ver': ts_ver,
+                   'ts_hor': ts_hor,
+                   'med': medication_chunk,
+                   'admission_hours': admission_hours_chunk}
+
+    @cached_stage
+    def run(self):
+
+        self.reset_dir()
+
+        self.medication = self.filter_tables(self.medication,
+                                             **self.colnames_med)
+        self.medication = self.index_patients(self.medication)
+
+        admission_hours = self._get_admission_hours()
 
-            self.process_tables(ts_ver,
-                                ts_hor,
-                                med=medication_chunk,
-                                admission_hours=admission_hours,
-                                stop_at_first_chunk=False)
+        self.process_chunks(self._chunk_inputs(admission_hours))
@@ -27,18 +27,39 @@ class Blendedicu_stats(blendedicuTSP):
                        'hirid': 'tab:red'}
 
         self.raw_ts_pths = self._get_pths(self.formatted_ts_dirs)
-        self.ts_pths_lst = sum([v for v in self.raw_ts_pths.values()], [])
+        if self.TS_STORAGE == 'chunked':
+            self.ts_pths_lst = pd.concat(self.raw_ts_pths.values())
+        else:
+            self.ts_pths_lst = sum([v for v in self.raw_ts_pths.values()], [])
         self.med_pths = self._get_pths(self.formatted_med_dirs)
 
         self.omop = OMOP_converter(full_init=False)
 
         
     def _get_pths(self, dir_dic, sample=900):
+        """
+        Samples the timeseries of 900 patients in each source database.
+        With TS_STORAGE='chunked', the samples are subsets of the patient
+        index instead of lists of paths.
+        """
+        if self.TS_STORAGE == 'chunked':
+            return {d: self._sample_patients(pth, sample)
+                    for d, pth in dir_dic.items() if d != 'blended'}
         
         pths = {d: self.ls(pth, sort=False)
                 for d, pth in dir_dic.items() if d != 'blended'}
         return {d: random.sample(v, sample) for d, v in pths.items()}
 
+    def _sample_patients(self, pth, sample):
+        patient_index = self.patient_index(pth)
+        patients = random.sample(patient_index.index.to_list(), sample)
+        return patient_index.loc[patients]
+
+    def _load_sample(self, pths, **kwargs):
+        if self.TS_STORAGE == 'chunked':
+            return self.load_patients(pths, **kwargs)
+        return self.load(pths, **kwargs)
+
     def flat_stats(self):
         self.labels = pd.read_parquet(self.labels_pth)
         self.dataset_mapper = self.labels.source_dataset
@@ -166,7 +187,7 @@ class Blendedicu_stats(blendedicuTSP):
         }).unstack(level=1))
 
     def _n_variables(self):
-        self.raw_timeseries = (self.load(self.ts_pths_lst, verbose=False)
+        self.raw_timeseries = (self._load_sample(self.ts_pths_lst, verbose=False)
                                .drop(columns='ventilator_mode'))
 
         self.n_variables_patients = ((self.raw_timeseries.drop(columns='time')
@@ -198,11 +219,11 @@ class Blendedicu_stats(blendedicuTSP):
         print('Computing timeseries frequencies...')
         ts_freq, ts_freq_std = {}, {}
         for dataset, pths in self.raw_ts_pths.items():
-            if not pths:
+            if len(pths) == 0:
                 print('skipping {dataset}')
                 continue
             print(f'  -> {dataset}')
-            ts = (self.load(pths, verbose=False)
+            ts = (self._load_sample(pths, verbose=False)
                   .drop(columns='ventilator_mode')
                   .set_index('time', append=True)
                   .groupby(level=[0, 1]).mean().droplevel(1)
@@ -243,10 +264,10 @@ class Blendedicu_stats(blendedicuTSP):
         self.med_freq = {}
         for dataset, pths in self.med_pths.items():
             print(f'   -> {dataset}')
-            if not pths:
+            if len(pths) == 0:
                 print('skipping {dataset}')
                 continue
-            self.meds = (self.load(pths, columns=['variable'], verbose=False)
+            self.meds = (self._load_sample(pths, columns=['variable'], verbose=False)
                          .reset_index()
                          .drop_duplicates())
 
@@ -301,7 +322,7 @@ class Blendedicu_stats(blendedicuTSP):
             title = '\n'.join(textwrap.wrap(self.omop_mapping[var],30))  # TODO exploiter la base telechargée...
             for dataset, ts_pths in self.raw_ts_pths.items():
                 if self.is_measured.loc[var, dataset]:
-                    ts_list.append(self.load(ts_pths, verbose=False, columns=[var]))
+                    ts_list.append(self._load_sample(ts_pths, verbose=False, columns=[var]))
             
             self.ts_list = ts_list
             
@@ -1,4 +1,5 @@
 import tarfile
+from functools import partial
 from pathlib import Path
 
 import pandas as pd
@@ -6,9 +7,19 @@ import pandas as pd
 from utils.parquet_utils import compute_offset
 from database_processing.medicationprocessor import MedicationProcessor
 from database_processing.datapreparator import DataPreparator
+from database_processing.tablescan import TableScan
+from hirid_preprocessing.patientbuckets import PatientBuckets
 
 
 class hiridPreparator(DataPreparator):
+    extraction_steps = {'gen_labels': [],
+                        'gen_medication': ['gen_labels'],
+                        'gen_timeseries': ['gen_labels']}
+    height_weight_ids = {'weight': 10000400,
+                         'height': 10000450}
+    ts_loader_kwargs = {'rename_dic': {'datetime': 'offset'},
+                        'itemid_label': 'variableid'}
+
     def __init__(
             self,
             variable_ref_path,
@@ -34,6 +45,13 @@ class hiridPreparator(DataPreparator):
         
         self.ts_savepth = self.parquet_pth+'/timeseries_1000_patient_chunks/'
         self.pharma_savepth = self.parquet_pth+'/pharma_1000_patient_chunks/'
+        self.ts_bucketpth = self.parquet_pth+'/timeseries_buckets/'
+        self.pharma_bucketpth = self.parquet_pth+'/pharma_buckets/'
+        self.step_outputs = {
+            'gen_labels': [self.labels_savepath],
+            'gen_medication': [self.pharma_savepth],
+            'gen_timeseries': [self.ts_savepth],
+            }
         self.id_mapping = self._variablenames_mapping()
 
         self.weights = None
@@ -58,13 +76,18 @@ class hiridPreparator(DataPreparator):
         tar.close()
 
 
-    def _load_ts_chunks(self):
+    def _load_ts_chunks(self, filters=None):
+        """
+        filters: rows to read, in the format of pd.read_parquet. They are
+            pushed down to the parquet reader.
+        """
         for p in Path(self.ts_path).iterdir():
             yield pd.read_parquet(p,
                                   columns=['datetime',
                                            'patientid',
                                            'value',
-                                           'variableid'])
+                                           'variableid'],
+                                  filters=filters)
 
     def _load_pharma_chunks(self):
         df_all_in_one_chunk = pd.read_parquet(self.med_path,
@@ -139,49 +162,82 @@ class hiridPreparator(DataPreparator):
         return {'observation': obs_id_mapping,
                 'pharma': pharma_id_mapping}
 
+    def _select_heights_weights(self, chunk):
+        """
+        Consumer of the observation table scan: heights and weights measured
+        before self.flat_hr_from_adm hours after admission.
+        """
+        chunk = (chunk.rename(columns={'datetime': 'valuedate',
+                                       'patientid': 'admissionid'})
+                 .merge(self.admissions[['admissiontime', 'admissionid']],
+                        on='admissionid')
+                 .pipe(compute_offset,
+                       col_intime='admissiontime',
+                       col_measuretime='valuedate'))
+
+        time_idx = chunk.valuedate < self.flat_hr_from_adm.total_seconds()
+        return chunk.loc[time_idx, ['admissionid', 'variableid', 'value']]
+
+    def _set_heights_weights(self, df_hw):
+        """
+        Admission height and weight, averaged over the selected measurements.
+        """
+        variables = self.height_weight_ids
+        if df_hw.empty:
+            df_hw = pd.DataFrame(columns=['admissionid', 'variableid', 'value'])
+
+        self.heights = (df_hw.loc[df_hw.variableid == variables['height'],
+                                  ['admissionid', 'value']]
+                             .rename(columns={'value': 'height'})
+                             .groupby('admissionid')
+                             .mean())
+        self.weights = (df_hw.loc[df_hw.variableid == variables['weight'],
+                                  ['admissionid', 'value']]
+                             .rename(columns={'value': 'weight'})
+                             .groupby('admissionid')
+                             .mean())
+
+    def _heights_weights_filters(self):
+        return [('variableid', 'in', [*self.height_weight_ids.values()])]
+
     def _load_heights_weights(self):
         """
         Fetches the admission height and weight to fill the labels table.
         The filled heights and weights are those that were available at 
         self.flat_hr_from_adm hours after admission.
+        Only the rows of the height and weight variables are read from the
+        observation tables.
         """
-        print('Fecting heights and weights from timesersies tables, this may '
-              'take several minutes...')
-        variables = {'weight': 10000400,
-                     'height': 10000450}
-
-        ts_chunks = self._load_ts_chunks()
-
-        heights, weights = [], []
-        for i, chunk in enumerate(ts_chunks):
-            print(f'Read {(i+1)*self.chunksize} lines from observation table...')
-            chunk = (chunk.rename(columns={'datetime': 'valuedate',
-                                           'patientid': 'admissionid'})
-                     .merge(self.admissions[['admissiontime', 'admissionid']],
-                            on='admissionid')
-                     .pipe(compute_offset,
-                           col_intime='admissiontime',
-                           col_measuretime='valuedate'))
-
-            h_idx = chunk.variableid == variables['height']
-            w_idx = chunk.variableid == variables['weight']
-
-            time_idx = chunk.valuedate < self.flat_hr_from_adm.total_seconds()
-            heights.append(chunk.loc[h_idx & time_idx,
-                           ['admissionid', 'value']])
-            weights.append(chunk.loc[w_idx & time_idx,
-                           ['admissionid', 'value']])
-
-        df_heights = (pd.concat(heights)
-                        .rename(columns={'value': 'height'})
-                        .groupby('admissionid')
-                        .mean())
-        df_weights = (pd.concat(weights)
-                        .rename(columns={'value': 'weight'})
-                        .groupby('admissionid')
-                        .mean())
-        self.weights = df_weights
-        self.heights = df_heights
+        print('Fetching heights and weights from timeseries tables...')
+        filters = self._heights_weights_filters()
+        scan = TableScan()
+        scan.register('heights_weights',
+                      self._select_heights_weights,
+                      filters=filters)
+        scanned = scan.run(self._load_ts_chunks(filters=filters))
+        self._set_heights_weights(scanned['heights_weights'])
+
+    def _numericize_ids(self, table, rename_dic, itemid_label):
+        numcols = [itemid_label, 'patientid']
+        table = table.rename(columns=rename_dic)
+
+        table[numcols] = table[numcols].apply(pd.to_numeric, errors='coerce')
+
+        return (table.dropna(subset=numcols)
+                     .astype({itemid_label: int,
+                              'patientid': int}))
+
+    def _finalize_patient_chunk(self,
+                                df_chunk,
+                                itemid_label='itemid',
+                                value_label='value',
+                                id_mapping=None):
+        df_chunk['admissionid'] = df_chunk['patientid']
+        df_chunk['variable'] = df_chunk[itemid_label].map(id_mapping)
+
+        df_chunk[value_label] = pd.to_numeric(df_chunk[value_label],
+                                              errors='coerce')
+        return df_chunk
 
     def _build_patient_chunk(self,
                              start,
@@ -196,7 +252,6 @@ class hiridPreparator(DataPreparator):
         To create patient chunks, we have to go through the whole file and
         select a list of patient ids.
         '''
-        numcols = [itemid_label, 'patientid']
         if self.labels is None:
             raise ValueError('Please run labels first.')
 
@@ -204,41 +259,97 @@ class hiridPreparator(DataPreparator):
         patient_chunk = self.stays[start:start+self.n_patient_chunk]
 
         for k, table in enumerate(chunk_loader()):
-            table = table.rename(columns=rename_dic)
-
-            table[numcols] = table[numcols].apply(
-                pd.to_numeric, errors='coerce')
-
-            table = (table.dropna(subset=numcols)
-                     .astype({itemid_label: int,
-                              'patientid': int}))
+            table = self._numericize_ids(table, rename_dic, itemid_label)
 
             table = table.loc[table.patientid.isin(patient_chunk)]
 
             chunk_tables.append(table)
 
         df_chunk = pd.concat(chunk_tables)
-        df_chunk['admissionid'] = df_chunk['patientid']
-        df_chunk['variable'] = df_chunk[itemid_label].map(id_mapping)
-
-        df_chunk[value_label] = pd.to_numeric(df_chunk[value_label],
-                                              errors='coerce')
-        return df_chunk
+        return self._finalize_patient_chunk(df_chunk,
+                                            itemid_label=itemid_label,
+                                            value_label=value_label,
+                                            id_mapping=id_mapping)
+
+    def _bucket_writer(self,
+                       bucket_path,
+                       stays,
+                       rename_dic={},
+                       itemid_label='itemid'):
+        """
+        Patient buckets of stays, the rows written to bucket k are those of
+        stays[k*n_patient_chunk:(k+1)*n_patient_chunk].
+        """
+        return PatientBuckets(bucket_path,
+                              stays,
+                              self.n_patient_chunk,
+                              prepare=partial(self._numericize_ids,
+                                              rename_dic=rename_dic,
+                                              itemid_label=itemid_label))
+
+    def _bucket_patient_chunks(self,
+                               bucket_path,
+                               chunk_loader=None,
+                               rename_dic={},
+                               itemid_label='itemid',
+                               value_label='value',
+                               id_mapping=None):
+        '''
+        Single pass alternative to _build_patient_chunk.
+        The source table is read once: each row is sent to the patient chunk
+        of its patientid and appended to a parquet file for this chunk.
+        Patient chunks are the same as in _build_patient_chunk, chunk k
+        contains self.stays[k*n_patient_chunk:(k+1)*n_patient_chunk].
+        The buckets may have been filled by the scan of gen_labels, the source
+        table is only read if they are not complete.
+        The chunks are then yielded in order and the bucket files are removed.
+        '''
+        if self.labels is None:
+            raise ValueError('Please run labels first.')
 
-    def gen_labels(self):
+        buckets = self._bucket_writer(bucket_path,
+                                      self.stays,
+                                      rename_dic=rename_dic,
+                                      itemid_label=itemid_label)
+        if buckets.is_complete():
+            print(f'Reusing the patient buckets of {bucket_path}')
+        else:
+            buckets.open()
+            try:
+                for i, table in enumerate(chunk_loader()):
+                    print(f'Bucketing source file {i+1}...')
+                    buckets.write(table)
+            finally:
+                buckets.close_writers()
+            buckets.close()
+
+        for df_chunk in buckets.chunks():
+            yield self._finalize_patient_chunk(df_chunk,
+                                               itemid_label=itemid_label,
+                                               value_label=value_label,
+                                               id_mapping=id_mapping)
+        buckets.remove()
+
+    def gen_labels(self, bucketing=True):
         """
         The admission table does not contain the heights and weights. 
         These variables must be fetched from the timeseries table.
         The length of stay (los) is not specified either.
         It is usually derived from the last measurement of a timeseries
         variable. 
+        With bucketing, the observation tables are read once: the heights and
+        weights are selected and the rows are split into the patient buckets
+        of gen_timeseries in the same pass.
         """
         print('o Labels')
         
         lengthsofstay = self._load_los()
 
         if (self.heights is None) or (self.weights is None):
-            self._load_heights_weights()
+            if bucketing:
+                self._scan_observations(lengthsofstay)
+            else:
+                self._load_heights_weights()
 
         admissions = (self.admissions.merge(self.heights,
                                             left_on='admissionid',
@@ -254,36 +365,71 @@ class hiridPreparator(DataPreparator):
         admissions['care_site'] = 'Bern University Hospital'
         self.save(admissions, self.parquet_pth+'labels.parquet')
 
-    def gen_timeseries(self):
+    def _scan_observations(self, lengthsofstay):
+        """
+        Single scan of the observation tables, shared by the heights and
+        weights and by the patient buckets of the timeseries. The stays are
+        those of the labels: the admissions with a length of stay.
+        """
+        admissionids = self.admissions.admissionid
+        stays = admissionids.loc[admissionids.isin(lengthsofstay.index)].unique()
+
+        buckets = self._bucket_writer(self.ts_bucketpth,
+                                      stays,
+                                      **self.ts_loader_kwargs)
+        scan = TableScan()
+        scan.register('heights_weights',
+                      self._select_heights_weights,
+                      filters=self._heights_weights_filters())
+        scan.register('timeseries', buckets.write)
+
+        print('Fetching heights and weights and bucketing the timeseries '
+              'tables...')
+        buckets.open()
+        try:
+            scanned = scan.run(self._load_ts_chunks(filters=scan.filters()))
+        finally:
+            buckets.close_writers()
+        buckets.close()
+        self._set_heights_weights(scanned['heights_weights'])
+
+    def gen_timeseries(self, bucketing=True):
         """
         The timeseries table is too large to be loaded in memory. 
         The icu stays are not ordered in the table. 
-        To create a chunk of 1000 patient, we must go through the whole file. 
-        Consequently, this processing step is longer than other databases.
+        With bucketing, the observation tables are split into patient chunks
+        on disk, during the scan of gen_labels or, if these buckets are not
+        available, in a single pass. Otherwise, to create a chunk of 1000
+        patient, we must go through the whole file, which is much longer.
         """
         self.reset_chunk_idx()
         self.get_labels()
-        for start in range(0, len(self.stays), self.n_patient_chunk):
 
-            chunk = self._build_patient_chunk(
-                                    start,
-                                    chunk_loader=self._load_ts_chunks,
-                                    rename_dic={'datetime': 'offset'},
-                                    itemid_label='variableid',
-                                    value_label='value',
-                                    id_mapping=self.id_mapping['observation'])
+        loader_kwargs = {'chunk_loader': self._load_ts_chunks,
+                         'value_label': 'value',
+                         'id_mapping': self.id_mapping['observation'],
+                         **self.ts_loader_kwargs}
+
+        if bucketing:
+            chunks = self._bucket_patient_chunks(self.ts_bucketpth,
+                                                 **loader_kwargs)
+        else:
+            chunks = (self._build_patient_chunk(start, **loader_kwargs)
+                      for start in range(0, len(self.stays), self.n_patient_chunk))
 
+        for chunk in chunks:
             self.chunk = self.prepare_tstable(chunk,
                                               col_offset='offset',
                                               col_intime='admissiontime')
 
             self.save_chunk(self.chunk, self.ts_savepth)
 
-    def gen_medication(self):
+    def gen_medication(self, bucketing=True):
         """
         Similary to the timeseries table, the patients are not ordered in the 
-        raw files. the _build_patient_chunk goes through the whole table to
-        extract data from a chunk of patients.
+        raw files. The pharma table is split into patient chunks with the same
+        bucketing as the timeseries table, or with _build_patient_chunk
+        that goes through the whole table for each chunk of patients.
         """
         self.reset_chunk_idx()
         self.get_labels()
@@ -297,16 +443,20 @@ class hiridPreparator(DataPreparator):
                                       offset_calc=True,
                                       col_admittime='admissiontime')
 
-        for start in range(0, len(self.stays), self.n_patient_chunk):
+        loader_kwargs = {'chunk_loader': self._load_pharma_chunks,
+                         'rename_dic': {'givenat': 'offset'},
+                         'itemid_label': 'pharmaid',
+                         'value_label': 'givendose',
+                         'id_mapping': self.id_mapping['pharma']}
 
-            chunk = self._build_patient_chunk(
-                                    start,
-                                    chunk_loader=self._load_pharma_chunks,
-                                    rename_dic={'givenat': 'offset'},
-                                    itemid_label='pharmaid',
-                                    value_label='givendose',
-                                    id_mapping=self.id_mapping['pharma'])
+        if bucketing:
+            chunks = self._bucket_patient_chunks(self.pharma_bucketpth,
+                                                 **loader_kwargs)
+        else:
+            chunks = (self._build_patient_chunk(start, **loader_kwargs)
+                      for start in range(0, len(self.stays), self.n_patient_chunk))
 
+        for chunk in chunks:
             chunk = (chunk.drop(columns=['givendose', 'pharmaid'])
                           .pipe(self.mp.run))
 
@@ -0,0 +1,116 @@
+"""
+Split of a source table that is not ordered by patient into patient chunks
+on disk.
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database_processing.chunkmanifest import fingerprint
+
+
+class PatientBuckets:
+    """
+    Parquet files of the rows of a source table, one per chunk of patients.
+    Chunk k contains stays[k*n_patient_chunk:(k+1)*n_patient_chunk]. The rows
+    are appended by write(), which can be used as a consumer of a TableScan,
+    and read back in order by chunks().
+    A marker file is written by close(), so that buckets filled by an earlier
+    stage are reused when they were built for the same stays.
+
+    pth: directory of the bucket files.
+    stays: ordered patient ids.
+    n_patient_chunk: number of patients per chunk.
+    prepare: function applied to each table before it is split, it must keep
+        the 'patientid' column.
+    """
+    def __init__(self, pth, stays, n_patient_chunk, prepare=None):
+        self.pth = Path(pth)
+        self.n_patient_chunk = n_patient_chunk
+        self.prepare = prepare
+        self.n_chunks = -(-len(stays) // n_patient_chunk)
+        self.chunk_of_stay = pd.Series(np.arange(len(stays)) // n_patient_chunk,
+                                       index=stays)
+        self.key = fingerprint([pd.Index(stays), n_patient_chunk])
+        self.bucket_pths = [self.pth/f'bucket_{k}.parquet'
+                            for k in range(self.n_chunks)]
+        self.marker_pth = self.pth/'_complete.json'
+        self.writers = {}
+        self.schema = None
+
+    def is_complete(self):
+        try:
+            with open(self.marker_pth) as file:
+                return json.load(file).get('key') == self.key
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def open(self):
+        self.remove()
+        self.pth.mkdir(parents=True)
+        self.writers = {}
+        self.schema = None
+
+    def write(self, table):
+        """
+        Appends the rows of table to the buckets of their patients. Returns
+        an empty DataFrame, as a TableScan consumer.
+        """
+        if self.prepare is not None:
+            table = self.prepare(table)
+        buckets = table.patientid.map(self.chunk_of_stay)
+        table = table.loc[buckets.notna()]
+
+        for k, df in table.groupby(buckets.dropna().astype(int)):
+            if self.schema is None:
+                self.schema = pa.Schema.from_pandas(df, preserve_index=False)
+            if k not in self.writers:
+                self.writers[k] = pq.ParquetWriter(self.bucket_pths[k],
+                                                   self.schema)
+            self.writers[k].write_table(pa.Table.from_pandas(df,
+                                                             schema=self.schema,
+                                                             preserve_index=False))
+        return pd.DataFrame()
+
+    def close_writers(self):
+        """
+        Closes the bucket files without marking the buckets as complete, eg.
+        when the scan of the source table failed.
+        """
+        for writer in self.writers.values():
+            writer.close()
+
+    def close(self):
+        self.close_writers()
+
+        if self.schema is None:
+            raise ValueError(f'No row of the source table matched the '
+                             f'labelled stays, see {self.pth}')
+
+        self.schema.empty_table().to_pandas().to_parquet(self.pth/'_empty.parquet')
+        tmp_pth = self.marker_pth.with_name(self.marker_pth.name+'.tmp')
+        with open(tmp_pth, 'w') as file:
+            json.dump({'key': self.key,
+                       'buckets': sorted(self.writers)},
+                      file)
+        os.replace(tmp_pth, self.marker_pth)
+
+    def chunks(self):
+        """
+        DataFrames of the patient chunks, in the order of stays.
+        """
+        empty = pd.read_parquet(self.pth/'_empty.parquet')
+        for pth in self.bucket_pths:
+            if pth.is_file():
+                yield pd.read_parquet(pth)
+            else:
+                yield empty.copy()
+
+    def remove(self):
+        shutil.rmtree(self.pth, ignore_errors=True)
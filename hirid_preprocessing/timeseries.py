@@ -1,3 +1,4 @@
+from database_processing.stagecache import cached_stage
 from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
 
 
@@ -7,8 +8,8 @@ class hiridTSP(TimeseriesPreprocessing):
     * 2 long tables: timeseries and pharma
     * 1 medication table that was computed in 1_hirid.py
     """
-    def __init__(self, ts_chunks, pharma_chunks):
-        super().__init__(dataset='hirid')
+    def __init__(self, ts_chunks, pharma_chunks, n_workers=None):
+        super().__init__(dataset='hirid', n_workers=n_workers)
         self.ts_files = self.ls(self.parquet_pth+ts_chunks)
         self.pharma_files = self.ls(self.parquet_pth+pharma_chunks)
 
@@ -24,24 +25,28 @@ class hiridTSP(TimeseriesPreprocessing):
 
         self.loadcols = self.ts_colnames.values()
 
-    def run(self):
-
-        self.reset_dir()
-
+    def _chunk_inputs(self):
         kept_variables = (self.kept_ts+['Body weight', 'Body height measure'])
 
         for ts_pth, pharma_pth in zip(self.ts_files, self.pharma_files):
-            self.timeseries = self.load(ts_pth, columns=self.loadcols)
+            timeseries = self.load(ts_pth, columns=self.loadcols)
 
-            self.pharma = self.load(pharma_pth)
+            pharma = self.load(pharma_pth)
 
-            ts = self.filter_tables(self.timeseries,
+            ts = self.filter_tables(timeseries,
                                     kept_variables,
                                     **self.ts_colnames)
-            self.ts = ts
 
-            med = self.filter_tables(self.pharma,
+            med = self.filter_tables(pharma,
                                      self.kept_med,
                                      **self.med_colnames)
 
-            self.process_tables(ts, med=med)
+            yield {'ts_ver': ts,
+                   'med': med}
+
+    @cached_stage
+    def run(self):
+
+        self.reset_dir()
+
+        self.process_chunks(self._chunk_inputs())
@@ -5,9 +5,27 @@ import pandas as pd
 
 from database_processing.medicationprocessor import MedicationProcessor
 from database_processing.datapreparator import DataPreparator
+from database_processing.tablescan import TableScan
 
 
 class mimicPreparator(DataPreparator):
+    extraction_steps = {'load_raw_tables': [],
+                        'build_source_cache': [],
+                        'gen_labels': ['load_raw_tables'],
+                        'gen_flat': ['load_raw_tables', 'gen_timeseries'],
+                        'gen_medication': ['load_raw_tables'],
+                        'gen_timeseriesoutputs': ['gen_labels'],
+                        'gen_timeserieslab': ['gen_labels',
+                                              'build_source_cache'],
+                        'gen_timeseries': ['gen_labels', 'build_source_cache']}
+    source_tables = {'chartevents_pth': 'stay_id',
+                     'labevents_pth': 'hadm_id'}
+    height_weight_itemids = {'weight_kg_2': 224639,
+                             'weight_kg': 226512,
+                             'weight_lbs': 226531,
+                             'height_inch': 226707,
+                             'height_cm': 226730}
+
     def __init__(self,
                  chartevents_pth,
                  labevents_pth):
@@ -23,11 +41,36 @@ class mimicPreparator(DataPreparator):
         self.dlabitems_pth = f'{self.parquet_pth}d_labitems.parquet'
         self.tslab_savepath = f'{self.parquet_pth}/timeserieslab.parquet'
         self.ts_savepath = f'{self.parquet_pth}/timeseries.parquet'
+        self.heights_weights_savepath = f'{self.parquet_pth}/heights_weights.parquet'
         self.outputevents_savepath = f'{self.parquet_pth}/timeseriesoutputs.parquet'
+        self.step_outputs = {
+            'load_raw_tables': [self.dlabitems_pth,
+                                self.admissions_pth,
+                                self.ditems_pth,
+                                self.inputevents_pth,
+                                self.outputevents_pth,
+                                self.icustays_pth,
+                                self.patients_pth],
+            'gen_labels': [self.labels_savepath],
+            'gen_flat': [self.flat_savepath],
+            'gen_medication': [self.med_savepath],
+            'gen_timeseriesoutputs': [self.outputevents_savepath],
+            'gen_timeserieslab': [self.tslab_savepath],
+            'gen_timeseries': [self.ts_savepath,
+                               self.heights_weights_savepath],
+            }
         self.col_los = 'los'
         self.unit_los = 'day'
-        self.icustays = self._icustays()
+        self.icustays = None
         
+    def get_icustays(self):
+        """
+        The icustays table is built from the parquet files written by 
+        load_raw_tables, so it is only loaded by the steps that need it.
+        """
+        if self.icustays is None:
+            self.icustays = self._icustays()
+
     def _icustays(self):
         admissions = pd.read_parquet(self.admissions_pth,
                                      columns=['hadm_id',
@@ -63,45 +106,31 @@ class mimicPreparator(DataPreparator):
 
             self.save(pd.read_csv(f'{pth_csv}.csv.gz'), f'{pth_pqt}.parquet')
 
+    def _select_heights_weights(self, df):
+        """
+        Consumer of the chartevents scan of gen_timeseries: heights and
+        weights measured before self.flat_hr_from_adm.
+        """
+        df = df.merge(self.icustays[['stay_id', 'intime']], on='stay_id')
+
+        df['measuretime'] = ((pd.to_datetime(df['charttime'])
+                             - pd.to_datetime(df['intime']))
+                             .astype('timedelta64[s]'))
+
+        df = df.loc[df.measuretime < self.flat_hr_from_adm]
+        return df.drop(columns=['measuretime', 'intime'])
+
     def _fetch_heights_weights(self):
         """
         admission heights and weights, available at self.flat_hr_from_adm
         are fetched to fill the flat and labels tables.
         They can be found under several itemids depending on the unit in 
         which they are measured. Every value is converted to the metric system.
+        The measurements are selected from the chartevents table by 
+        gen_timeseries, in the same pass as the timeseries.
         """
-        print('Fetching heights and weights in the chartevents table...'
-              'this may take several minutes.')
-        itemids = {'weight_kg_2': 224639,
-                   'weight_kg': 226512,
-                   'weight_lbs': 226531,
-                   'height_inch': 226707,
-                   'height_cm': 226730}
-
-        keepids = [*itemids.values()]
-
-        chartevents = pd.read_csv(self.chartevents_pth,
-                                  chunksize=self.chunksize,
-                                  usecols=['stay_id',
-                                           'itemid',
-                                           'valuenum',
-                                           'charttime'])
-
-        dfs_hw = []
-        for i, df in enumerate(chartevents):
-            print(f'Read {(i+1)*self.chunksize} lines from chartevents table...')
-            df = df.merge(self.icustays[['stay_id', 'intime']], on='stay_id')
-                    
-            df['measuretime'] = ((pd.to_datetime(df['charttime'])
-                                 - pd.to_datetime(df['intime']))
-                                 .astype('timedelta64[s]'))
-
-            df = df.loc[(df.itemid.isin(keepids))
-                        & (df.measuretime < self.flat_hr_from_adm)]
-
-            dfs_hw.append(df.drop(columns=['measuretime', 'intime']))
-
-        df_hw = pd.concat(dfs_hw)
+        itemids = self.height_weight_itemids
+        df_hw = self.load(self.heights_weights_savepath)
 
         inch_idx = df_hw.itemid == itemids['height_inch']
         lbs_idx = df_hw.itemid == itemids['weight_lbs']
@@ -126,6 +155,7 @@ class mimicPreparator(DataPreparator):
 
     def gen_flat(self):
         print('o Flat Features')
+        self.get_icustays()
         patients = pd.read_parquet(self.patients_pth,
                                    columns=['subject_id',
                                             'gender',
@@ -188,6 +218,7 @@ class mimicPreparator(DataPreparator):
 
     def gen_labels(self):
         print('o Labels')
+        self.get_icustays()
         labels = self.icustays.loc[:, ['subject_id', 'hadm_id',
                                        'stay_id', 'los', 'intime',
                                        'discharge_location', 'first_careunit']]
@@ -237,12 +268,6 @@ class mimicPreparator(DataPreparator):
                                     columns=['label', 'itemid'])
 
         print('o Timeseries Lab')
-        labevents = pd.read_csv(self.labevents_pth,
-                                chunksize=self.chunksize,
-                                usecols=['hadm_id',
-                                         'itemid',
-                                         'charttime',
-                                         'valuenum'])
 
         keepvars = ['MCV', 'Phosphate', 'Hemoglobin', 'PTT', 'Platelet Count',
                     'RDW',
@@ -262,6 +287,15 @@ class mimicPreparator(DataPreparator):
 
         keepitemids = dlabitems.loc[dlabitems.label.isin(keepvars), 'itemid']
 
+        labevents = self.read_table(self.labevents_pth,
+                                    chunk_rows=self.chunksize,
+                                    columns=['hadm_id',
+                                             'itemid',
+                                             'charttime',
+                                             'valuenum'],
+                                    filters=[('itemid', 'in',
+                                              keepitemids.to_list())])
+
         prepare_tslab = partial(self.prepare_tstable,
                                 keepvars=keepitemids,
                                 col_offset='charttime',
@@ -280,17 +314,13 @@ class mimicPreparator(DataPreparator):
         """
         This timeseries table does not fit in memory, it is processed by 
         chunks. The processed table is smaller so it is saved to a single file.
+        The admission heights and weights used by gen_flat are selected in
+        the same pass over the chartevents table.
         """
         self.get_labels()
+        self.get_icustays()
         ditems = pd.read_parquet(self.ditems_pth, columns=['itemid', 'label'])
 
-        chartevents = pd.read_csv(self.chartevents_pth,
-                                  chunksize=self.chunksize,
-                                  usecols=['stay_id',
-                                           'charttime',
-                                           'itemid',
-                                           'valuenum'])
-
         print('o Timeseries')
 
         keepvars = ['Hemoglobin', 'Potassium (whole blood)',
@@ -377,8 +407,27 @@ class mimicPreparator(DataPreparator):
                                 col_variable='itemid',
                                 )
 
-        self.df_ts = (pd.concat(map(prepare_tslab, chartevents))
-                        .merge(ditems, on='itemid')
-                        .drop(columns='itemid'))
+        scan = TableScan()
+        scan.register('timeseries',
+                      prepare_tslab,
+                      filters=[('itemid', 'in', keepitemids.to_list())])
+        scan.register('heights_weights',
+                      self._select_heights_weights,
+                      filters=[('itemid', 'in',
+                                [*self.height_weight_itemids.values()])])
+
+        chartevents = self.read_table(self.chartevents_pth,
+                                      chunk_rows=self.chunksize,
+                                      columns=['stay_id',
+                                               'charttime',
+                                               'itemid',
+                                               'valuenum'],
+                                      filters=scan.filters())
+        scanned = scan.run(chartevents)
+
+        self.df_ts = (scanned['timeseries']
+                      .merge(ditems, on='itemid')
+                      .drop(columns='itemid'))
 
         self.save(self.df_ts, self.ts_savepath)
+        self.save(scanned['heights_weights'], self.heights_weights_savepath)
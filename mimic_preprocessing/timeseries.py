@@ -1,5 +1,6 @@
 import pandas as pd
 
+from database_processing.stagecache import cached_stage
 from database_processing.timeseriespreprocessing import TimeseriesPreprocessing
 
 
@@ -13,8 +14,9 @@ class mimicTSP(TimeseriesPreprocessing):
                  med_pth,
                  ts_pth,
                  tslab_pth,
-                 outputevents_pth):
-        super().__init__(dataset='mimic')
+                 outputevents_pth,
+                 n_workers=None):
+        super().__init__(dataset='mimic', n_workers=n_workers)
 
         self.medication = self.load(self.parquet_pth+med_pth)
         self.timeseries = self.load(self.parquet_pth+ts_pth)
@@ -53,6 +55,7 @@ class mimicTSP(TimeseriesPreprocessing):
             'col_time': 'offset'
         }
 
+    @cached_stage
     def run(self):
 
         self.outputevents = self.filter_tables(self.outputevents,
@@ -78,12 +81,15 @@ class mimicTSP(TimeseriesPreprocessing):
 
         patientids = self.timeser.patient.drop_duplicates()
         self.chunks = self.generate_patient_chunks(patientids)
+        self.timeser = self.index_patients(self.timeser)
+        self.medic = self.index_patients(self.medic)
 
+        self.process_chunks(self._chunk_inputs())
+
+    def _chunk_inputs(self):
         for patient_chunk in self.chunks:
-            ts_chunk = self.timeser.loc[self.timeser.patient.isin(patient_chunk)]
-            med_chunk = self.medic.loc[self.medic.patient.isin(patient_chunk)]
-            self.ts_chunk = ts_chunk
-            self.med_chunk=med_chunk
+            ts_chunk = self.timeser.get(patient_chunk)
+            med_chunk = self.medic.get(patient_chunk)
 
-            self.process_tables(ts_chunk,
-                                med=med_chunk)
+            yield {'ts_ver': ts_chunk,
+                   'med': med_chunk}
@@ -0,0 +1,51 @@
+"""
+Stable integer ids from string identifiers, eg. the OMOP person and visit
+ids from the blendedICU patient ids.
+"""
+import numpy as np
+import pyarrow as pa
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def _fnv1a(data, starts, lengths, state):
+    """
+    64-bit FNV-1a hash of the byte strings data[starts[i]:starts[i]+lengths[i]],
+    continuing from state. The strings are hashed together, one byte
+    position at a time.
+    """
+    for k in range(lengths.max(initial=0)):
+        active = np.flatnonzero(lengths > k)
+        state[active] ^= data[starts[active] + k].astype(np.uint64)
+        state[active] *= _FNV_PRIME
+    return state
+
+
+def hash_ids(values, prefix=''):
+    """
+    Positive int64 ids of an array of strings: the 64-bit FNV-1a hash of
+    prefix+'_'+value, shifted right by one bit to fit in a positive int64.
+    The hash is computed on the utf8 buffers of the arrow array, for all the
+    values at once. It only depends on the values, so the ids are the same
+    in every run.
+    """
+    arr = pa.array(values, type=pa.large_string())
+    if arr.null_count:
+        raise ValueError('Cannot hash missing identifiers.')
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64)
+    offsets = offsets[arr.offset:arr.offset+len(arr)+1]
+    data = arr.buffers()[2]
+    data = (np.frombuffer(data, dtype=np.uint8) if data is not None
+            else np.zeros(0, dtype=np.uint8))
+
+    prefix = np.frombuffer(f'{prefix}_'.encode(), dtype=np.uint8)
+    state = _fnv1a(prefix, np.zeros(1, dtype=np.int64),
+                   np.array([len(prefix)]),
+                   np.array([_FNV_OFFSET]))
+
+    hashed = _fnv1a(data,
+                    offsets[:-1],
+                    np.diff(offsets),
+                    np.repeat(state, len(arr)))
+    return (hashed >> np.uint64(1)).astype(np.int64)
@@ -0,0 +1,28 @@
+import sys
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss(children=False):
+    """
+    Peak resident set size of the current process, in bytes.
+    With children=True, peak resident set size of the largest terminated
+    child process instead.
+    Returns None when it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+
+def format_peak_rss():
+    rss = peak_rss()
+    if rss is None:
+        return 'peak RSS: n/a'
+    return f'peak RSS: {rss/1024**3:.2f} GB'
@@ -0,0 +1,147 @@
+"""
+Opt-in instrumentation of the processing steps.
+
+Methods decorated with `traced` record their duration, the number of rows
+and the memory of their input and output DataFrames. Profiling is enabled by
+setting PROFILE in config.json to the path of a trace file:
+    '*.jsonl': one JSON event per line,
+    '*.json': Chrome trace format, which can be opened in chrome://tracing
+        or https://ui.perfetto.dev
+The events of all processes are appended to the same file. The time spent
+in each step is summarized with
+    python -m utils.profiling trace.jsonl
+"""
+import functools
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+
+def _n_rows(data):
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return len(data)
+    return None
+
+
+def _memory(data):
+    """
+    Memory of a DataFrame in bytes. The objects of object columns are not
+    counted, measuring them would cost more than most of the traced steps.
+    """
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True).sum())
+    if isinstance(data, pd.Series):
+        return int(data.memory_usage(index=True))
+    return None
+
+
+class Profiler:
+    """
+    output: path of the trace file, profiling is disabled if empty.
+    dataset: recorded with each event, to compare the source databases.
+    chunk: label of the chunk being processed, recorded with each event.
+    """
+    def __init__(self, output=None, dataset=None):
+        self.output = output or None
+        self.dataset = dataset
+        self.chunk = None
+        self.chrome = self.output is not None and self.output.endswith('.json')
+
+    @property
+    def enabled(self):
+        return self.output is not None
+
+    def _write(self, event):
+        if self.chrome:
+            try:
+                # the closing bracket of the array is optional in the Chrome
+                # trace format, the events can be appended by every process.
+                with open(self.output, 'x') as file:
+                    file.write('[\n')
+            except FileExistsError:
+                pass
+            line = json.dumps({'name': event['name'],
+                               'cat': event['dataset'],
+                               'ph': 'X',
+                               'ts': event['start']*1e6,
+                               'dur': event['duration']*1e6,
+                               'pid': event['pid'],
+                               'tid': event['pid'],
+                               'args': event}) + ',\n'
+        else:
+            line = json.dumps(event) + '\n'
+        with open(self.output, 'a') as file:
+            file.write(line)
+
+    def record(self, name, start, duration, data_in=None, data_out=None,
+               mem_in=None):
+        mem_out = _memory(data_out)
+        self._write({'name': name,
+                     'dataset': self.dataset,
+                     'chunk': self.chunk,
+                     'pid': os.getpid(),
+                     'start': start,
+                     'duration': duration,
+                     'rows_in': _n_rows(data_in),
+                     'rows_out': _n_rows(data_out),
+                     'mem_in': mem_in,
+                     'mem_out': mem_out,
+                     'mem_delta': (None if mem_in is None or mem_out is None
+                                   else mem_out - mem_in)})
+
+
+def traced(func):
+    """
+    Decorator of the methods of DataProcessor objects. The input is the
+    first argument after self, eg. the DataFrame of a .pipe step or the path
+    of a load.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None or not profiler.enabled:
+            return func(self, *args, **kwargs)
+
+        data_in = args[0] if args else next(iter(kwargs.values()), None)
+        mem_in = _memory(data_in)
+        start, start_perf = time.time(), time.perf_counter()
+        data_out = func(self, *args, **kwargs)
+        duration = time.perf_counter() - start_perf
+        profiler.record(func.__qualname__, start, duration,
+                        data_in=data_in, data_out=data_out, mem_in=mem_in)
+        return data_out
+    return wrapper
+
+
+def load_trace(pth):
+    if pth.endswith('.json'):
+        with open(pth) as file:
+            content = file.read().rstrip().rstrip(',')
+        events = json.loads(content if content.endswith(']') else content+']')
+        return pd.DataFrame([e['args'] for e in events])
+    return pd.read_json(pth, lines=True)
+
+
+def summarize(pth):
+    """
+    Total duration, number of calls and rows of each traced step, for each
+    dataset. Nested steps are included in the duration of their parents.
+    """
+    return (load_trace(pth)
+            .groupby(['dataset', 'name'], dropna=False)
+            .agg(duration=('duration', 'sum'),
+                 calls=('duration', 'size'),
+                 rows_in=('rows_in', 'sum'),
+                 rows_out=('rows_out', 'sum'),
+                 mem_delta=('mem_delta', 'sum'))
+            .sort_values(['dataset', 'duration'], ascending=[True, False]))
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.max_rows', None,
+                           'display.max_columns', None,
+                           'display.width', 200):
+        print(summarize(sys.argv[1]))
@@ -0,0 +1,69 @@
+"""
+Vectorized conversion of time offsets to datetimes, eg. the OMOP dates and
+times from the offsets in seconds or days of the blendedICU tables.
+The conversions are done with numpy arithmetic on datetime64 columns instead
+of a datetime or Timedelta object per element.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def _day_microseconds(days):
+    """
+    Microseconds in a number of days, rounded as datetime.timedelta(days)
+    does: the whole days are converted exactly, the fraction is converted to
+    microseconds and only its remainder is rounded, half to even on the total.
+    """
+    day_fractions, whole_days = np.modf(days)
+    leftover, microseconds = np.modf(day_fractions*86_400_000_000.)
+    total = whole_days*86_400_000_000. + microseconds
+    rounded = np.round(leftover)
+    ties = np.abs(leftover) == 0.5
+    rounded[ties] = np.where(total[ties] % 2 != 0, np.sign(leftover[ties]), 0.)
+    return total + rounded
+
+
+def offsets_to_datetimes(ref_date, offsets, unit='s'):
+    """
+    datetime64[ns] Series of ref_date + offsets, with offsets in days ('D')
+    or seconds ('s'). Offsets in days are rounded to the microsecond as
+    datetime.timedelta does, offsets in seconds are converted to nanoseconds
+    as pd.Timedelta does. Missing offsets give NaT.
+    """
+    offsets = pd.Series(offsets, dtype=float, copy=False)
+    if unit == 'D':
+        deltas = pd.to_timedelta(_day_microseconds(offsets.to_numpy()), unit='us')
+    elif unit == 's':
+        deltas = pd.to_timedelta(offsets.to_numpy(), unit='s')
+    else:
+        raise ValueError(f'Unknown offset unit {unit}')
+    return pd.Series(pd.Timestamp(ref_date) + deltas, index=offsets.index)
+
+
+def years_to_datetimes(years):
+    """
+    datetime64[ns] Series of the first of January of years, the years are
+    truncated to integers.
+    """
+    years = pd.Series(years, copy=False)
+    dates = (years.to_numpy().astype(int) - 1970).astype('datetime64[Y]')
+    return pd.Series(dates.astype('datetime64[ns]'), index=years.index)
+
+
+def times_of_day(datetimes):
+    """
+    Time of day of a datetime64 Series as a time64[us] arrow column, as
+    .dt.time without a datetime.time object per element: the nanoseconds
+    since the epoch modulo a day, truncated to the microsecond. The column
+    is saved as time64[us] in parquet and written as str(datetime.time) by
+    DataFrame.to_csv. Missing datetimes give nulls.
+    """
+    datetimes = pd.Series(datetimes, copy=False)
+    nanoseconds = datetimes.to_numpy(dtype='datetime64[ns]').view('i8')
+    microseconds = (nanoseconds % 86_400_000_000_000) // 1000
+    times = pa.array(microseconds,
+                     mask=datetimes.isna().to_numpy(),
+                     type=pa.int64()).cast(pa.time64('us'))
+    return pd.Series(pd.arrays.ArrowExtensionArray(times),
+                     index=datetimes.index)